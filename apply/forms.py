@@ -208,12 +208,9 @@ class InstanceForm(forms.ModelForm):
                                                     " qualified, e.g. <em>host"
                                                     ".domain.com</em>, not"
                                                     " <em>host</em>")))
-        existing_instances = Instance.objects.all()
         pending_instances = InstanceApplication.objects.all()
         names_pending = [j.hostname for j in pending_instances if j.is_pending()]
-        names = [i.name for i in existing_instances]
-        reserved_names = names + names_pending
-        if hostname in reserved_names:
+        if hostname in names_pending or Instance.objects.filter(name=hostname):
             raise forms.ValidationError(_("Hostname already exists."))
         return hostname
 
@@ -397,9 +394,7 @@ class InstanceApplicationReviewForm(InstanceForm):
                                                     " qualified, e.g. <em>host"
                                                     ".domain.com</em>, not"
                                                     " <em>host</em>")))
-        existing_instances = Instance.objects.all()
-        names = [i.name for i in existing_instances]
-        if hostname in names:
+        if Instance.objects.filter(name=hostname):
             raise forms.ValidationError(_("Hostname already exists."))
         return hostname
 
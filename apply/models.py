@@ -30,12 +30,7 @@ from django.conf import settings
 
 GANETI_TAG_PREFIX = settings.GANETI_TAG_PREFIX
 
-try:
-    from ganetimgr.settings import BEANSTALK_TUBE
-except ImportError:
-    BEANSTALK_TUBE = None
-
-import beanstalkc
+from ganeti.jobqueue import enqueue
 from paramiko import RSAKey, DSSKey
 from binascii import hexlify
 
@@ -283,13 +278,10 @@ class InstanceApplication(models.Model):
         self.save()
         application_submitted.send(sender=self)
 
-        b = beanstalkc.Connection()
-        if BEANSTALK_TUBE:
-            b.use(BEANSTALK_TUBE)
-        b.put(json.dumps({
+        enqueue({
             "type": "CREATE",
             "application_id": self.id
-        }))
+        })
 
     def get_ssh_keys_url(self, prefix=None):
         if prefix is None:
@@ -22,7 +22,7 @@ from django.contrib.sites.models import Site
 from django.contrib import messages
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.core.cache import cache
+from ganeti.caching import cache
 from django.core.mail import send_mail, mail_managers
 from django.shortcuts import render, get_object_or_404
 from django.http import Http404
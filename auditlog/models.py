@@ -27,9 +27,17 @@ class AuditEntry(models.Model):
     cluster = models.CharField(max_length=50)
     job_id = models.IntegerField(null=True, blank=True)
     recorded = models.DateTimeField(auto_now_add=True)
-    last_updated = models.DateTimeField(auto_now=True)
+    last_updated = models.DateTimeField(auto_now=True, db_index=True)
     is_authorized = models.BooleanField(default=True)
 
+    class Meta:
+        # the audit log is listed by time, for a user or for everyone, and
+        # looked up by instance
+        index_together = [
+            ('requester', 'last_updated'),
+            ('cluster', 'instance'),
+        ]
+
     def __unicode__(self):
         return "%s %s %s" % (self.requester, self.action, self.instance)
 
@@ -1,12 +1,15 @@
 from django.test import TestCase, Client, RequestFactory
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
+from auditlog.models import AuditEntry
 from auditlog.utils import auditlog_entry
 import json
 
 
 class AuditlogTest(TestCase):
     def setUp(self):
+        cache.clear()
         self.client = Client()
         self.user = User.objects.create_user('audittest', 'test@test.com', 'audittest')
         self.superuser = User.objects.create_user('audittestadmin', 'test@test.com', 'audittestadmin')
@@ -37,7 +40,7 @@ class AuditlogTest(TestCase):
         self.assertEqual(res.status_code, 200)
 
         # the response should be empty
-        response = json.loads(res.content)
+        response = json.loads(''.join(res.streaming_content))
         self.assertEqual(len(response['aaData']), 0)
 
         # lets create an audit entry
@@ -50,11 +53,10 @@ class AuditlogTest(TestCase):
         # get again the auditlog
         res = self.client.get(reverse('auditlog_json'))
         self.assertEqual(res.status_code, 200)
-        response = json.loads(res.content)
+        response = json.loads(''.join(res.streaming_content))
         self.assertEqual(response['aaData'][0]['user'], entry.requester.username)
 
         # the response should not be empty this time
-        response = json.loads(res.content)
         self.assertEqual(len(response['aaData']), 1)
 
         # do it again as a simple user
@@ -63,15 +65,97 @@ class AuditlogTest(TestCase):
 
         res = self.client.get(reverse('auditlog_json'))
         self.assertEqual(res.status_code, 200)
-        response = json.loads(res.content)
 
         # the response should be empty for a simple user
-        response = json.loads(res.content)
+        response = json.loads(''.join(res.streaming_content))
         self.assertEqual(len(response['aaData']), 0)
 
         # but it sould have an entry for the superuser
         self.client.login(username='audittestadmin', password='audittestadmin')
         res = self.client.get(reverse('auditlog_json'))
         self.assertEqual(res.status_code, 200)
-        response = json.loads(res.content)
+        response = json.loads(''.join(res.streaming_content))
         self.assertEqual(len(response['aaData']), 1)
+
+    def get_json(self, **params):
+        res = self.client.get(reverse('auditlog_json'), params)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(''.join(res.streaming_content))
+
+    def test_auditlog_pages(self):
+        request = self.factory.get(reverse('auditlog_json'))
+        request.user = self.superuser
+        for i in range(5):
+            auditlog_entry(request, "Reboot", 'test%d' % (i % 2), 'test')
+        auditlog_entry(request, "Shutdown", 'test0', 'other')
+        self.client.login(username='audittestadmin', password='audittestadmin')
+
+        # newest first, followed through the cursor of every page
+        ids = []
+        response = self.get_json(limit=4)
+        ids.extend(e['id'] for e in response['aaData'])
+        self.assertEqual(len(ids), 4)
+        response = self.get_json(limit=4, cursor=response['next'])
+        ids.extend(e['id'] for e in response['aaData'])
+        self.assertIsNone(response['next'])
+        self.assertEqual(ids, sorted(ids, reverse=True))
+        self.assertEqual(len(set(ids)), 6)
+
+        response = self.get_json(order='asc', limit=10)
+        self.assertEqual([e['id'] for e in response['aaData']], ids[::-1])
+
+        response = self.get_json(cluster='test', instance='test0')
+        self.assertEqual(len(response['aaData']), 3)
+        response = self.get_json(search='shut')
+        self.assertEqual(response['aaData'][0]['cluster'], 'other')
+
+        # DataTables server-side processing
+        response = self.get_json(
+            sEcho=2, iDisplayStart=0, iDisplayLength=2, iColumns=2,
+            mDataProp_1='cluster', sSearch_1='test|other'
+        )
+        self.assertEqual(response['sEcho'], 2)
+        self.assertEqual(response['iTotalRecords'], 6)
+        self.assertEqual(response['iTotalDisplayRecords'], 6)
+        self.assertEqual(len(response['aaData']), 2)
+        response = self.get_json(
+            sEcho=3, iDisplayLength=2, iColumns=2,
+            mDataProp_1='cluster', sSearch_1='other'
+        )
+        self.assertEqual(response['iTotalDisplayRecords'], 1)
+
+    def test_auditlog_cursor(self):
+        request = self.factory.get(reverse('auditlog_json'))
+        request.user = self.superuser
+        for i in range(3):
+            auditlog_entry(request, "Reboot", 'test%d' % i, 'test')
+        self.client.login(username='audittestadmin', password='audittestadmin')
+        response = self.get_json(limit=2)
+        ids = [e['id'] for e in response['aaData']]
+        cursor = response['next']
+
+        # the entry the cursor points to is updated after the page was read,
+        # which moves it to the top without the next page repeating entries
+        AuditEntry.objects.get(pk=ids[-1]).save()
+        response = self.get_json(limit=10, cursor=cursor)
+        self.assertEqual(
+            [e['id'] for e in response['aaData']], [ids[-1] - 1]
+        )
+        # malformed cursors start over
+        response = self.get_json(limit=10, cursor='bogus')
+        self.assertEqual(len(response['aaData']), 3)
+
+    def test_auditlog_counts_cached(self):
+        request = self.factory.get(reverse('auditlog_json'))
+        request.user = self.superuser
+        auditlog_entry(request, "Reboot", 'test', 'test')
+        self.client.login(username='audittestadmin', password='audittestadmin')
+        params = {'sEcho': 1, 'iDisplayLength': 10}
+        self.assertEqual(self.get_json(**params)['iTotalRecords'], 1)
+        auditlog_entry(request, "Reboot", 'test', 'test')
+        with self.assertNumQueries(5):
+            # the session, the user, their profile, the page and the
+            # clusters, but no count
+            response = self.get_json(**params)
+        self.assertEqual(response['iTotalRecords'], 1)
+        self.assertEqual(len(response['aaData']), 2)
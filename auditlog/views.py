@@ -14,15 +14,18 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import json
 import datetime
+import hashlib
 
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
 from django.shortcuts import render
-from django.core.urlresolvers import reverse
 from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
 from auditlog.models import AuditEntry
+from ganeti.caching import get_or_fetch
+from ganeti.models import Cluster
+from ganeti.utils import StreamingJsonResponse, cached_reverse
 
 
 @login_required
@@ -42,22 +45,104 @@ def auditlog(request):
     return render(request, 'auditlog/auditlog.html', context)
 
 
+# Number of entries returned per page by default and at most
+AUDITLOG_PAGE_SIZE = 50
+AUDITLOG_MAX_PAGE_SIZE = 1000
+# Seconds the entry counts reported to DataTables are cached for
+AUDITLOG_COUNT_TTL = 60
+
+
+def _int_param(params, name, default):
+    try:
+        return int(params.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _encode_cursor(entry):
+    return "%s_%d" % (entry.last_updated.isoformat(), entry.id)
+
+
+def _decode_cursor(cursor):
+    '''
+    Returns the (last_updated, id) pair of the entry a cursor points to,
+    or None if it is malformed.
+    '''
+    try:
+        last_updated, pk = cursor.rsplit('_', 1)
+        return parse_datetime(last_updated), int(pk)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def _cached_count(queryset, filters):
+    '''
+    Returns the number of entries of a queryset, cached for
+    AUDITLOG_COUNT_TTL seconds under the filters it was built from.
+    '''
+    key = "auditlog:count:%s" % hashlib.md5(repr(filters)).hexdigest()
+    return get_or_fetch(key, queryset.count, AUDITLOG_COUNT_TTL)
+
+
+def _entry_dict(entry):
+    entrydict = {}
+    entrydict['id'] = entry.id
+    entrydict['user'] = entry.requester.username
+    entrydict['user_id'] = entry.requester.id
+    entrydict['user_href'] = "%s" % (
+        cached_reverse(
+            "user-info",
+            kwargs={
+                'type': 'user',
+                'usergroup': entry.requester.username
+            }
+        )
+    )
+    entrydict['job_id'] = entry.job_id
+    entrydict['instance'] = entry.instance
+    entrydict['cluster'] = entry.cluster
+    entrydict['action'] = entry.action
+    entrydict['last_upd'] = "%s" % entry.last_updated
+    entrydict['name_href'] = "%s" % (
+        cached_reverse(
+            "instance-detail",
+            kwargs={
+                'cluster_slug': entry.cluster,
+                'instance': entry.instance,
+            }
+        )
+    )
+    entrydict['is_authorized'] = entry.is_authorized
+    return entrydict
+
+
 @login_required
 def auditlog_json(request):
     '''
-    Shows all the audit entries of the current user or of all
+    Shows the audit entries of the current user or of all
     users in case we are the superuser. There are limits depending on the
     usage of the service and the time it has been up, so there is an extra
     setting "AUDIT_ENTRIES_LAST_X_DAYS" which limits the results (only for
     the superusers).
+
+    The entries are returned a page at a time, newest first unless
+    order=asc is given, and may be filtered by cluster (more than once),
+    instance, user and a search term. Every page carries the cursor of the
+    next one in "next", which is passed back as "cursor" so that deep pages
+    are read through the (requester, last_updated) index instead of being
+    counted through with an offset. DataTables server-side processing
+    parameters are understood as well; the entry counts they need are
+    cached for a while rather than taken on every page.
     '''
+    params = request.GET
+    admin = (
+        request.user.is_superuser or
+        request.user.has_perm('ganeti.view_instances')
+    )
     # age of the log entries that will be shown. We have to store it in order
     # to show it in the template
     days = None
-    if (
-        request.user.is_superuser or
-        request.user.has_perm('ganeti.view_instances')
-    ):
+    if admin:
         days = 0
         al = AuditEntry.objects.all()
         if hasattr(settings, 'AUDIT_ENTRIES_LAST_X_DAYS'):
@@ -66,37 +151,87 @@ def auditlog_json(request):
             al = al.filter(last_updated__gte=datetime.datetime.now() - datetime.timedelta(days=days))
     else:
         al = AuditEntry.objects.filter(requester=request.user)
-    entries = []
-    for entry in al:
-        entrydict = {}
-        entrydict['user'] = entry.requester.username
-        entrydict['user_id'] = entry.requester.id
-        entrydict['user_href'] = "%s" % (
-            reverse(
-                "user-info",
-                kwargs={
-                    'type': 'user',
-                    'usergroup': entry.requester.username
-                }
-            )
+    total = al
+
+    datatables = 'sEcho' in params
+    clusters = params.getlist('cluster')
+    search = params.get('search', '')
+    ascending = params.get('order') == 'asc'
+    length = _int_param(params, 'limit', AUDITLOG_PAGE_SIZE)
+    start = 0
+    if datatables:
+        columns = dict(
+            (params.get('mDataProp_%d' % c), params.get('sSearch_%d' % c, ''))
+            for c in range(_int_param(params, 'iColumns', 0))
         )
-        entrydict['job_id'] = entry.job_id
-        entrydict['instance'] = entry.instance
-        entrydict['cluster'] = entry.cluster
-        entrydict['action'] = entry.action
-        entrydict['last_upd'] = "%s" % entry.last_updated
-        entrydict['name_href'] = "%s" % (
-            reverse(
-                "instance-detail",
-                kwargs={
-                    'cluster_slug': entry.cluster,
-                    'instance': entry.instance,
-                }
-            )
+        # the cluster filter is sent as a regular expression of alternatives
+        clusters = [c for c in columns.get('cluster', '').split('|') if c]
+        search = params.get('sSearch', '')
+        ascending = params.get('sSortDir_0') == 'asc'
+        length = _int_param(params, 'iDisplayLength', AUDITLOG_PAGE_SIZE)
+        start = max(_int_param(params, 'iDisplayStart', 0), 0)
+    if length <= 0 or length > AUDITLOG_MAX_PAGE_SIZE:
+        length = AUDITLOG_MAX_PAGE_SIZE
+
+    if clusters:
+        al = al.filter(cluster__in=clusters)
+    if params.get('instance'):
+        al = al.filter(instance=params['instance'])
+    if admin and params.get('user'):
+        al = al.filter(requester__username=params['user'])
+    if search:
+        query = (
+            Q(instance__icontains=search) |
+            Q(action__icontains=search) |
+            Q(cluster__icontains=search)
         )
-        entrydict['is_authorized'] = entry.is_authorized
-        entries.append(entrydict)
+        if admin:
+            query |= Q(requester__username__icontains=search)
+        al = al.filter(query)
+    filtered = al
+
+    if ascending:
+        al = al.order_by('last_updated', 'id')
+    else:
+        al = al.order_by('-last_updated', '-id')
+    cursor = _decode_cursor(params.get('cursor'))
+    if cursor is not None and cursor[0] is not None:
+        last_updated, pk = cursor
+        if ascending:
+            al = al.filter(
+                Q(last_updated__gt=last_updated) |
+                Q(last_updated=last_updated, id__gt=pk)
+            )
+        else:
+            al = al.filter(
+                Q(last_updated__lt=last_updated) |
+                Q(last_updated=last_updated, id__lt=pk)
+            )
+        start = 0
+    entries = list(
+        al.select_related('requester')[start:start + length + 1]
+    )
     jresp = {}
-    jresp['aaData'] = entries
-    res = jresp
-    return HttpResponse(json.dumps(res), content_type='application/json')
+    jresp['next'] = None
+    if len(entries) > length:
+        entries = entries[:length]
+        jresp['next'] = _encode_cursor(entries[-1])
+    jresp['aaData'] = (_entry_dict(entry) for entry in entries)
+    if datatables:
+        scope = ('all', days) if admin else ('user', request.user.pk)
+        jresp['sEcho'] = _int_param(params, 'sEcho', 0)
+        jresp['iTotalRecords'] = _cached_count(total, scope)
+        if filtered is total:
+            jresp['iTotalDisplayRecords'] = jresp['iTotalRecords']
+        else:
+            jresp['iTotalDisplayRecords'] = _cached_count(filtered, scope + (
+                sorted(clusters),
+                params.get('instance'),
+                params.get('user') if admin else None,
+                search,
+            ))
+        if admin:
+            jresp['clusters'] = list(
+                Cluster.objects.values_list('slug', flat=True)
+            )
+    return StreamingJsonResponse(jresp)
@@ -15,7 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 from apply.models import InstanceApplication, STATUS_PENDING
-from django.core.cache import cache
+from ganeti.caching import cache
 
 
 def notify(request):
@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*- vim:fileencoding=utf-8:
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import re
+import threading
+from time import sleep, time
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache as default_cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import close_old_connections, transaction
+
+# Seconds a fetch may hold the cross-process lock of a key
+FETCH_LOCK_TIMEOUT = getattr(settings, 'CACHE_FETCH_LOCK_TIMEOUT', 30)
+# Seconds between checks while waiting for another process' fetch
+FETCH_WAIT_INTERVAL = 0.2
+# Seconds a value is kept after it turns stale, to be served while it is
+# being refreshed in the background
+STALE_TTL = getattr(settings, 'CACHE_STALE_TTL', 300)
+
+FETCH_COUNTERS = ('issued', 'coalesced', 'stale')
+
+# Families of cache keys that can be invalidated at once. Keys of families
+# with a shard group are registered separately per shard, e.g. per cluster
+# or per user, to keep each registry small.
+KEY_FAMILIES = (
+    # cluster resources along with their freshness markers, not the locks
+    # or the per-user keys kept under the same prefix
+    ('cluster', r'^cluster:(?P<shard>[^:]+):'
+                r'(instances(:snapshot|:changes)?|info|owners|clusterdetails|'
+                r'nodes|listnodes|nodegroups|networks|lockednodegroups:nodes|'
+                r'(instance|node|nodegroup):[^:]+)(:fresh)?$'),
+    ('user', r'^user:(?P<shard>[^:]+)'),
+    ('ajax', r'^(?P<shard>[^:]+):ajax'),
+    ('lists', r'^(allclusternodes|bad(clusters|nodes)|len\w+|'
+              r'operating_systems|pendingapplications|locked_instances)$'),
+)
+# Seconds registry entries outlive the keys they refer to, so that keys
+# refreshed periodically are not registered again on every refresh
+REGISTRY_SLACK = 3600
+# Number of registrations a process remembers before forgetting expired ones
+REGISTRY_MEMO_SIZE = 10000
+
+logger = logging.getLogger(__name__)
+
+
+class NamespacedCache(object):
+    '''
+    Wraps a cache, keeping a registry of the keys stored in each of the
+    KEY_FAMILIES, so that they can be dropped by family and prefix.
+
+    Registries live in the cache itself, as dicts of keys to the time they
+    expire. Each process only writes them for keys it has not registered
+    before or whose registration is about to lapse. They are updated
+    without locking, so concurrent registrations may occasionally be lost;
+    they are meant for administrative invalidation, not for correctness.
+    '''
+
+    def __init__(self, backend, families=KEY_FAMILIES):
+        self._backend = backend
+        self._families = [
+            (name, re.compile(pattern)) for name, pattern in families
+        ]
+        self._registered = {}
+        self._shards = set()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
+
+    def __contains__(self, key):
+        return key in self._backend
+
+    def _registry(self, key):
+        for name, pattern in self._families:
+            match = pattern.match(key)
+            if match:
+                return name, match.groupdict().get('shard')
+        return None
+
+    def _registry_key(self, family, shard=None):
+        if shard is None:
+            return "registry:%s" % family
+        return "registry:%s:%s" % (family, shard)
+
+    def _shards_key(self, family):
+        return "registry-shards:%s" % family
+
+    def _expiry(self, timeout):
+        if timeout is None:
+            return None
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self._backend.default_timeout
+        return time() + timeout + REGISTRY_SLACK
+
+    def _register(self, keys, timeout):
+        expiry = self._expiry(timeout)
+        now = time()
+        pending = {}
+        new_shards = set()
+        with self._lock:
+            if len(self._registered) > REGISTRY_MEMO_SIZE:
+                self._registered = dict(
+                    (key, expires)
+                    for key, expires in self._registered.items()
+                    if expires is None or expires > now
+                )
+            for key in keys:
+                registry = self._registry(key)
+                if registry is None:
+                    continue
+                registered = self._registered.get(key, 0)
+                if registered is None or (
+                    expiry is not None and
+                    registered >= expiry - REGISTRY_SLACK
+                ):
+                    continue
+                self._registered[key] = expiry
+                pending.setdefault(registry, {})[key] = expiry
+                if registry[1] is not None and registry not in self._shards:
+                    self._shards.add(registry)
+                    new_shards.add(registry)
+
+        for (family, shard), entries in pending.items():
+            registry_key = self._registry_key(family, shard)
+            registry = self._backend.get(registry_key) or {}
+            registry = dict(
+                (key, expires) for key, expires in registry.items()
+                if expires is None or expires > now
+            )
+            registry.update(entries)
+            self._backend.set(registry_key, registry, None)
+        for family, shard in new_shards:
+            shards = self._backend.get(self._shards_key(family)) or set()
+            if shard not in shards:
+                shards.add(shard)
+                self._backend.set(self._shards_key(family), shards, None)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, *args, **kwargs):
+        self._backend.set(key, value, timeout, *args, **kwargs)
+        self._register([key], timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, *args, **kwargs):
+        added = self._backend.add(key, value, timeout, *args, **kwargs)
+        if added:
+            self._register([key], timeout)
+        return added
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, *args, **kwargs):
+        result = self._backend.set_many(data, timeout, *args, **kwargs)
+        self._register(data.keys(), timeout)
+        return result
+
+    def invalidate(self, family, shard=None, prefix=''):
+        '''
+        Drops the keys of a family, or of one of its shards, that start with
+        prefix. Returns the number of entries that were actually cached.
+        '''
+        if shard is not None:
+            registry_keys = [self._registry_key(family, shard)]
+        else:
+            shards = self._backend.get(self._shards_key(family)) or set()
+            registry_keys = [self._registry_key(family)] + [
+                self._registry_key(family, s) for s in shards
+            ]
+        keys = []
+        for registry in self._backend.get_many(registry_keys).values():
+            keys.extend(key for key in registry if key.startswith(prefix))
+        if not keys:
+            return 0
+        dropped = len(self._backend.get_many(keys))
+        self._backend.delete_many(keys)
+        return dropped
+
+
+cache = NamespacedCache(default_cache)
+
+# fetches in flight in this process, by cache key
+_flights = {}
+# process-local copies of hot values, by cache key, as (version, value)
+_local = {}
+_flights_lock = threading.Lock()
+_local_stats = dict.fromkeys(FETCH_COUNTERS, 0)
+
+
+class _Flight(object):
+    '''A fetch in progress that other callers can wait for'''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def _count(counter):
+    _local_stats[counter] += 1
+    key = "stats:fetches:%s" % counter
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def fetch_stats():
+    '''
+    Returns the number of fetches issued and of the ones avoided by
+    coalescing, for this process and for all processes sharing the cache.
+    '''
+    shared = cache.get_many(
+        ["stats:fetches:%s" % counter for counter in FETCH_COUNTERS]
+    )
+    return {
+        'local': dict(_local_stats),
+        'shared': dict(
+            (counter, shared.get("stats:fetches:%s" % counter, 0))
+            for counter in FETCH_COUNTERS
+        ),
+    }
+
+
+def _fresh_key(key):
+    return "%s:fresh" % key
+
+
+def store(key, value, timeout):
+    '''
+    Caches value under key. The value is fresh for timeout seconds and is
+    kept for STALE_TTL seconds more, during which get_or_fetch may serve it
+    while fetching a fresh one.
+
+    Every value stored gets a new version, kept in its freshness marker, so
+    that processes holding a local copy can tell whether it is current.
+    '''
+    version = _set(key, value, timeout)
+    if key in _local:
+        _local[key] = (version, value)
+
+
+def _set(key, value, timeout):
+    version = uuid4().hex
+    cache.set(key, value, timeout + STALE_TTL)
+    cache.set(_fresh_key(key), version, timeout)
+    return version
+
+
+def _store(key, value, timeout):
+    if timeout is not None:
+        store(key, value, timeout)
+
+
+def _revalidate(key, fetch, timeout):
+    lock_key = "%s:lock" % key
+    if not cache.add(lock_key, 1, FETCH_LOCK_TIMEOUT):
+        # already being refreshed
+        return
+
+    def _refresh():
+        try:
+            _count('issued')
+            _store(key, fetch(), timeout)
+        except Exception as err:
+            logger.warning("Refreshing %s failed: %s", key, err)
+        finally:
+            cache.delete(lock_key)
+            close_old_connections()
+
+    # Under gevent's monkey patching this is a greenlet
+    refresher = threading.Thread(target=_refresh)
+    refresher.daemon = True
+    refresher.start()
+
+
+def _fetch_locked(key, fetch, timeout):
+    lock_key = "%s:lock" % key
+    if cache.add(lock_key, 1, FETCH_LOCK_TIMEOUT):
+        try:
+            _count('issued')
+            value = fetch()
+            _store(key, value, timeout)
+            return value
+        finally:
+            cache.delete(lock_key)
+
+    # Another process is fetching the same key, wait for its result
+    deadline = time() + FETCH_LOCK_TIMEOUT
+    while time() < deadline:
+        sleep(FETCH_WAIT_INTERVAL)
+        cached = cache.get_many([key, _fresh_key(key)])
+        if _fresh_key(key) in cached and key in cached:
+            _count('coalesced')
+            return cached[key]
+        if cache.get(lock_key) is None:
+            # the fetch failed, or its result is already gone
+            break
+    _count('issued')
+    value = fetch()
+    _store(key, value, timeout)
+    return value
+
+
+def get_or_fetch(key, fetch, timeout=None, stale=False, local=False):
+    '''
+    Returns the value cached under key, calling fetch() on a miss.
+
+    Concurrent misses on the same key result in a single call to fetch():
+    callers in the same process wait for the fetch in flight, while other
+    processes wait on a lock kept in the cache until the value shows up.
+
+    If timeout is given, the value returned by fetch() is cached for that
+    many seconds, otherwise fetch() is expected to cache it itself using
+    store().
+
+    With stale set, a value that is no longer fresh is returned right away
+    and refreshed in the background, instead of being treated as a miss.
+
+    With local set, the value is also kept in this process and is only
+    fetched from the cache again once a newer version has been stored.
+    Such values are shared by all callers and must not be modified.
+    '''
+    entry = _local.get(key) if local else None
+    if entry is not None:
+        if cache.get(_fresh_key(key)) == entry[0]:
+            return entry[1]
+
+    cached = cache.get_many([key, _fresh_key(key)])
+    value = cached.get(key)
+    if value is not None:
+        if _fresh_key(key) in cached:
+            if local:
+                _local[key] = (cached[_fresh_key(key)], value)
+            return value
+        if stale:
+            _count('stale')
+            _revalidate(key, fetch, timeout)
+            return value
+
+    _flights_lock.acquire()
+    try:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+    finally:
+        _flights_lock.release()
+
+    if not leader:
+        _count('coalesced')
+        return flight.wait()
+
+    try:
+        flight.value = _fetch_locked(key, fetch, timeout)
+    except Exception as err:
+        flight.error = err
+        raise
+    finally:
+        _flights_lock.acquire()
+        try:
+            del _flights[key]
+        finally:
+            _flights_lock.release()
+        flight.done.set()
+    return flight.value
+
+
+def _generation_key(scope):
+    return "generation:%s" % scope
+
+
+def generation(*scopes):
+    '''
+    Returns a token made of the current generations of the given scopes,
+    to be included in the keys of cache entries that depend on them.
+    '''
+    return ".".join(str(current) for current in _generations(scopes))
+
+
+def _generations(scopes):
+    keys = [_generation_key(scope) for scope in scopes]
+    current = cache.get_many(keys)
+    for key in keys:
+        if key not in current:
+            # Start from a timestamp, so that generations never go back
+            # to a value used before the counter was evicted
+            cache.add(key, int(time() * 1000), None)
+            current[key] = cache.get(key)
+    return [current[key] for key in keys]
+
+
+def bump_generation(*scopes):
+    '''
+    Invalidates every cache entry whose key includes the generation of any
+    of the given scopes.
+    '''
+    for scope in scopes:
+        key = _generation_key(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, int(time() * 1000), None)
+
+
+# Seconds a lookup table is kept before being rebuilt from scratch, in case
+# some change bypassed the signals that maintain it
+LOOKUP_TTL = getattr(settings, 'LOOKUP_TABLE_TTL', 300)
+
+
+class LookupTable(object):
+    '''
+    A dict kept in the cache and maintained row by row, instead of being
+    rebuilt from the database whenever it expires.
+
+    build() returns the whole table. load(pk) returns the entries of a
+    single row, or an empty dict if the row no longer exists, and owner()
+    maps an entry back to the primary key of its row. Tables without load
+    are rebuilt on any change. Every change, and every rebuild of the
+    table once it expires, bumps the table's version.
+
+    Changes are applied once the transaction making them commits. A change
+    made while the table is being built or updated elsewhere marks the
+    table dirty, and the table is dropped once stored instead of being
+    kept with the change missing.
+
+    Tables are stored without the local copy store() keeps, since
+    get_lookup_tables keeps its own, checked against the table's version.
+    '''
+
+    def __init__(self, name, build, load=None, owner=None):
+        self.name = name
+        self.key = "lookup:%s" % name
+        self._build = build
+        self._load = load
+        self._owner = owner or (lambda value: value.pk)
+
+    def version(self):
+        return generation(self.key)
+
+    def get(self):
+        return get_or_fetch(self.key, self._rebuild)
+
+    def _rebuild(self):
+        table = self._build()
+        self._store(table)
+        return table
+
+    def _store(self, table):
+        # called with the lock of the table held
+        _set(self.key, table, LOOKUP_TTL)
+        dirty_key = "%s:dirty" % self.key
+        if cache.get(dirty_key) is not None:
+            # the table changed while it was being read
+            cache.delete_many([dirty_key, self.key])
+        # processes holding a copy of the previous table must drop it
+        bump_generation(self.key)
+
+    def invalidate(self):
+        transaction.on_commit(self._invalidate)
+
+    def _invalidate(self):
+        if cache.get("%s:lock" % self.key) is not None:
+            # whoever holds the lock may store a table read before now
+            cache.set("%s:dirty" % self.key, 1, FETCH_LOCK_TIMEOUT)
+        cache.delete(self.key)
+        bump_generation(self.key)
+
+    def update(self, pks):
+        '''
+        Refreshes the entries of the rows with the given primary keys, once
+        the current transaction commits.
+
+        Only those rows are loaded from the database, but the table is a
+        single cache value, so it is still scanned and stored as a whole.
+        '''
+        pks = set(pks)
+        transaction.on_commit(lambda: self._update(pks))
+
+    def _update(self, pks):
+        lock_key = "%s:lock" % self.key
+        if self._load is None or not cache.add(lock_key, 1, FETCH_LOCK_TIMEOUT):
+            # Someone else is building or updating the table
+            self._invalidate()
+            return
+        try:
+            table = cache.get(self.key)
+            if table is None:
+                bump_generation(self.key)
+                return
+            table = dict(
+                (key, value) for key, value in table.items()
+                if self._owner(value) not in pks
+            )
+            for pk in pks:
+                table.update(self._load(pk))
+            self._store(table)
+        finally:
+            cache.delete(lock_key)
+
+
+def get_lookup_tables(tables):
+    '''
+    Returns the contents of the given lookup tables, by name.
+
+    Tables are kept in this process and only fetched again from the cache
+    when their version changes; the versions of all tables are checked in
+    a single round trip, as are the tables that need to be fetched. The
+    returned tables are shared by all callers and must not be modified.
+    '''
+    versions = _generations([table.key for table in tables])
+    result = {}
+    outdated = []
+    for table, version in zip(tables, versions):
+        entry = _local.get(table.key)
+        if entry is not None and entry[0] == version:
+            result[table.name] = entry[1]
+        else:
+            outdated.append((table, version))
+    if not outdated:
+        return result
+
+    keys = []
+    for table, version in outdated:
+        keys.extend([table.key, _fresh_key(table.key)])
+    cached = cache.get_many(keys)
+    for table, version in outdated:
+        if table.key in cached and _fresh_key(table.key) in cached:
+            value = cached[table.key]
+        else:
+            value = table.get()
+        # Versions are bumped after the tables are updated, so a table
+        # fetched after reading its version is at least as recent
+        _local[table.key] = (version, value)
+        result[table.name] = value
+    return result
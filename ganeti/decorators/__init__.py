@@ -1,4 +1,4 @@
-from django.core.cache import cache
+from ganeti.caching import cache
 from django.shortcuts import get_object_or_404
 from django.template.loader import get_template
 from django.http import HttpResponseForbidden, HttpResponseBadRequest
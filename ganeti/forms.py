@@ -80,9 +80,7 @@ class InstanceRenameForm(forms.Form):
                                                     " qualified, e.g. <em>host"
                                                     ".domain.com</em>, not"
                                                     " <em>host</em>")))
-        existing_instances = Instance.objects.all()
-        names = [i.name for i in existing_instances]
-        if hostname in names:
+        if Instance.objects.filter(name=hostname):
             raise forms.ValidationError(_("Hostname already exists."))
         return hostname
 
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*- vim:fileencoding=utf-8:
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+from time import time
+
+from gevent import sleep, spawn
+from gevent.event import AsyncResult
+
+from django.conf import settings
+
+from ganeti.models import JOB_STATUS_FIELDS, parseQuery
+from util.client import SendMany
+
+# Seconds between two polls of the same job, the last one repeating
+POLL_INTERVALS = [0.5, 1, 1, 2, 2, 2, 5]
+
+logger = logging.getLogger('watcher')
+
+
+def next_poll_interval():
+    for t in POLL_INTERVALS:
+        yield t
+
+    while True:
+        yield POLL_INTERVALS[-1]
+
+
+class JobWatch(object):
+    '''A job waited for, along with its poll schedule'''
+
+    def __init__(self, cluster, job_id):
+        self.cluster = cluster
+        self.job_id = job_id
+        self.result = AsyncResult()
+        self.intervals = next_poll_interval()
+        self.due = time()
+        self.waiters = 0
+        self.greenlet = None
+
+
+class JobPoller(object):
+    '''
+    Polls the status of the Ganeti jobs handlers wait for.
+
+    Outstanding jobs are grouped by cluster, so that each tick costs a
+    single RAPI job query per cluster that has jobs due, no matter how
+    many jobs are pending. Handlers register the jobs they wait for with
+    watch() and block on the returned result, which is set to the status
+    of the job once it ends.
+    '''
+
+    def __init__(self, tick=POLL_INTERVALS[0], timeout=None):
+        self.tick = tick
+        self.timeout = timeout or settings.RAPI_RESPONSE_TIMEOUT
+        self.watches = {}
+
+    def watch(self, cluster, job_id):
+        '''
+        Starts polling a job, if not polled already. Returns a
+        gevent.event.AsyncResult set to the status of the job once it ends.
+        '''
+        key = (cluster.slug, int(job_id))
+        watch = self.watches.get(key)
+        if watch is None:
+            watch = self.watches[key] = JobWatch(cluster, int(job_id))
+        watch.waiters += 1
+        return watch.result
+
+    def forget(self, cluster, job_id):
+        '''Stops polling a job once none of its handlers waits for it'''
+        key = (cluster.slug, int(job_id))
+        watch = self.watches.get(key)
+        if watch is None:
+            return
+        watch.waiters -= 1
+        if watch.waiters <= 0:
+            del self.watches[key]
+
+    def due(self, now):
+        '''
+        Returns the pending jobs of each cluster that has jobs due, so that
+        jobs not due yet ride along with the ones that are.
+        '''
+        batches = {}
+        due = set()
+        for watch in self.watches.values():
+            if watch.result.ready():
+                continue
+            slug = watch.cluster.slug
+            batches.setdefault(slug, []).append(watch)
+            if watch.due <= now:
+                due.add(slug)
+        return [batches[slug] for slug in due]
+
+    def poll(self):
+        '''Polls the jobs due once, setting the results of the ended ones'''
+        now = time()
+        batches = self.due(now)
+        if not batches:
+            return
+        responses = SendMany(
+            [
+                batch[0].cluster.job_status_request(
+                    [watch.job_id for watch in batch]
+                ) for batch in batches
+            ],
+            timeout=self.timeout
+        )
+        for batch, response in zip(batches, responses):
+            statuses = {}
+            if isinstance(response, Exception):
+                logger.warn("Error polling jobs of cluster %s: %s" %
+                            (batch[0].cluster.slug, response))
+            else:
+                try:
+                    statuses = dict(
+                        (status['id'], status)
+                        for status in parseQuery(response)
+                    )
+                except Exception as err:
+                    logger.warn("Malformed job status from cluster %s: %s" %
+                                (batch[0].cluster.slug, err))
+            for watch in batch:
+                status = statuses.get(watch.job_id)
+                if status is not None and status['end_ts']:
+                    watch.result.set(status)
+                elif watch.due <= now:
+                    watch.due = now + watch.intervals.next()
+
+    def run(self):
+        '''Polls the jobs waited for forever'''
+        while True:
+            try:
+                self.poll()
+            except Exception as err:
+                logger.error("Error polling jobs: %s" % err)
+            sleep(self.tick)
+
+
+class JobWaiter(JobPoller):
+    '''
+    Tracks the Ganeti jobs handlers wait for through RAPI's job change
+    notifications instead of polling them.
+
+    Every job has a WaitForJobChange request pending on its cluster, which
+    RAPI answers as soon as the job changes, so jobs are seen to end
+    without delay and cost a request per change rather than per poll.
+    '''
+
+    def watch(self, cluster, job_id):
+        key = (cluster.slug, int(job_id))
+        result = JobPoller.watch(self, cluster, job_id)
+        watch = self.watches[key]
+        if watch.greenlet is None:
+            watch.greenlet = spawn(self.wait, watch)
+        return result
+
+    def forget(self, cluster, job_id):
+        key = (cluster.slug, int(job_id))
+        watch = self.watches.get(key)
+        JobPoller.forget(self, cluster, job_id)
+        if watch is not None and key not in self.watches:
+            watch.greenlet.kill(block=False)
+
+    def wait(self, watch):
+        '''Waits for a job to change until it ends'''
+        job_info = None
+        log_serial = None
+        while not watch.result.ready():
+            response = SendMany(
+                [watch.cluster.job_change_request(
+                    watch.job_id, job_info, log_serial
+                )],
+                timeout=self.timeout
+            )[0]
+            if isinstance(response, Exception):
+                logger.warn("Error waiting for job %d of cluster %s: %s" %
+                            (watch.job_id, watch.cluster.slug, response))
+                sleep(watch.intervals.next())
+                continue
+            if not response:
+                # RAPI gave up waiting before the job changed
+                continue
+            job_info = response['job_info']
+            for entry in response['log_entries']:
+                log_serial = max(log_serial, entry[0])
+            status = dict(zip(JOB_STATUS_FIELDS, job_info))
+            if status['end_ts']:
+                watch.result.set(status)
+
+    def run(self):
+        '''Nothing to poll, jobs are waited for as soon as watched'''
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*- vim:fileencoding=utf-8:
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import logging
+from threading import Lock
+from time import time
+
+import beanstalkc
+
+from django.conf import settings
+from django.db import transaction
+
+BEANSTALK_TUBE = getattr(settings, 'BEANSTALK_TUBE', None)
+# Idle connections to beanstalkd kept open by each process
+BEANSTALK_POOL_SIZE = getattr(settings, 'BEANSTALK_POOL_SIZE', 4)
+# Seconds to wait for beanstalkd to accept a connection
+BEANSTALK_CONNECT_TIMEOUT = getattr(settings, 'BEANSTALK_CONNECT_TIMEOUT', 1)
+# Seconds a connection may stay idle before it is checked on reuse
+BEANSTALK_CHECK_INTERVAL = 30
+# Seconds during which beanstalkd is not tried again after it failed
+BEANSTALK_RETRY_INTERVAL = 10
+
+logger = logging.getLogger(__name__)
+
+
+class ProducerPool(object):
+    '''
+    Keeps connections to beanstalkd open for putting messages, so that
+    requests do not pay for setting one up.
+
+    Connections idle for a while are checked before they are reused. Once
+    connecting fails, beanstalkd is not tried again for a few seconds, so
+    that requests do not wait for connections bound to fail.
+    '''
+
+    def __init__(self, size=BEANSTALK_POOL_SIZE, tube=BEANSTALK_TUBE):
+        self.size = size
+        self.tube = tube
+        # (connection, time of last use) pairs, the most recent last
+        self.idle = []
+        self.lock = Lock()
+        self.down_until = 0
+
+    def connect(self):
+        connection = beanstalkc.Connection(
+            connect_timeout=BEANSTALK_CONNECT_TIMEOUT
+        )
+        if self.tube:
+            connection.use(self.tube)
+        return connection
+
+    @staticmethod
+    def discard(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        '''
+        Returns an open connection, or None if beanstalkd is unreachable.
+        '''
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                connection, used = self.idle.pop()
+            if time() - used < BEANSTALK_CHECK_INTERVAL:
+                return connection
+            try:
+                connection.using()
+                return connection
+            except Exception:
+                self.discard(connection)
+
+        if time() < self.down_until:
+            return None
+        try:
+            return self.connect()
+        except Exception as err:
+            logger.warning("Unable to connect to beanstalkd: %s" % err)
+            self.down_until = time() + BEANSTALK_RETRY_INTERVAL
+            return None
+
+    def release(self, connection):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((connection, time()))
+                return
+        self.discard(connection)
+
+    def put(self, body):
+        '''Puts a message to beanstalkd. Returns False if it could not.'''
+        # a pooled connection may have been closed by beanstalkd, in which
+        # case the message is put through another one
+        for attempt in range(2):
+            connection = self.acquire()
+            if connection is None:
+                return False
+            try:
+                connection.put(body)
+            except Exception as err:
+                logger.warning("Unable to put to beanstalkd: %s" % err)
+                self.discard(connection)
+                continue
+            self.release(connection)
+            return True
+        return False
+
+
+_pool = ProducerPool()
+
+
+def enqueue(message):
+    '''
+    Queues a message for the watcher. When beanstalkd is unreachable the
+    message is kept in the outbox, for the watcher to move to beanstalkd
+    with flush_outbox once it is back.
+    '''
+    body = json.dumps(message)
+    if not _pool.put(body):
+        # ganeti.models imports this module
+        from ganeti.models import QueuedJob
+        QueuedJob.objects.create(body=body)
+
+
+def flush_outbox(limit=100):
+    '''
+    Moves the messages kept in the outbox to beanstalkd, oldest first.
+    Returns the number of messages moved.
+    '''
+    from ganeti.models import QueuedJob
+    moved = 0
+    # the rows stay locked until they are deleted, so that other watchers
+    # flushing as well do not put the same messages
+    with transaction.atomic():
+        queued = QueuedJob.objects.select_for_update().order_by('pk')
+        for job in queued[:limit]:
+            if not _pool.put(job.body):
+                break
+            job.delete()
+            moved += 1
+    return moved
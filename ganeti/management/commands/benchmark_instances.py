@@ -0,0 +1,104 @@
+import gc
+import resource
+from time import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from ganeti.models import Instance, get_tag_classifier
+
+
+def memory_usage():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # peak usage, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def instance_row(i):
+    prefix = settings.GANETI_TAG_PREFIX
+    return {
+        'name': 'instance%d.example.com' % i,
+        'tags': [
+            '%s:user:user%d' % (prefix, i % 1000),
+            '%s:group:group%d' % (prefix, i % 100),
+            '%s:service:web' % prefix,
+            'custom:tag',
+        ],
+        'pnode': 'node%d.example.com' % (i % 50),
+        'snodes': ['node%d.example.com' % ((i + 1) % 50)],
+        'disk.sizes': [20480],
+        'nic.modes': ['routed', 'bridged'],
+        'nic.ips': ['10.0.%d.%d' % (i / 256 % 256, i % 256), None],
+        'nic.links': ['rt1', 'br1'],
+        'nic.macs': ['aa:00:00:%02x:%02x:%02x' % (
+            i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff
+        ), 'aa:00:01:00:00:00'],
+        'status': 'running',
+        'admin_state': 'up',
+        'oper_state': True,
+        'beparams': {'maxmem': 2048, 'minmem': 2048, 'vcpus': 2},
+        'hvparams': {'kernel_path': ''},
+        'ctime': 1400000000.0 + i,
+        'mtime': 1400000000.0 + i,
+    }
+
+
+class Command(BaseCommand):
+    help = ("Measures the construction time and memory of Instance objects"
+            " for a synthetic fleet")
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument(
+            "--instances", type=int, dest="instances", default=50000,
+            help="Number of instances to build (default: 50000)"
+        )
+
+    def handle(self, *args, **options):
+        count = options.get("instances")
+        cached_data = {
+            'users': {},
+            'groups': {},
+            'orgs': {},
+            'instanceapps': {},
+            'networks': {'rt1': '2001:db8:1::/64'},
+        }
+        # rows are classified when the instance cache is refreshed
+        classifier = get_tag_classifier()
+        rows = [instance_row(i) for i in range(count)]
+        for row in rows:
+            classifier.classify_row(row)
+
+        gc.collect()
+        before = memory_usage()
+        start = time()
+        instances = [
+            Instance(None, row['name'], row, cached_data) for row in rows
+        ]
+        built = time() - start
+        gc.collect()
+        used = memory_usage() - before
+
+        start = time()
+        for instance in instances:
+            instance.users
+            instance.groups
+            instance.services
+            instance.nic_ips
+            instance.ipv6s
+            instance.admin_state
+        derived = time() - start
+        gc.collect()
+        derived_used = memory_usage() - before - used
+
+        self.stdout.write("instances:          %d" % count)
+        self.stdout.write("construction:       %.3fs (%.2fus/instance)" %
+                          (built, built * 1e6 / count))
+        self.stdout.write("memory:             %.1fMB (%d bytes/instance)" %
+                          (used / 1048576.0, used / count))
+        self.stdout.write("derived attributes: %.3fs (%.2fus/instance)" %
+                          (derived, derived * 1e6 / count))
+        self.stdout.write("derived memory:     %.1fMB (%d bytes/instance)" %
+                          (derived_used / 1048576.0, derived_used / count))
@@ -0,0 +1,65 @@
+from time import time
+
+from django.core.management.base import BaseCommand
+from django.core.urlresolvers import reverse
+from ganeti.utils import cached_reverse
+
+
+# The routes generated for every row of the instance, graph and audit log
+# listings
+ROUTES = (
+    ('instance-detail', None, {
+        'cluster_slug': 'cluster%d', 'instance': 'instance%d.example.com'
+    }),
+    ('user-info', None, {'type': 'user', 'usergroup': 'user%d'}),
+    ('user-info', None, {'type': 'group', 'usergroup': 'group%d'}),
+    ('graph', ('cluster%d', 'instance%d.example.com', 'cpu-ts'), None),
+)
+
+
+def route_params(args, kwargs, i):
+    if args:
+        args = tuple(arg.replace('%d', str(i)) for arg in args)
+    if kwargs:
+        kwargs = dict(
+            (key, value.replace('%d', str(i)))
+            for (key, value) in kwargs.iteritems()
+        )
+    return args, kwargs
+
+
+class Command(BaseCommand):
+    help = ("Compares the time reverse and cached_reverse take to generate"
+            " the links of the listings")
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument(
+            "--rows", type=int, dest="rows", default=50000,
+            help="Number of rows to generate links for (default: 50000)"
+        )
+
+    def handle(self, *args, **options):
+        rows = options.get("rows")
+        params = [
+            (name, route_params(route_args, route_kwargs, i))
+            for i in range(rows)
+            for (name, route_args, route_kwargs) in ROUTES
+        ]
+        for (name, (route_args, route_kwargs)) in params[:len(ROUTES)]:
+            expected = reverse(name, args=route_args, kwargs=route_kwargs)
+            found = cached_reverse(name, args=route_args, kwargs=route_kwargs)
+            if expected != found:
+                self.stderr.write("%s: %s != %s" % (name, found, expected))
+
+        self.stdout.write("rows:           %d (%d links)" %
+                          (rows, len(params)))
+        for (label, function) in (
+            ("reverse:", reverse), ("cached_reverse:", cached_reverse)
+        ):
+            start = time()
+            for (name, (route_args, route_kwargs)) in params:
+                function(name, args=route_args, kwargs=route_kwargs)
+            elapsed = time() - start
+            self.stdout.write("%-15s %.3fs (%.2fus/link)" %
+                              (label, elapsed, elapsed * 1e6 / len(params)))
@@ -1,7 +1,7 @@
 import sys
 import logging
 from django.core.management.base import BaseCommand
-from ganeti.models import Cluster
+from ganeti.warmer import CacheWarmer, WARM_INTERVAL, WARM_TTL
 
 
 logger = logging.getLogger('refresh_logger')
@@ -14,31 +14,27 @@ class Command(BaseCommand):
     def add_arguments(parser):
         parser.add_argument("clusters", nargs="*")
         parser.add_argument("seconds", nargs="?", type=int)
-
-    @staticmethod
-    def fetch_clusters(cluster_hostnames=None):
-        if not cluster_hostnames:
-            return Cluster.objects.all()
-        return Cluster.objects.filter(hostname__in=cluster_hostnames)
-
-    @staticmethod
-    def refresh(cluster, seconds):
-        if seconds:
-            cluster.refresh_instances(seconds=seconds)
-            cluster.refresh_nodes(seconds=seconds)
-        else:
-            cluster.refresh_instances()
-            cluster.refresh_nodes()
+        parser.add_argument(
+            "--loop", action="store_true", dest="loop",
+            help="Keep refreshing the clusters instead of exiting"
+        )
+        parser.add_argument(
+            "--interval", type=int, dest="interval", default=WARM_INTERVAL,
+            help="Seconds between refreshes of a cluster, with --loop"
+                 " (default: %d)" % WARM_INTERVAL
+        )
 
     def handle(self, *args, **options):
-        exit_code = 0
-        for cluster in self.fetch_clusters(options.get("clusters")):
-            print("Refreshing cache for cluster: {0}".format(cluster))
-            try:
-                self.refresh(cluster, options.get("seconds"))
-            except Exception as err:
-                logger.info("Error while refreshing cache for cluster {0}: {1}"
-                            .format(cluster, err))
-                exit_code = 1
-
-        sys.exit(exit_code)
+        warmer = CacheWarmer(
+            clusters=options.get("clusters"),
+            interval=options.get("interval"),
+            seconds=options.get("seconds") or WARM_TTL,
+        )
+        if options.get("loop"):
+            warmer.run()
+
+        failed = warmer.run_once()
+        for cluster in failed:
+            logger.info("Error while refreshing cache for cluster {0}"
+                        .format(cluster))
+        sys.exit(1 if failed else 0)
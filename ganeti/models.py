@@ -18,17 +18,22 @@ import re
 import random
 import hashlib
 import base64
+import json
 import os
 import ipaddr
 from datetime import datetime, timedelta
 from gevent.pool import Pool
 from socket import gethostbyname
-from time import sleep
-from django.db import models
-from django.db.models.signals import pre_save
+from time import sleep, time
+from django.db import close_old_connections, models
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_save,
+)
 from django.dispatch import receiver
 from django.http import Http404
-from django.core.cache import cache
 from django.contrib.auth.models import User, Group
 from django.contrib.sites.models import Site
 from django.template.loader import render_to_string
@@ -36,7 +41,25 @@ from django.utils.translation import ugettext_lazy as _
 from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
 from django.conf import settings
 from util import vapclient
-from util.client import GanetiRapiClient, GanetiApiError, GenericCurlConfig
+from ganeti.caching import (
+    FETCH_LOCK_TIMEOUT,
+    FETCH_WAIT_INTERVAL,
+    LookupTable,
+    bump_generation,
+    cache,
+    get_lookup_tables,
+    get_or_fetch,
+    store,
+)
+from ganeti.jobqueue import enqueue
+from util.client import (
+    GanetiRapiClient,
+    GanetiApiError,
+    GenericCurlConfig,
+    GANETI_RAPI_VERSION,
+    HTTP_GET,
+    HTTP_PUT,
+)
 from apply.models import Organization, InstanceApplication
 from distutils.version import LooseVersion
 
@@ -55,16 +78,153 @@ RAPI_RESPONSE_TIMEOUT = settings.RAPI_RESPONSE_TIMEOUT
 
 SHA1_RE = re.compile('^[a-f0-9]{40}$')
 
-if hasattr(settings, 'BEANSTALK_TUBE'):
-    BEANSTALK_TUBE = settings.BEANSTALK_TUBE
-else:
-    BEANSTALK_TUBE = None
-
-import beanstalkc
+# Fields cached for every instance of a cluster
+INSTANCE_FIELDS = [
+    'name',
+    'tags',
+    'pnode',
+    'snodes',
+    'disk.sizes',
+    'nic.modes',
+    'nic.ips',
+    'nic.links',
+    'status',
+    'admin_state',
+    'beparams',
+    'oper_state',
+    'hvparams',
+    'nic.macs',
+    'ctime',
+    'mtime'
+]
+# Fields fetched for every instance on a delta refresh. Runtime state does
+# not touch the instance mtime, so it is always refreshed.
+INSTANCE_DELTA_FIELDS = ['name', 'mtime', 'oper_state', 'status']
+
+# Fields polled for the status of instances
+INSTANCE_STATUS_FIELDS = ['name', 'status', 'admin_state', 'oper_state', 'pnode']
+
+# Fields of the cached nodes of a cluster
+NODE_FIELDS = [
+    'name',
+    'role',
+    'mfree',
+    'mtotal',
+    'dtotal',
+    'dfree',
+    'ctotal',
+    'group',
+    'pinst_cnt',
+    'offline',
+    'vm_capable',
+    'pinst_list'
+]
+
+# Fields polled for the status of jobs, as returned by GetJobStatus
+JOB_STATUS_FIELDS = ['id', 'status', 'end_ts', 'opstatus', 'opresult']
+
+# Refresh instances incrementally, re-fetching only new or modified ones
+INSTANCE_DELTA_REFRESH = getattr(settings, 'INSTANCE_DELTA_REFRESH', True)
+# Seconds after which a delta refresh falls back to a full one
+INSTANCE_FULL_REFRESH_INTERVAL = getattr(
+    settings, 'INSTANCE_FULL_REFRESH_INTERVAL', 3600
+)
+# Seconds the cluster of an instance is remembered. Entries are rewritten
+# on every full refresh and verified on use.
+INSTANCE_DIRECTORY_TTL = 2 * INSTANCE_FULL_REFRESH_INTERVAL
+# Seconds an instance found on no cluster is remembered as missing. New
+# instances are recorded in the directory when the cache is refreshed.
+INSTANCE_DIRECTORY_MISS_TTL = 30
+# Number of refreshes whose changed instances are remembered, for clients
+# to catch up with
+INSTANCE_CHANGELOG_SIZE = 30
+
+# Resources summed up per owner of the instances of a cluster
+OWNER_TOTAL_FIELDS = ('instances', 'cpu', 'memory', 'disk')
+
+# RAPI clients are shared by all Cluster objects pointing to the same
+# endpoint, so that their pooled cURL handles (and the connections kept alive
+# by them) survive across requests. Maps hostnames to the credentials and
+# the client.
+_rapi_clients = {}
+# Cached instances of each cluster by name and their positions in the
+# instance list, along with the instance list they were built from
+_instance_rows = {}
+
+
+def instance_directory_key(name):
+    return "directory:instance:%s" % name
+
+
+def instance_row_totals(info):
+    '''
+    Returns the resources of an instance row, in the form of the totals
+    of its owners.
+    '''
+    beparams = info.get('beparams') or {}
+    return {
+        'instances': 1,
+        'cpu': beparams.get('vcpus', 0),
+        'memory': beparams.get('maxmem', 0),
+        'disk': sum(info.get('disk.sizes') or ()),
+    }
+
+
+def add_owner_totals(totals, owner, resources):
+    current = totals.get(owner)
+    if current is None:
+        totals[owner] = dict(resources)
+    else:
+        for field in OWNER_TOTAL_FIELDS:
+            current[field] += resources[field]
+
+
+def instance_row_version(info):
+    '''
+    Returns a token that changes whenever the cached row of an instance
+    does: configuration changes update its mtime, while its runtime state
+    is checked separately.
+    '''
+    return "%s-%s-%s-%s" % (
+        info.get('mtime'),
+        info.get('status'),
+        info.get('oper_state'),
+        info.get('admin_state'),
+    )
 
-import json
 
-from django.db import close_old_connections
+def get_rapi_client(hostname, username=None, password=None):
+    credentials = (username, password)
+    entry = _rapi_clients.get(hostname)
+    if entry is not None and entry[0] == credentials:
+        return entry[1]
+    curl_conf = GenericCurlConfig(
+        connect_timeout=RAPI_CONNECT_TIMEOUT,
+        timeout=RAPI_RESPONSE_TIMEOUT
+    )
+    client = GanetiRapiClient(
+        host=hostname,
+        username=username,
+        password=password,
+        curl_config_fn=curl_conf
+    )
+    _rapi_clients[hostname] = (credentials, client)
+    if entry is not None:
+        # the credentials changed, so the connections of the old client
+        # are of no use any more
+        entry[1].Close()
+    return client
+
+
+def rapi_connection_stats():
+    '''
+    Returns the counters of the pooled cURL handles of the RAPI clients of
+    this process, by cluster hostname.
+    '''
+    return dict(
+        (hostname, client.GetCurlPoolStats())
+        for hostname, (_, client) in _rapi_clients.items()
+    )
 
 
 class InstanceManager(object):
@@ -86,6 +246,52 @@ class InstanceManager(object):
         p.map(_get_instances, clusters)
         return instances
 
+    def _filter_name(self, name, cached_data):
+        '''
+        Returns the instances of the enabled clusters with the given name,
+        looking in the cluster the instance directory points to first.
+        '''
+        instances = []
+        failed = []
+        clusters = list(Cluster.objects.filter(disabled=False))
+
+        def _find(cluster):
+            try:
+                info = cluster.get_instance_rows().get(name)
+            except (GanetiApiError, Exception):
+                info = None
+                failed.append(cluster)
+            finally:
+                close_old_connections()
+            if info is not None:
+                instances.append(Instance(cluster, name, info, cached_data))
+
+        slug = cache.get(instance_directory_key(name))
+        if slug == '':
+            # looked for on every cluster a moment ago, in vain
+            return instances
+        for cluster in clusters:
+            if cluster.slug == slug:
+                _find(cluster)
+                if instances:
+                    return instances
+                clusters.remove(cluster)
+                break
+
+        p = Pool(20)
+        p.map(_find, clusters)
+        if len(instances) == 1:
+            cache.set(
+                instance_directory_key(name),
+                instances[0].cluster.slug,
+                INSTANCE_DIRECTORY_TTL
+            )
+        elif not instances and not failed:
+            cache.set(
+                instance_directory_key(name), '', INSTANCE_DIRECTORY_MISS_TTL
+            )
+        return instances
+
     def filter(self, **kwargs):
         cached_data = preload_instance_data()
         if 'cluster' in kwargs:
@@ -101,6 +307,8 @@ class InstanceManager(object):
             except GanetiApiError:
                 results = []
             del kwargs['cluster']
+        elif 'name' in kwargs:
+            results = self._filter_name(kwargs.pop('name'), cached_data)
         else:
             results = self.all()
 
@@ -143,7 +351,62 @@ class InstanceManager(object):
             raise ObjectDoesNotExist("Could not find an instance")
 
 
+# RAPI field of each Instance attribute, dots replaced by underscores
+_INSTANCE_ATTR_FIELDS = {}
+
+
+def lazy_property(fn):
+    '''
+    An Instance property computed on first access, and kept in the slot
+    named after it with a _lazy_ prefix
+    '''
+    slot = '_lazy_%s' % fn.__name__.lstrip('_')
+
+    def get(self):
+        try:
+            return getattr(self, slot)
+        except AttributeError:
+            value = fn(self)
+            setattr(self, slot, value)
+            return value
+    return property(get, doc=fn.__doc__)
+
+
 class Instance(object):
+    '''
+    An instance, as a view over its row in the cluster's cached instances.
+
+    RAPI fields are read from the row on access, with dots replaced by
+    underscores (e.g. nic_ips), and derived attributes are computed on
+    first access. Instances have no __dict__, so every attribute they are
+    given, including the ones set by views, needs a slot.
+    '''
+    __slots__ = (
+        'cluster',
+        'name',
+        'admin_view_only',
+        'joblock',
+        '_info',
+        '_cached_data',
+        # lazy properties
+        '_lazy_extra_data',
+        '_lazy_tags',
+        '_lazy_users',
+        '_lazy_groups',
+        '_lazy_organization',
+        '_lazy_application',
+        '_lazy_ctime',
+        '_lazy_mtime',
+        '_lazy_links',
+        '_lazy_nic_ips',
+        '_lazy_ipv6s',
+        # set by views
+        'cpu_url',
+        'net_url',
+        'netw',
+        'osname',
+        'node_group_locked',
+    )
     objects = InstanceManager()
 
     def __init__(
@@ -155,90 +418,140 @@ class Instance(object):
     ):
         self.cluster = cluster
         self.name = name
-        self.networks = []
-        self.organization = None
-        self.application = None
-        self.services = []
-        self.users = []
-        self.groups = []
-        self.links = []
-        self.ipv6s = []
         self.admin_view_only = False
-        self.adminlock = False
-        self.isolate = False
-        self.needsreboot = False
-        self.whitelistip = None
         self.joblock = False
-        self._update(info, cached_data)
-
-    def _update(self, info=None, cached_data=None):
-        serv_cache = {}
+        self._cached_data = cached_data
         if not info:
-            info = self.cluster.get_instance_info(self.name)
-        for attr in info:
-            self.__dict__[attr.replace(".", "_")] = info[attr]
-
-        group_pfx = "%s:group:" % GANETI_TAG_PREFIX
-        user_pfx = "%s:user:" % GANETI_TAG_PREFIX
-        org_pfx = "%s:org:" % GANETI_TAG_PREFIX
-        app_pfx = "%s:application:" % GANETI_TAG_PREFIX
-        serv_pfx = "%s:service:" % GANETI_TAG_PREFIX
-        adminlock_tag = "%s:adminlock" % GANETI_TAG_PREFIX
-        isolate_tag = "%s:isolate" % GANETI_TAG_PREFIX
-        needsreboot_tag = "%s:needsreboot" % GANETI_TAG_PREFIX
-        whitelist_pfx = "%s:whitelist_ip:" % GANETI_TAG_PREFIX
-
-        extra_data = cached_data or preload_instance_data()
-
-        self.groups = list(tag_prefix_resolver(info, group_pfx,
-                                               extra_data["groups"]))
-        self.users = list(tag_prefix_resolver(info, user_pfx,
-                                              extra_data["users"]))
-        self.organization = next(iter(tag_prefix_resolver(
-            info, org_pfx, extra_data["orgs"])), None)
-        self.application = next(iter(tag_prefix_resolver(
-            info, app_pfx, extra_data["instanceapps"])), None)
-        self.networks = extra_data["networks"]
-
-        for tag in self.tags:
-            if tag.startswith(serv_pfx):
-                serv = tag.replace(serv_pfx, '')
-                if serv not in serv_cache:
-                    serv_cache[serv] = serv
-                if serv_cache[serv] is not None:
-                    self.services.append(serv_cache[serv])
-            elif tag == adminlock_tag:
-                self.adminlock = True
-            elif tag == isolate_tag:
-                self.isolate = True
-            elif tag == needsreboot_tag:
-                self.needsreboot = True
-            elif tag.startswith(whitelist_pfx):
-                self.whitelistip = tag.replace(whitelist_pfx, '')
-        if getattr(self, 'ctime', None):
-            self.ctime = datetime.fromtimestamp(self.ctime)
-        if getattr(self, 'mtime', None):
-            self.mtime = datetime.fromtimestamp(self.mtime)
-        for nlink in self.nic_links:
-            try:
-                self.links.append(self.networks[nlink])
-            except Exception:
-                pass
-        for i in range(len(self.nic_modes)):
-            if self.nic_modes[i] == 'bridged':
-                self.nic_ips[i] = None
-        for i in range(len(self.links)):
-            try:
-                ipv6addr = self.generate_ipv6(self.links[i], self.nic_macs[i])
-                if not ipv6addr:
-                    continue
-                self.ipv6s.append("%s" % (ipv6addr))
-            except Exception:
-                pass
-        if self.admin_state == 'up':
-            self.admin_state = True
-        if self.admin_state == 'down':
-            self.admin_state = False
+            info = cluster.get_instance_info(name)
+        self._info = info
+
+    def __getattr__(self, name):
+        # Only called for attributes not found otherwise, i.e. RAPI fields
+        if name.startswith('_'):
+            raise AttributeError(name)
+        info = self._info
+        field = _INSTANCE_ATTR_FIELDS.get(name)
+        if field is None:
+            candidates = [name] + [
+                name[:i] + '.' + name[i + 1:]
+                for i, char in enumerate(name) if char == '_'
+            ]
+            for candidate in candidates:
+                if candidate in info:
+                    field = _INSTANCE_ATTR_FIELDS[name] = candidate
+                    break
+            else:
+                raise AttributeError(name)
+        try:
+            return info[field]
+        except KeyError:
+            raise AttributeError(name)
+
+    @lazy_property
+    def _extra_data(self):
+        return self._cached_data or preload_instance_data()
+
+    @lazy_property
+    def _tags(self):
+        # rows classified at refresh time carry their tag classes
+        return get_tag_classifier().classify_row(self._info, save=False)
+
+    def _resolve(self, kind, table):
+        table = self._extra_data[table]
+        return [table[name] for name in self._tags[kind] if name in table]
+
+    @lazy_property
+    def users(self):
+        return self._resolve('users', 'users')
+
+    @lazy_property
+    def groups(self):
+        return self._resolve('groups', 'groups')
+
+    @lazy_property
+    def organization(self):
+        return next(iter(self._resolve('orgs', 'orgs')), None)
+
+    @lazy_property
+    def application(self):
+        return next(iter(self._resolve('applications', 'instanceapps')), None)
+
+    @property
+    def networks(self):
+        return self._extra_data["networks"]
+
+    @property
+    def services(self):
+        return self._tags['services']
+
+    @property
+    def adminlock(self):
+        return self._tags['adminlock']
+
+    @property
+    def isolate(self):
+        return self._tags['isolate']
+
+    @property
+    def needsreboot(self):
+        return self._tags['needsreboot']
+
+    @property
+    def whitelistip(self):
+        return self._tags['whitelistip']
+
+    @lazy_property
+    def ctime(self):
+        ctime = self._info.get('ctime')
+        return datetime.fromtimestamp(ctime) if ctime else ctime
+
+    @lazy_property
+    def mtime(self):
+        mtime = self._info.get('mtime')
+        return datetime.fromtimestamp(mtime) if mtime else mtime
+
+    @property
+    def version(self):
+        return instance_row_version(self._info)
+
+    @lazy_property
+    def links(self):
+        networks = self.networks
+        return [
+            networks[nlink] for nlink in self._info.get('nic.links', [])
+            if nlink in networks
+        ]
+
+    @lazy_property
+    def nic_ips(self):
+        if 'nic.modes' not in self._info:
+            return self._info.get('nic.ips', [])
+        return [
+            None if mode == 'bridged' else ip
+            for ip, mode in zip(
+                self._info.get('nic.ips', []),
+                self._info.get('nic.modes', [])
+            )
+        ]
+
+    @lazy_property
+    def ipv6s(self):
+        ipv6s = []
+        macs = self._info.get('nic.macs', [])
+        for link, mac in zip(self.links, macs):
+            ipv6addr = self.generate_ipv6(link, mac)
+            if ipv6addr:
+                ipv6s.append("%s" % (ipv6addr))
+        return ipv6s
+
+    @property
+    def admin_state(self):
+        admin_state = self._info.get('admin_state')
+        if admin_state == 'up':
+            return True
+        if admin_state == 'down':
+            return False
+        return admin_state
 
     def generate_ipv6(self, prefix, mac):
         try:
@@ -351,15 +664,10 @@ class Cluster(models.Model):
 
     def __init__(self, *args, **kwargs):
         models.Model.__init__(self, *args, **kwargs)
-        curl_conf = GenericCurlConfig(
-            connect_timeout=RAPI_CONNECT_TIMEOUT,
-            timeout=RAPI_RESPONSE_TIMEOUT
-        )
-        self._client = GanetiRapiClient(
-            host=self.hostname,
+        self._client = get_rapi_client(
+            self.hostname,
             username=self.username,
-            password=self.password,
-            curl_config_fn=curl_conf
+            password=self.password
         )
 
     def __unicode__(self):
@@ -382,26 +690,14 @@ class Cluster(models.Model):
         else:
             cache.set('locked_instances', {'%s' % instance: "%s" % reason}, 90)
         if job_id is not None:
-            b = None
-            for i in range(5):
-                try:
-                    b = beanstalkc.Connection()
-                    break
-                except Exception:
-                    sleep(1)
-            if b is None:
-                return
-
-            if BEANSTALK_TUBE:
-                b.use(BEANSTALK_TUBE)
-            b.put(json.dumps({
+            enqueue({
                 "type": "JOB_LOCK",
                 "cluster": self.slug,
                 "instance": instance,
                 "job_id": job_id,
                 "lock_key": lock_key,
                 "flush_keys": [self._instance_cache_key(instance)]
-            }))
+            })
 
     @classmethod
     def get_all_instances(cls):
@@ -427,35 +723,292 @@ class Cluster(models.Model):
             else:
                 raise
 
-    def refresh_instances(self, seconds=180):
-        instances = parseQuery(
-            self._client.Query(
-                'instance',
-                [
-                    'name',
-                    'tags',
-                    'pnode',
-                    'snodes',
-                    'disk.sizes',
-                    'nic.modes',
-                    'nic.ips',
-                    'nic.links',
-                    'status',
-                    'admin_state',
-                    'beparams',
-                    'oper_state',
-                    'hvparams',
-                    'nic.macs',
-                    'ctime',
-                    'mtime'
-                ]))
-        cache.set("cluster:{0}:instances".format(self.hostname),
-                  instances, seconds)
+    def _instances_snapshot_key(self):
+        return "cluster:{0}:instances:snapshot".format(self.hostname)
+
+    def _instances_changelog_key(self):
+        return "cluster:{0}:instances:changes".format(self.hostname)
+
+    def _query_instances(self, names=None):
+        qfilter = None
+        if names is not None:
+            qfilter = ["|"] + [["=", "name", name] for name in names]
+        return parseQuery(
+            self._client.Query('instance', INSTANCE_FIELDS, qfilter)
+        )
+
+    def _refresh_instances_delta(self, snapshot):
+        '''Brings a snapshot of the cluster instances up to date by asking
+        RAPI for the mtime of every instance and re-fetching only the ones
+        that are new or have changed since the snapshot was taken.
+        Returns None when a full refresh would be cheaper.
+        '''
+        current = parseQuery(
+            self._client.Query('instance', INSTANCE_DELTA_FIELDS)
+        )
+        known = dict((i['name'], i) for i in snapshot['instances'])
+        changed = [
+            i['name'] for i in current
+            if i['name'] not in known or
+            known[i['name']].get('mtime') != i['mtime']
+        ]
+        if len(changed) * 2 > len(current):
+            return None
+
+        fetched = {}
+        if changed:
+            fetched = dict(
+                (i['name'], i) for i in self._query_instances(changed)
+            )
+        instances = []
+        for info in current:
+            instance = fetched.get(info['name'])
+            if instance is None:
+                if info['name'] not in known:
+                    # removed between the two queries
+                    continue
+                instance = dict(known[info['name']])
+                instance.update(info)
+            instances.append(instance)
+        return instances
+
+    def refresh_instances(self, seconds=180, delta=INSTANCE_DELTA_REFRESH):
+        instances = None
+        known = ()
+        refreshed = time()
+        snapshot = cache.get(self._instances_snapshot_key())
+        if delta:
+            if (
+                snapshot and
+                refreshed - snapshot['refreshed'] <
+                INSTANCE_FULL_REFRESH_INTERVAL
+            ):
+                instances = self._refresh_instances_delta(snapshot)
+                refreshed = snapshot['refreshed']
+                if instances is not None:
+                    known = set(i['name'] for i in snapshot['instances'])
+        if instances is None:
+            refreshed = time()
+            instances = self._query_instances()
+        classifier = get_tag_classifier()
+        for info in instances:
+            classifier.classify_row(info)
+        serial = self._record_instance_changes(snapshot, instances)
+        cache.set(
+            self._instances_snapshot_key(),
+            {'instances': instances, 'refreshed': refreshed, 'serial': serial},
+            INSTANCE_FULL_REFRESH_INTERVAL
+        )
+        store("cluster:{0}:instances".format(self.hostname),
+              instances, seconds)
+        self._store_owner_index(instances, seconds)
+        self._store_instance_directory(instances, known)
         return instances
 
+    def _record_instance_changes(self, snapshot, instances):
+        '''
+        Appends the instances added, changed or removed since the previous
+        snapshot to the changelog of the cluster. Returns the serial of the
+        new snapshot, which only changes along with its instances.
+
+        Concurrent refreshes of the cluster take turns through a lock kept
+        in the cache, and the changes recorded by the ones that started
+        from the same snapshot are recorded again, so that no serial stands
+        for two different instance lists.
+        '''
+        key = self._instances_changelog_key()
+        if not snapshot or 'serial' not in snapshot:
+            # Start from a timestamp, so that serials are never reused
+            serial = int(time() * 1000)
+            cache.set(
+                key,
+                {'serial': serial, 'base': serial, 'changes': []},
+                INSTANCE_FULL_REFRESH_INTERVAL
+            )
+            return serial
+        previous = dict(
+            (info['name'], instance_row_version(info))
+            for info in snapshot['instances']
+        )
+        current = set()
+        changed = set()
+        for info in instances:
+            current.add(info['name'])
+            if previous.get(info['name']) != instance_row_version(info):
+                changed.add(info['name'])
+        removed = set(name for name in previous if name not in current)
+        serial = snapshot['serial']
+
+        lock_key = "%s:lock" % key
+        # the lock expires after FETCH_LOCK_TIMEOUT, should its holder die
+        while not cache.add(lock_key, 1, FETCH_LOCK_TIMEOUT):
+            sleep(FETCH_WAIT_INTERVAL)
+        try:
+            changelog = cache.get(key)
+            if (
+                changelog is None or
+                not changelog['base'] <= serial <= changelog['serial']
+            ):
+                changelog = {'serial': serial, 'base': serial, 'changes': []}
+            for (change, names, gone) in changelog['changes']:
+                if change > serial:
+                    for name in names + gone:
+                        if name in current:
+                            changed.add(name)
+                        else:
+                            removed.add(name)
+            if not changed and not removed:
+                return changelog['serial']
+            serial = changelog['serial'] + 1
+            changes = changelog['changes'] + [
+                (serial, sorted(changed), sorted(removed))
+            ]
+            changes = changes[-INSTANCE_CHANGELOG_SIZE:]
+            cache.set(
+                key,
+                {
+                    'serial': serial,
+                    'base': changes[0][0] - 1,
+                    'changes': changes
+                },
+                INSTANCE_FULL_REFRESH_INTERVAL
+            )
+        finally:
+            cache.delete(lock_key)
+        return serial
+
+    def get_instance_changes(self, since=None):
+        '''
+        Returns the current serial of the instance list along with the
+        names of the instances changed and removed since the given serial.
+        The names are None if the changes are no longer known.
+        '''
+        self.get_client_struct_instances()
+        changelog = cache.get(self._instances_changelog_key())
+        if changelog is None:
+            return None, None, None
+        serial = changelog['serial']
+        if since is None or not changelog['base'] <= since <= serial:
+            return serial, None, None
+        changed = set()
+        removed = set()
+        for (change, names, gone) in changelog['changes']:
+            if change > since:
+                changed.update(names)
+                removed.difference_update(names)
+                removed.update(gone)
+                changed.difference_update(gone)
+        return serial, changed, removed
+
+    def _store_instance_directory(self, instances, known=()):
+        '''
+        Records this cluster as the owner of the given instances, skipping
+        the ones already known from a previous refresh.
+        '''
+        cache.set_many(
+            dict(
+                (instance_directory_key(info['name']), self.slug)
+                for info in instances if info['name'] not in known
+            ),
+            INSTANCE_DIRECTORY_TTL
+        )
+
+    def _store_owner_index(self, instances, seconds=180):
+        '''
+        Caches the names of the instances owned by each user and group,
+        as found in the instance tags, along with the resources they add up
+        to (see instance_row_totals).
+        '''
+        classifier = get_tag_classifier()
+        users = {}
+        groups = {}
+        totals = {'users': {}, 'groups': {}}
+        for info in instances:
+            tags = classifier.classify_row(info, save=False)
+            resources = instance_row_totals(info)
+            for user in set(tags['users']):
+                users.setdefault(user, []).append(info['name'])
+                add_owner_totals(totals['users'], user, resources)
+            for group in set(tags['groups']):
+                groups.setdefault(group, []).append(info['name'])
+                add_owner_totals(totals['groups'], group, resources)
+        owners = {'users': users, 'groups': groups, 'totals': totals}
+        store("cluster:{0}:owners".format(self.hostname), owners, seconds)
+        return owners
+
+    def get_owner_index(self):
+        return get_or_fetch(
+            "cluster:{0}:owners".format(self.hostname),
+            lambda: self._store_owner_index(
+                self.get_client_struct_instances()
+            ),
+            stale=True,
+            local=True
+        )
+
+    def get_owner_totals(self):
+        '''
+        Returns the resources of the instances owned by each user and each
+        group, as of the last refresh of the instances.
+        '''
+        owners = self.get_owner_index()
+        if 'totals' not in owners:
+            # cached before the totals were recorded
+            owners = self._store_owner_index(
+                self.get_client_struct_instances()
+            )
+        return owners['totals']
+
+    def get_user_instance_names(self, user):
+        '''
+        Returns the names of the instances owned by a user, directly or
+        through their groups.
+        '''
+        owners = self.get_owner_index()
+        names = set(owners['users'].get(user.username, ()))
+        for group in user.groups.values_list('name', flat=True):
+            names.update(owners['groups'].get(group, ()))
+        return names
+
+    def get_user_totals(self, user):
+        '''
+        Returns the resources of the instances owned by a user, directly or
+        through their groups, each instance counted once.
+        '''
+        rows = self.get_instance_rows()
+        totals = {}
+        for name in self.get_user_instance_names(user):
+            if name in rows:
+                add_owner_totals(
+                    totals, user.username, instance_row_totals(rows[name])
+                )
+        return totals.get(user.username)
+
+    def get_instance_rows(self):
+        '''
+        Returns the cached instances of the cluster by name. The mapping is
+        built once per version of the instance list in each process.
+        '''
+        return self._get_instance_index()[0]
+
+    def _get_instance_index(self):
+        instances = self.get_client_struct_instances()
+        rows = _instance_rows.get(self.hostname)
+        if rows is None or rows[0] is not instances:
+            rows = _instance_rows[self.hostname] = (
+                instances,
+                dict((info['name'], info) for info in instances),
+                dict((info['name'], i) for i, info in enumerate(instances))
+            )
+        return rows[1], rows[2]
+
     def get_client_struct_instances(self):
-        return (cache.get("cluster:{0}:instances".format(self.hostname))
-                or self.refresh_instances())
+        return get_or_fetch(
+            "cluster:{0}:instances".format(self.hostname),
+            self.refresh_instances,
+            stale=True,
+            local=True
+        )
 
     def get_instances(self):
         cached_extra_info = preload_instance_data()
@@ -468,43 +1021,52 @@ class Cluster(models.Model):
         instances and delay node listing for admins
         '''
         instances = self._client.GetInstances(bulk=True)
+        classifier = get_tag_classifier()
         for i in instances:
+            classifier.classify_row(i)
             if i['name'] == instance:
                 i['action_lock'] = True
-        cache.set("cluster:{0}:instances".format(self.hostname), instances, 45)
+        store("cluster:{0}:instances".format(self.hostname), instances, 45)
+        self._store_owner_index(instances, 45)
 
-    def get_user_instances(self, user, admin=True):
-        instances = self.get_instances()
+    def get_user_instances(self, user, admin=True, names=None):
+        '''
+        Returns the instances listed to a user, optionally only the ones
+        among the given names, in the order of the cluster's instance list.
+        '''
         if (user.is_superuser or user.has_perm('ganeti.view_instances')) and admin:
-            return instances
+            if names is None:
+                return self.get_instances()
+            owned = set(names)
         else:
-            user = User.objects.get(pk=user.pk)
-            ugroups = []
-            for ug in user.groups.all():
-                ugroups.append(ug.pk)
-            return [
-                i for i in instances if (
-                    user in i.users or
-                    len(
-                        list(set(ugroups).intersection(
-                            set([g.id for g in i.groups]))
-                        )
-                    ) > 0
-                )
-            ]
+            owned = self.get_user_instance_names(user)
+            if names is not None:
+                owned.intersection_update(names)
+        rows, positions = self._get_instance_index()
+        cached_data = preload_instance_data()
+        return [
+            Instance(self, name, rows[name], cached_data)
+            for name in sorted(
+                (name for name in owned if name in rows),
+                key=positions.get
+            )
+        ]
+
+    def refresh_cluster_info(self, seconds=180):
+        info = self._client.GetInfo()
+        if 'ctime' in info and info['ctime']:
+            info['ctime'] = datetime.fromtimestamp(info['ctime'])
+        if 'mtime' in info and info['mtime']:
+            info['mtime'] = datetime.fromtimestamp(info['mtime'])
+        store("cluster:{0}:info".format(self.hostname), info, seconds)
+        return info
 
     def get_cluster_info(self):
-        info = cache.get("cluster:{0}:info".format(self.hostname))
-
-        if info is None:
-            info = self._client.GetInfo()
-            if 'ctime' in info and info['ctime']:
-                info['ctime'] = datetime.fromtimestamp(info['ctime'])
-            if 'mtime' in info and info['mtime']:
-                info['mtime'] = datetime.fromtimestamp(info['mtime'])
-            cache.set("cluster:{0}:info".format(self.hostname), info, 180)
-
-        return info
+        return get_or_fetch(
+            "cluster:{0}:info".format(self.hostname),
+            self.refresh_cluster_info,
+            stale=True
+        )
 
     def get_extstorage_disk_params(self, provider):
         """
@@ -565,7 +1127,22 @@ class Cluster(models.Model):
                       nodes, 180)
         return nodes
 
+    def node_list_request(self):
+        '''Returns the RAPI request behind refresh_nodes, in the form
+        accepted by util.client.SendMany
+        '''
+        return (self._client, HTTP_PUT,
+                "/%s/query/node" % GANETI_RAPI_VERSION, None,
+                {"fields": NODE_FIELDS})
+
     def refresh_nodes(self, seconds=180):
+        return self.store_nodes(self._client.Query('node', NODE_FIELDS),
+                                seconds)
+
+    def store_nodes(self, response, seconds=180):
+        '''Caches the nodes of the cluster, given the response of a RAPI
+        node query
+        '''
         def update_info_used(node_info, iused, itotal, ifree):
             try:
                 node_info[iused] = 100 * (
@@ -590,36 +1167,21 @@ class Cluster(models.Model):
             node_info['shared_storage'] = False
 
         cachenodes = []
-        nodes = parseQuery(
-            self._client.Query(
-                'node',
-                [
-                    'name',
-                    'role',
-                    'mfree',
-                    'mtotal',
-                    'dtotal',
-                    'dfree',
-                    'ctotal',
-                    'group',
-                    'pinst_cnt',
-                    'offline',
-                    'vm_capable',
-                    'pinst_list'
-                ]))
+        nodes = parseQuery(response)
 
         for info in nodes:
             update_node_info(info)
             cachenodes.append(info)
         nodes = cachenodes
-        cache.set("cluster:{0}:nodes".format(self.hostname), nodes, seconds)
+        store("cluster:{0}:nodes".format(self.hostname), nodes, seconds)
         return nodes
 
     def get_cluster_nodes(self):
-        nodes = cache.get("cluster:{0}:nodes".format(self.hostname))
-        if nodes is None:
-            nodes = self.refresh_nodes()
-        return nodes
+        return get_or_fetch(
+            "cluster:{0}:nodes".format(self.hostname),
+            self.refresh_nodes,
+            stale=True
+        )
 
     def get_available_nodes(self, node_group, number_of_nodes):
         ret_nodes = []
@@ -634,21 +1196,39 @@ class Cluster(models.Model):
             ret_nodes.append(n['name'])
         return ret_nodes[0:number_of_nodes]
 
+    def refresh_node_groups(self, seconds=180):
+        #info = parseQuery(self._client.Query('group',['name', 'tags']))
+        groups = self._client.GetGroups(bulk=True)
+        store('cluster:{0}:nodegroups'.format(self.hostname), groups, seconds)
+        return groups
+
     def get_node_groups(self):
-        info = cache.get('cluster:{0}:nodegroups'.format(self.hostname))
-        if info is None:
-            #info = parseQuery(self._client.Query('group',['name', 'tags']))
-            info = self._client.GetGroups(bulk=True)
-            cache.set('cluster:{0}:nodegroups'.format(self.hostname),
-                      info, 180)
-        return info
+        return get_or_fetch(
+            'cluster:{0}:nodegroups'.format(self.hostname),
+            self.refresh_node_groups
+        )
+
+    def refresh_networks(self, seconds=180):
+        networks = self._client.GetNetworks(bulk=True)
+        store('cluster:{0}:networks'.format(self.hostname), networks, seconds)
+        return networks
 
     def get_networks(self):
-        info = cache.get('cluster:{0}:networks'.format(self.hostname))
-        if info is None:
-            info = self._client.GetNetworks(bulk=True)
-            cache.set('cluster:{0}:networks'.format(self.hostname), info, 180)
-        return info
+        return get_or_fetch(
+            'cluster:{0}:networks'.format(self.hostname),
+            self.refresh_networks
+        )
+
+    def refresh_cache(self, seconds=180):
+        '''
+        Refreshes every cached resource of the cluster: instances, nodes,
+        node groups, networks and cluster info.
+        '''
+        self.refresh_instances(seconds=seconds)
+        self.refresh_nodes(seconds=seconds)
+        self.refresh_node_groups(seconds=seconds)
+        self.refresh_networks(seconds=seconds)
+        self.refresh_cluster_info(seconds=seconds)
 
     def get_node_group_networks(self, nodegroup):
         # This gets networks per nodegroup as received via a GetNetworks RAPI
@@ -716,8 +1296,47 @@ class Cluster(models.Model):
     def get_cluster_instances(self):
         return self._client.GetInstances()
 
+    def job_list_request(self):
+        '''Returns the RAPI request behind get_job_list, in the form
+        accepted by util.client.SendMany
+        '''
+        return (self._client, HTTP_GET, "/%s/jobs" % GANETI_RAPI_VERSION,
+                [("bulk", 1)], None)
+
+    def instance_status_request(self, names):
+        '''Returns the RAPI query for the status of the given instances, in
+        the form accepted by util.client.SendMany
+        '''
+        qfilter = ["|"] + [["=", "name", name] for name in names]
+        return (self._client, HTTP_PUT,
+                "/%s/query/instance" % GANETI_RAPI_VERSION, None,
+                {"fields": INSTANCE_STATUS_FIELDS, "qfilter": qfilter,
+                 "filter": qfilter})
+
+    def job_status_request(self, job_ids):
+        '''Returns the RAPI query for the status of the given jobs, in the
+        form accepted by util.client.SendMany
+        '''
+        qfilter = ["|"] + [["=", "id", int(job_id)] for job_id in job_ids]
+        return (self._client, HTTP_PUT,
+                "/%s/query/job" % GANETI_RAPI_VERSION, None,
+                {"fields": JOB_STATUS_FIELDS, "qfilter": qfilter,
+                 "filter": qfilter})
+
+    def job_change_request(self, job_id, job_info=None, log_serial=None):
+        '''Returns the RAPI request waiting for the given job to change from
+        the given status, in the form accepted by util.client.SendMany
+        '''
+        return (self._client, HTTP_GET,
+                "/%s/jobs/%s/wait" % (GANETI_RAPI_VERSION, job_id), None,
+                {"fields": JOB_STATUS_FIELDS,
+                 "previous_job_info": job_info,
+                 "previous_log_serial": log_serial})
+
     def get_job_list(self):
-        info = self._client.GetJobs(bulk=True)
+        return self.format_job_list(self._client.GetJobs(bulk=True))
+
+    def format_job_list(self, info):
         for i in info:
             i['cluster'] = self.slug
             if i.get('start_ts'):
@@ -1087,50 +1706,174 @@ class Network(models.Model):
         super(Network, self).save()
 
 
+def _build_network_lookup():
+    networks = {}
+    for network in Network.objects.all():
+        networks[network.link] = network.ipv6_prefix
+    return networks
+
+
+def _build_user_lookup():
+    users = {}
+    for user in User.objects.prefetch_related('groups').all():
+        users[user.username] = user
+    return users
+
+
+def _load_user_lookup(pk):
+    try:
+        user = User.objects.prefetch_related('groups').get(pk=pk)
+    except User.DoesNotExist:
+        return {}
+    return {user.username: user}
+
+
+def _build_org_lookup():
+    orgs = {}
+    for org in Organization.objects.all():
+        orgs[org.tag] = org
+    return orgs
+
+
+def _load_org_lookup(pk):
+    try:
+        org = Organization.objects.get(pk=pk)
+    except Organization.DoesNotExist:
+        return {}
+    return {org.tag: org}
+
+
+def _build_group_lookup():
+    groups = {}
+    for group in Group.objects.prefetch_related('user_set').all():
+        group.userset = list(group.user_set.all())
+        groups[group.name] = group
+    return groups
+
+
+def _load_group_lookup(pk):
+    try:
+        group = Group.objects.get(pk=pk)
+    except Group.DoesNotExist:
+        return {}
+    group.userset = list(group.user_set.all())
+    return {group.name: group}
+
+
+def _build_instanceapp_lookup():
+    instanceapps = {}
+    for instapp in InstanceApplication.objects.all():
+        instanceapps[str(instapp.pk)] = instapp
+    return instanceapps
+
+
+def _load_instanceapp_lookup(pk):
+    try:
+        instapp = InstanceApplication.objects.get(pk=pk)
+    except InstanceApplication.DoesNotExist:
+        return {}
+    return {str(instapp.pk): instapp}
+
+
+# Lookup tables resolving instance tags to the objects they refer to
+LOOKUP_TABLES = {
+    'networks': LookupTable('networks', _build_network_lookup),
+    'users': LookupTable('users', _build_user_lookup, _load_user_lookup),
+    'orgs': LookupTable('orgs', _build_org_lookup, _load_org_lookup),
+    'groups': LookupTable('groups', _build_group_lookup, _load_group_lookup),
+    'instanceapps': LookupTable(
+        'instanceapps',
+        _build_instanceapp_lookup,
+        _load_instanceapp_lookup
+    ),
+}
+
+
 def preload_instance_data():
-    networks = cache.get('networklist')
-    if not networks:
-        networks = Network.objects.select_related('cluster').all()
-        networkdict = {}
-        for network in networks:
-            networkdict[network.link] = network.ipv6_prefix
-        networks = networkdict
-        cache.set('networklist', networks, 60)
-    users = cache.get('userlist')
-    if not users:
-        users = User.objects.prefetch_related('groups').all()
-        userdict = {}
-        for user in users:
-            userdict[user.username] = user
-        users = userdict
-        cache.set('userlist', users, 60)
-    orgs = cache.get('orgslist')
-    if not orgs:
-        orgs = Organization.objects.all()
-        orgsdict = {}
-        for org in orgs:
-            orgsdict[org.tag] = org
-        orgs = orgsdict
-        cache.set('orgslist', orgs, 60)
-    groups = cache.get('groupslist')
-    if not groups:
-        groups = Group.objects.all()
-        groupsdict = {}
-        for group in groups:
-            group.userset = group.user_set.all()
-            groupsdict[group.name] = group
-        groups = groupsdict
-        cache.set('groupslist', groups, 60)
-    instanceapps = cache.get('instaceapplist')
-    if not instanceapps:
-        instanceapps = InstanceApplication.objects.all()
-        instappdict = {}
-        for instapp in instanceapps:
-            instappdict[str(instapp.pk)] = instapp
-        instanceapps = instappdict
-        cache.set('instaceapplist', instanceapps, 60)
-    return {"users": users, "orgs": orgs, "groups": groups,
-            "instanceapps": instanceapps, "networks": networks}
+    return get_lookup_tables(LOOKUP_TABLES.values())
+
+
+# User fields saved on their own that nothing resolved from tags reads,
+# e.g. on every login
+LOOKUP_IGNORED_USER_FIELDS = frozenset(['last_login'])
+
+
+# Signals
+def update_user_lookup(sender, instance, **kwargs):
+    if kwargs.get('raw', False):
+        return
+    update_fields = kwargs.get('update_fields')
+    if update_fields and LOOKUP_IGNORED_USER_FIELDS.issuperset(update_fields):
+        return
+    LOOKUP_TABLES['users'].update([instance.pk])
+    if kwargs.get('signal') is post_delete:
+        # the memberships of the user are gone along with it
+        LOOKUP_TABLES['groups'].invalidate()
+    else:
+        # groups hold copies of their users
+        LOOKUP_TABLES['groups'].update(
+            instance.groups.values_list('pk', flat=True)
+        )
+post_save.connect(
+    update_user_lookup, sender=User, dispatch_uid='update_user_lookup')
+post_delete.connect(
+    update_user_lookup, sender=User, dispatch_uid='delete_user_lookup')
+
+
+def update_group_lookup(sender, instance, **kwargs):
+    if kwargs.get('raw', False):
+        return
+    LOOKUP_TABLES['groups'].update([instance.pk])
+    # users hold copies of their groups
+    LOOKUP_TABLES['users'].update(
+        instance.user_set.values_list('pk', flat=True)
+    )
+post_save.connect(
+    update_group_lookup, sender=Group, dispatch_uid='update_group_lookup')
+
+
+def delete_group_lookup(sender, instance, **kwargs):
+    LOOKUP_TABLES['groups'].update([instance.pk])
+    LOOKUP_TABLES['users'].invalidate()
+post_delete.connect(
+    delete_group_lookup, sender=Group, dispatch_uid='delete_group_lookup')
+
+
+def update_membership_lookups(sender, instance, action, reverse, pk_set,
+                              **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if pk_set is None:
+        LOOKUP_TABLES['users'].invalidate()
+        LOOKUP_TABLES['groups'].invalidate()
+    elif reverse:
+        LOOKUP_TABLES['groups'].update([instance.pk])
+        LOOKUP_TABLES['users'].update(pk_set)
+    else:
+        LOOKUP_TABLES['users'].update([instance.pk])
+        LOOKUP_TABLES['groups'].update(pk_set)
+    # the instances listed to users depend on their groups
+    bump_generation('global')
+m2m_changed.connect(
+    update_membership_lookups,
+    sender=User.groups.through,
+    dispatch_uid='update_membership_lookups'
+)
+
+
+def connect_lookup(sender, table):
+    def update_lookup(sender, instance, **kwargs):
+        if not kwargs.get('raw', False):
+            LOOKUP_TABLES[table].update([instance.pk])
+    post_save.connect(
+        update_lookup, sender=sender, weak=False,
+        dispatch_uid='update_%s_lookup' % table)
+    post_delete.connect(
+        update_lookup, sender=sender, weak=False,
+        dispatch_uid='delete_%s_lookup' % table)
+connect_lookup(Organization, 'orgs')
+connect_lookup(InstanceApplication, 'instanceapps')
+connect_lookup(Network, 'networks')
 
 
 class InstanceActionManager(models.Manager):
@@ -1224,6 +1967,15 @@ class InstanceAction(models.Model):
         self.user.email_user(subject, message, settings.DEFAULT_FROM_EMAIL)
 
 
+class QueuedJob(models.Model):
+    '''
+    A message for the watcher that could not be put to beanstalkd, kept
+    until the watcher moves it there (see ganeti.jobqueue).
+    '''
+    body = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+
 class CustomPermission(models.Model):
     """
     Acts as a permission object that can be used to
@@ -1265,16 +2017,68 @@ def parseQuerysimple(response):
     return reslist
 
 
-def tag_prefix_resolver(instance_struct, tag_prefix, association_data):
-    def tag_prefix_matcher(tag):
-        return tag.startswith(tag_prefix)
+class TagClassifier(object):
+    '''
+    Sorts the tags of an instance into the kinds ganetimgr cares about,
+    in a single pass: tags such as "<prefix>:user:<name>" are collected
+    by kind, while "<prefix>:adminlock" and the like are flags.
+    '''
+    # kind of prefixed tag -> name of the list its values are collected in
+    LISTS = {
+        'user': 'users',
+        'group': 'groups',
+        'org': 'orgs',
+        'application': 'applications',
+        'service': 'services',
+    }
+    FLAGS = ('adminlock', 'isolate', 'needsreboot')
+    # row field the tag classes of an instance are cached in
+    FIELD = '_tags'
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._tag_prefix = "%s:" % prefix
+        self._skip = len(self._tag_prefix)
+
+    def classify(self, tags):
+        classes = {'prefix': self.prefix, 'whitelistip': None}
+        for name in self.LISTS.values():
+            classes[name] = []
+        for flag in self.FLAGS:
+            classes[flag] = False
+
+        for tag in tags:
+            if not tag.startswith(self._tag_prefix):
+                continue
+            kind, sep, value = tag[self._skip:].partition(':')
+            if not sep:
+                if kind in self.FLAGS:
+                    classes[kind] = True
+            elif kind in self.LISTS:
+                classes[self.LISTS[kind]].append(value)
+            elif kind == 'whitelist_ip':
+                classes['whitelistip'] = value
+        return classes
+
+    def classify_row(self, info, save=True):
+        '''
+        Returns the tag classes of an instance row, reusing the ones cached
+        in it. With save set, newly computed classes are stored in the row.
+        '''
+        classes = info.get(self.FIELD)
+        if classes is None or classes['prefix'] != self.prefix:
+            classes = self.classify(info.get('tags', ()))
+            if save:
+                info[self.FIELD] = classes
+        return classes
+
+
+_tag_classifiers = {}
 
-    def associate_data_with_tag(tag):
-        return association_data.get(tag.replace(tag_prefix, ""))
 
-    return filter(lambda x: x is not None,
-                  map(associate_data_with_tag,
-                      filter(tag_prefix_matcher,
-                             instance_struct.get("tags", tuple()))
-                      )
-                  )
+def get_tag_classifier(prefix=None):
+    prefix = prefix or GANETI_TAG_PREFIX
+    classifier = _tag_classifiers.get(prefix)
+    if classifier is None:
+        classifier = _tag_classifiers[prefix] = TagClassifier(prefix)
+    return classifier
@@ -1,7 +1,27 @@
-from django.test import TestCase, Client
-from django.core.urlresolvers import reverse
-from django.contrib.auth.models import User
-from ganeti.models import Cluster
+import json
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from gevent.pool import Pool
+
+from django.conf import settings
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, Client
+from django.core.urlresolvers import NoReverseMatch, reverse
+from django.core.cache import cache
+from django.contrib.auth.models import Group, User
+from django.utils import timezone
+from ganeti.models import (
+    Cluster,
+    Instance,
+    LOOKUP_TABLES,
+    Network,
+    TagClassifier,
+    preload_instance_data,
+)
+from ganeti import caching
 
 
 class LoginTestCase(TestCase):
@@ -142,6 +162,219 @@ class ClusterTestCase(LoginTestCase):
         self.assertEqual(res.status_code, 403)
 
 
+    def test_rapi_stats(self):
+        res = self.client.get(reverse('rapi-stats-json'))
+        self.assertEqual(res.status_code, 302)
+
+        self.login_user()
+        res = self.client.get(reverse('rapi-stats-json'))
+        self.assertEqual(res.status_code, 403)
+
+        self.login_superuser()
+        res = self.client.get(reverse('rapi-stats-json'))
+        self.assertEqual(res.status_code, 200)
+        stats = json.loads(res.content)
+        self.assertIn('connections_reused', stats['test.example.com'])
+
+
+class FakeCurl(object):
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class CurlPoolTestCase(TestCase):
+    def setUp(self):
+        from util.client import CurlPool
+        self.pool = CurlPool(FakeCurl, max_idle=1)
+
+    def test_reuse(self):
+        first = self.pool.Acquire()
+        self.pool.Release(first)
+        self.assertIs(self.pool.Acquire(), first)
+        stats = self.pool.GetStats()
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['handles_created'], 1)
+        self.assertEqual(stats['handles_reused'], 1)
+        self.assertEqual(stats['idle'], 0)
+
+    def test_release(self):
+        first = self.pool.Acquire()
+        second = self.pool.Acquire()
+        self.assertIsNot(first, second)
+        self.pool.Release(first)
+        # beyond max_idle handles are closed
+        self.pool.Release(second)
+        self.assertFalse(first.closed)
+        self.assertTrue(second.closed)
+        # as are the handles of failed transfers
+        third = self.pool.Acquire()
+        self.pool.Release(third, reusable=False)
+        self.assertTrue(third.closed)
+        stats = self.pool.GetStats()
+        self.assertEqual(stats['handles_discarded'], 2)
+        self.assertEqual(stats['idle'], 0)
+
+        self.pool.Release(self.pool.Acquire())
+        self.pool.Close()
+        self.assertTrue(first.closed)
+        self.assertEqual(self.pool.GetStats()['idle'], 0)
+
+    def test_shared_clients(self):
+        from ganeti.models import get_rapi_client
+        client = get_rapi_client('pool.example.com', 'user', 'secret')
+        self.assertIs(
+            get_rapi_client('pool.example.com', 'user', 'secret'), client
+        )
+        # the client is replaced once the credentials change
+        replaced = get_rapi_client('pool.example.com', 'user', 'changed')
+        self.assertIsNot(replaced, client)
+        self.assertIs(
+            get_rapi_client('pool.example.com', 'user', 'changed'), replaced
+        )
+
+
+class RapiTestHandler(BaseHTTPRequestHandler):
+    def respond(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length)
+        if self.path == '/slow':
+            time.sleep(2)
+        if self.path == '/error':
+            code, content = 500, {
+                'code': 500, 'message': 'Internal error', 'explain': ''
+            }
+        else:
+            code, content = 200, {
+                'method': self.command, 'path': self.path,
+                'body': json.loads(body) if body else None,
+            }
+        content = json.dumps(content)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_PUT = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class RapiTestServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # requests aborted by the client on purpose
+        pass
+
+
+class SendManyTestCase(TestCase):
+    def setUp(self):
+        from util.client import GanetiRapiClient
+        self.server = RapiTestServer(('127.0.0.1', 0), RapiTestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.client = GanetiRapiClient('127.0.0.1')
+        # the test server speaks plain HTTP
+        self.client._base_url = 'http://127.0.0.1:%d' % (
+            self.server.server_address[1]
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_results(self):
+        from util.client import SendMany, GanetiApiError
+        results = SendMany([
+            (self.client, 'PUT', '/ok', None, {'fields': ['name']}),
+            (self.client, 'GET', '/error', None, None),
+            (self.client, 'GET', '/ok', None, None),
+        ], timeout=10)
+        self.assertEqual(results[0]['method'], 'PUT')
+        self.assertEqual(results[0]['body'], {'fields': ['name']})
+        self.assertIsInstance(results[1], GanetiApiError)
+        self.assertEqual(results[1].code, 500)
+        self.assertEqual(results[2]['method'], 'GET')
+        # the handles are back in the pool, ready for reuse
+        stats = self.client.GetCurlPoolStats()
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['idle'], 3)
+
+    def test_deadline(self):
+        from util.client import SendMany, GanetiApiError
+        start = time.time()
+        results = SendMany([
+            (self.client, 'GET', '/slow', None, None, 0.2),
+            (self.client, 'GET', '/ok', None, None),
+        ], timeout=10)
+        self.assertTrue(time.time() - start < 2)
+        self.assertIsInstance(results[0], GanetiApiError)
+        self.assertIn('timed out', str(results[0]))
+        self.assertEqual(results[1]['path'], '/ok')
+        # the handle of the expired request is not reused
+        stats = self.client.GetCurlPoolStats()
+        self.assertEqual(stats['handles_discarded'], 1)
+        self.assertEqual(stats['idle'], 1)
+
+    def test_unreachable(self):
+        from util.client import SendMany, Error
+        self.server.server_close()
+        self.client._base_url = 'http://127.0.0.1:1'
+        results = SendMany([(self.client, 'GET', '/ok', None, None)])
+        self.assertIsInstance(results[0], Error)
+        self.assertEqual(self.client.GetCurlPoolStats()['idle'], 0)
+
+
+class ClusterNodesTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        from ganeti import utils
+        self.utils = utils
+        self.send_many = utils.SendMany
+        self.cached = Cluster.objects.create(hostname='a.example.com', slug='a')
+        self.missing = Cluster.objects.create(hostname='b.example.com', slug='b')
+        self.node = {
+            'name': 'node1.a.example.com', 'role': 'R', 'mfree': 512,
+            'mtotal': 1024, 'dtotal': 100, 'dfree': 50, 'ctotal': 4,
+            'group': 'default', 'pinst_cnt': 1, 'offline': False,
+            'vm_capable': True, 'pinst_list': ['vm.example.com'],
+        }
+        caching.store('cluster:a.example.com:nodes', [self.node], 180)
+        self.requests = []
+
+        def send_many(requests, timeout=None):
+            self.requests.extend(requests)
+            node = dict(self.node, name='node1.b.example.com', offline=True)
+            return [{
+                'fields': [{'name': f} for f in content['fields']],
+                'data': [[[0, node[f]] for f in content['fields']]],
+            } for (_, method, path, query, content) in requests]
+        utils.SendMany = send_many
+
+    def tearDown(self):
+        self.utils.SendMany = self.send_many
+
+    def test_batch(self):
+        nodes, bad_clusters, bad_nodes = self.utils.prepare_clusternodes()
+        # only the cluster without cached nodes is queried
+        self.assertEqual([r[2] for r in self.requests], ['/2/query/node'])
+        self.assertEqual(
+            sorted(n['name'] for n in nodes),
+            ['node1.a.example.com', 'node1.b.example.com']
+        )
+        self.assertEqual(bad_clusters, [])
+        self.assertEqual(bad_nodes, ['node1.b.example.com'])
+        self.assertEqual(
+            cache.get('cluster:b.example.com:nodes')[0]['cluster_slug'], 'b'
+        )
+
+
 class GraphsTestCase(LoginTestCase):
     def setUp(self):
         self.client = Client()
@@ -399,3 +632,1223 @@ class NodegroupsTestCase(LoginTestCase):
         # should return 200 (with error message)
         res = self.client.get(reverse('cluster_ng_stack'), {'cluster_id': self.cluster.pk})
         self.assertEqual(res.status_code, 200)
+
+
+class FakeRapiClient(object):
+    # answers instance queries from a list of instance dicts, recording
+    # the fields and filters it was asked for
+    def __init__(self, instances):
+        self.instances = instances
+        self.queries = []
+
+    def Query(self, what, fields, qfilter=None):
+        self.queries.append((fields, qfilter))
+        instances = self.instances
+        if qfilter is not None:
+            names = [f[2] for f in qfilter[1:]]
+            instances = [i for i in instances if i['name'] in names]
+        return {
+            'fields': [{'name': f} for f in fields],
+            'data': [[[0, i.get(f)] for f in fields] for i in instances],
+        }
+
+
+class InstanceRefreshTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.cluster = Cluster.objects.create(
+            hostname='test.example.com',
+            slug='test'
+        )
+        self.instances = [
+            {'name': 'a.example.com', 'mtime': 1, 'oper_state': True,
+             'status': 'running', 'tags': []},
+            {'name': 'b.example.com', 'mtime': 1, 'oper_state': True,
+             'status': 'running', 'tags': []},
+            {'name': 'c.example.com', 'mtime': 1, 'oper_state': True,
+             'status': 'running', 'tags': []},
+        ]
+        self.cluster._client = FakeRapiClient(self.instances)
+
+    def test_delta_refresh(self):
+        self.cluster.refresh_instances()
+        self.assertEqual(len(self.cluster._client.queries), 1)
+
+        # b is modified, c changes runtime state only
+        self.instances[1].update({'mtime': 2, 'tags': ['TEST:isolate']})
+        self.instances[2].update({'oper_state': False, 'status': 'ADMIN_down'})
+        self.cluster._client.queries = []
+        instances = self.cluster.refresh_instances()
+
+        # a light query plus a filtered query for the modified instance
+        self.assertEqual(len(self.cluster._client.queries), 2)
+        self.assertEqual(
+            self.cluster._client.queries[1][1],
+            ["|", ["=", "name", "b.example.com"]]
+        )
+        self.assertEqual([i['name'] for i in instances],
+                         ['a.example.com', 'b.example.com', 'c.example.com'])
+        self.assertEqual(instances[1]['tags'], ['TEST:isolate'])
+        self.assertEqual(instances[2]['status'], 'ADMIN_down')
+
+    def test_delta_refresh_removed(self):
+        self.cluster.refresh_instances()
+        del self.instances[0]
+        instances = self.cluster.refresh_instances()
+        self.assertEqual([i['name'] for i in instances],
+                         ['b.example.com', 'c.example.com'])
+
+    def test_full_refresh(self):
+        self.cluster.refresh_instances()
+        self.cluster._client.queries = []
+        self.cluster.refresh_instances(delta=False)
+        self.assertEqual(len(self.cluster._client.queries), 1)
+        self.assertEqual(self.cluster._client.queries[0][1], None)
+
+    def test_changes(self):
+        self.cluster.refresh_instances()
+        first, changed, removed = self.cluster.get_instance_changes(None)
+        self.assertIsNone(changed)
+
+        # refreshes without changes keep the serial
+        self.cluster.refresh_instances()
+        self.assertEqual(
+            self.cluster.get_instance_changes(first),
+            (first, set(), set())
+        )
+
+        self.instances[1].update({'mtime': 2})
+        self.cluster.refresh_instances()
+        second, changed, removed = self.cluster.get_instance_changes(first)
+        self.assertEqual((changed, removed), (set(['b.example.com']), set()))
+
+        del self.instances[1]
+        self.instances[0].update({'oper_state': False, 'status': 'ADMIN_down'})
+        self.cluster.refresh_instances(delta=False)
+        serial, changed, removed = self.cluster.get_instance_changes(first)
+        self.assertEqual(changed, set(['a.example.com']))
+        self.assertEqual(removed, set(['b.example.com']))
+        self.assertEqual(
+            self.cluster.get_instance_changes(second)[1:],
+            (set(['a.example.com']), set(['b.example.com']))
+        )
+        # unknown serials can only be caught up with from scratch
+        self.assertEqual(
+            self.cluster.get_instance_changes(first - 1), (serial, None, None)
+        )
+
+    def test_concurrent_changes(self):
+        self.cluster.refresh_instances()
+        snapshot = cache.get('cluster:test.example.com:instances:snapshot')
+        first = snapshot['serial']
+        rows = [dict(i) for i in self.instances]
+
+        # two refreshes start from the same snapshot and see different
+        # changes
+        rows[1]['mtime'] = 2
+        second = self.cluster._record_instance_changes(snapshot, rows)
+        rows = [dict(i) for i in self.instances]
+        rows[2]['mtime'] = 2
+        third = self.cluster._record_instance_changes(snapshot, rows)
+
+        self.assertEqual((second, third), (first + 1, first + 2))
+        # clients of the first list get b again, since the last list holds
+        # the row of b it started from
+        self.assertEqual(
+            self.cluster.get_instance_changes(second)[1:],
+            (set(['b.example.com', 'c.example.com']), set())
+        )
+
+
+class CoalescingTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_get_or_fetch(self):
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return ['value']
+
+        self.assertEqual(caching.get_or_fetch('test:key', fetch, 60), ['value'])
+        self.assertEqual(caching.get_or_fetch('test:key', fetch, 60), ['value'])
+        self.assertEqual(len(calls), 1)
+
+    def test_concurrent_fetches_coalesce(self):
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'value'
+
+        def get():
+            results.append(caching.get_or_fetch('test:key', fetch, 60))
+
+        leader = threading.Thread(target=get)
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=get) for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 4)
+
+    def test_failed_fetch_releases_lock(self):
+        def fetch():
+            raise ValueError()
+
+        self.assertRaises(ValueError, caching.get_or_fetch, 'test:key', fetch)
+        self.assertEqual(cache.get('test:key:lock'), None)
+
+    def test_stale_value_refreshed_in_background(self):
+        refreshed = threading.Event()
+
+        def fetch():
+            refreshed.set()
+            return 'fresh'
+
+        cache.set('test:key', 'stale', 60)
+        self.assertEqual(
+            caching.get_or_fetch('test:key', fetch, 60, stale=True), 'stale'
+        )
+        self.assertTrue(refreshed.wait(5))
+        for _ in range(50):
+            if cache.get('test:key:lock') is None:
+                break
+            time.sleep(0.1)
+        self.assertEqual(caching.get_or_fetch('test:key', fetch, 60), 'fresh')
+
+    def test_stale_value_is_a_miss_by_default(self):
+        cache.set('test:key', 'stale', 60)
+        self.assertEqual(
+            caching.get_or_fetch('test:key', lambda: 'fresh', 60), 'fresh'
+        )
+
+
+class WarmerTestCase(TestCase):
+    def test_next_interval_backs_off(self):
+        from ganeti import warmer
+        interval = warmer.next_interval(100)
+        self.assertTrue(90 <= interval <= 110)
+        interval = warmer.next_interval(100, failures=3)
+        self.assertTrue(720 <= interval <= 880)
+        interval = warmer.next_interval(100, failures=20)
+        self.assertTrue(interval <= warmer.WARM_MAX_BACKOFF * 1.1)
+
+
+class CacheWarmerTestCase(TestCase):
+    def setUp(self):
+        from ganeti import warmer
+        self.warmer = warmer
+        self.sleep = warmer.sleep
+        self.next_interval = warmer.next_interval
+        self.slept = []
+        warmer.sleep = self.slept.append
+        # sleep for the number of failures, to tell the backoff apart
+        warmer.next_interval = lambda interval, failures=0: failures
+
+    def tearDown(self):
+        self.warmer.sleep = self.sleep
+        self.warmer.next_interval = self.next_interval
+
+    def test_warm_backs_off(self):
+        outcomes = [IOError('unreachable'), IOError('unreachable'), True,
+                    IOError('unreachable'), True, False]
+
+        def refresh(hostname):
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        warmer = self.warmer.CacheWarmer()
+        warmer.refresh = refresh
+        # returns once the cluster is removed
+        warmer.warm('one.example.com')
+        self.assertEqual(self.slept, [1, 2, 0, 1, 0])
+        self.assertEqual(outcomes, [])
+
+    def test_run_once(self):
+        def refresh(hostname):
+            if hostname == 'down.example.com':
+                raise IOError('unreachable')
+            return True
+        warmer = self.warmer.CacheWarmer()
+        warmer.refresh = refresh
+        warmer.fetch_hostnames = lambda: [
+            'up.example.com', 'down.example.com'
+        ]
+        self.assertEqual(warmer.run_once(), ['down.example.com'])
+
+    def test_refresh_removed_cluster(self):
+        warmer = self.warmer.CacheWarmer()
+        self.assertFalse(warmer.refresh('gone.example.com'))
+
+    def test_refresh(self):
+        refreshed = []
+        cluster = Cluster.objects.create(
+            hostname='warm.example.com', slug='warm'
+        )
+        warmer = self.warmer.CacheWarmer(seconds=60)
+        original = Cluster.refresh_cache
+        Cluster.refresh_cache = lambda c, seconds: refreshed.append(
+            (c.hostname, seconds)
+        )
+        try:
+            self.assertTrue(warmer.refresh(cluster.hostname))
+        finally:
+            Cluster.refresh_cache = original
+        self.assertEqual(refreshed, [('warm.example.com', 60)])
+
+
+class JobPollerTestCase(TestCase):
+    def setUp(self):
+        from ganeti import jobpoller
+        self.jobpoller = jobpoller
+        self.send_many = jobpoller.SendMany
+        self.requests = []
+        self.cluster = Cluster(hostname='jobs.example.com', slug='jobs')
+        self.ended = set()
+
+        def send_many(requests, timeout=None):
+            self.requests.append(requests)
+            responses = []
+            for (_, method, path, query, content) in requests:
+                ids = [f[2] for f in content['qfilter'][1:]]
+                responses.append({
+                    'fields': [{'name': f} for f in content['fields']],
+                    'data': [
+                        [[0, job_id], [0, 'success'],
+                         [0, [1, 0] if job_id in self.ended else None],
+                         [0, []], [0, []]]
+                        for job_id in ids
+                    ],
+                })
+            return responses
+        jobpoller.SendMany = send_many
+
+    def tearDown(self):
+        self.jobpoller.SendMany = self.send_many
+
+    def test_batches_jobs(self):
+        poller = self.jobpoller.JobPoller()
+        first = poller.watch(self.cluster, 1)
+        second = poller.watch(self.cluster, '2')
+        poller.poll()
+        # both jobs are fetched with a single query
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(len(self.requests[0]), 1)
+        self.assertEqual(
+            sorted(self.requests[0][0][4]['qfilter'][1:]),
+            [['=', 'id', 1], ['=', 'id', 2]]
+        )
+        self.assertFalse(first.ready())
+
+        # nothing is due before the next interval
+        poller.poll()
+        self.assertEqual(len(self.requests), 1)
+
+        self.ended.add(2)
+        for watch in poller.watches.values():
+            watch.due = 0
+        poller.poll()
+        self.assertFalse(first.ready())
+        self.assertEqual(second.get(timeout=0)['status'], 'success')
+
+        poller.forget(self.cluster, 2)
+        self.assertEqual(poller.watches.keys(), [('jobs', 1)])
+
+    def test_waits_for_changes(self):
+        responses = [
+            {'job_info': [3, 'running', None, [None], [None]],
+             'log_entries': [[1, [0, 0], 'message', 'started']]},
+            None,
+            {'job_info': [3, 'success', [1, 0], ['success'], [None]],
+             'log_entries': [[2, [1, 0], 'message', 'done']]},
+        ]
+        requests = []
+
+        def send_many(batch, timeout=None):
+            requests.extend(batch)
+            return [responses.pop(0)]
+        self.jobpoller.SendMany = send_many
+
+        waiter = self.jobpoller.JobWaiter()
+        watch = self.jobpoller.JobWatch(self.cluster, 3)
+        waiter.wait(watch)
+        self.assertEqual(watch.result.get(timeout=0)['status'], 'success')
+        self.assertEqual(len(requests), 3)
+        self.assertEqual(requests[0][2], '/2/jobs/3/wait')
+        # each request waits for a change from the last status seen
+        self.assertIsNone(requests[0][4]['previous_job_info'])
+        self.assertEqual(requests[2][4]['previous_job_info'][1], 'running')
+        self.assertEqual(requests[2][4]['previous_log_serial'], 1)
+
+
+class FakeConnection(object):
+    def __init__(self, sent):
+        self.sent = sent
+        self.closed = False
+
+    def put(self, body):
+        if self.sent is None:
+            raise IOError("Connection reset")
+        self.sent.append(body)
+
+    def close(self):
+        self.closed = True
+
+
+class JobQueueTestCase(TestCase):
+    def setUp(self):
+        from ganeti import jobqueue
+        self.jobqueue = jobqueue
+        self.pool = jobqueue._pool
+        self.sent = []
+        self.connects = []
+
+        def connect():
+            self.connects.append(1)
+            if self.sent is None:
+                raise IOError("Connection refused")
+            return FakeConnection(self.sent)
+        jobqueue._pool = jobqueue.ProducerPool(size=1)
+        jobqueue._pool.connect = connect
+
+    def tearDown(self):
+        self.jobqueue._pool = self.pool
+
+    def test_reuses_connections(self):
+        self.jobqueue.enqueue({'type': 'JOB_LOCK', 'job_id': 1})
+        self.jobqueue.enqueue({'type': 'JOB_LOCK', 'job_id': 2})
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(len(self.connects), 1)
+
+    def test_outbox(self):
+        from ganeti.models import QueuedJob
+        sent = self.sent
+        self.sent = None
+        self.jobqueue.enqueue({'type': 'JOB_LOCK', 'job_id': 1})
+        self.jobqueue.enqueue({'type': 'JOB_LOCK', 'job_id': 2})
+        self.assertEqual(QueuedJob.objects.count(), 2)
+        # beanstalkd is not tried again right after failing
+        self.assertEqual(len(self.connects), 1)
+        self.assertEqual(self.jobqueue.flush_outbox(), 0)
+        self.assertEqual(QueuedJob.objects.count(), 2)
+
+        self.sent = sent
+        self.jobqueue._pool.down_until = 0
+        self.assertEqual(self.jobqueue.flush_outbox(), 2)
+        self.assertEqual(QueuedJob.objects.count(), 0)
+        self.assertEqual(
+            [json.loads(body)['job_id'] for body in self.sent], [1, 2]
+        )
+
+
+class GenerationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_bump_changes_dependent_keys(self):
+        from ganeti.utils import (
+            user_instances_cache_key, invalidate_cluster_users_cache
+        )
+        index = user_instances_cache_key('user')
+        own = user_instances_cache_key('user', 'one')
+        other = user_instances_cache_key('user', 'two')
+        self.assertEqual(index, user_instances_cache_key('user'))
+
+        invalidate_cluster_users_cache('one')
+        self.assertNotEqual(index, user_instances_cache_key('user'))
+        self.assertNotEqual(own, user_instances_cache_key('user', 'one'))
+        self.assertEqual(other, user_instances_cache_key('user', 'two'))
+
+    def test_generation_survives_eviction(self):
+        before = caching.generation('scope')
+        cache.delete('generation:scope')
+        caching.bump_generation('scope')
+        self.assertTrue(int(caching.generation('scope')) >= int(before))
+
+
+class NamespacedCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.cache = caching.NamespacedCache(cache)
+
+    def test_invalidate_family(self):
+        self.cache.set('cluster:one:instances', [1], 60)
+        self.cache.set('cluster:two:nodes', [2], 60)
+        self.cache.set('user:admin:index:instances', [3], 60)
+        self.cache.set('badclusters', [], 60)
+        self.cache.set('unrelated', 1, 60)
+        cache.delete('cluster:two:nodes')
+
+        self.assertEqual(self.cache.invalidate('cluster'), 1)
+        self.assertEqual(cache.get('cluster:one:instances'), None)
+        self.assertEqual(cache.get('user:admin:index:instances'), [3])
+        self.assertEqual(self.cache.invalidate('lists'), 1)
+        self.assertEqual(cache.get('unrelated'), 1)
+
+    def test_invalidate_cluster_resources(self):
+        self.cache.set('cluster:one:instance:vm1', 1, 60)
+        self.cache.set('cluster:one:instance:vm1:fresh', 1, 60)
+        self.cache.set('cluster:one:instance:vm1:lock', 1, 60)
+        self.cache.set('cluster:one:instance:vm1:user:admin', 1, 60)
+        self.cache.set('cluster:one:nodes:lock', 1, 60)
+
+        self.assertEqual(self.cache.invalidate('cluster'), 2)
+        self.assertEqual(cache.get('cluster:one:instance:vm1'), None)
+        self.assertEqual(cache.get('cluster:one:instance:vm1:lock'), 1)
+        self.assertEqual(cache.get('cluster:one:instance:vm1:user:admin'), 1)
+        self.assertEqual(cache.get('cluster:one:nodes:lock'), 1)
+
+    def test_invalidate_shard_prefix(self):
+        self.cache.set_many({
+            'user:admin:index:instances': 1,
+            'user:admin:stats': 2,
+            'user:other:index:instances': 3,
+        }, 60)
+        self.assertEqual(
+            self.cache.invalidate(
+                'user', shard='admin', prefix='user:admin:index'
+            ),
+            1
+        )
+        self.assertEqual(cache.get('user:admin:stats'), 2)
+        self.assertEqual(cache.get('user:other:index:instances'), 3)
+
+
+class LookupTableTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('lookup', 'lookup@test.com')
+        self.group = Group.objects.create(name='lookupgroup')
+
+    def test_tables_follow_changes(self):
+        version = LOOKUP_TABLES['users'].version()
+        data = preload_instance_data()
+        self.assertIn('lookup', data['users'])
+        self.assertEqual(data['groups']['lookupgroup'].userset, [])
+
+        self.user.username = 'renamed'
+        self.user.save()
+        self.user.groups.add(self.group)
+        data = preload_instance_data()
+        self.assertNotIn('lookup', data['users'])
+        self.assertIn('renamed', data['users'])
+        self.assertEqual(
+            [u.username for u in data['groups']['lookupgroup'].userset],
+            ['renamed']
+        )
+        self.assertNotEqual(LOOKUP_TABLES['users'].version(), version)
+
+        self.user.delete()
+        self.assertNotIn('renamed', preload_instance_data()['users'])
+
+    def test_login_keeps_tables(self):
+        preload_instance_data()
+        version = LOOKUP_TABLES['users'].version()
+        self.user.last_login = timezone.now()
+        self.user.save(update_fields=['last_login'])
+        self.assertEqual(LOOKUP_TABLES['users'].version(), version)
+
+        self.user.email = 'changed@test.com'
+        self.user.save(update_fields=['email'])
+        self.assertNotEqual(LOOKUP_TABLES['users'].version(), version)
+
+    def test_rolled_back_changes_ignored(self):
+        preload_instance_data()
+        version = LOOKUP_TABLES['users'].version()
+        try:
+            with transaction.atomic():
+                self.user.username = 'rolledback'
+                self.user.save()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(LOOKUP_TABLES['users'].version(), version)
+        self.assertIn('lookup', preload_instance_data()['users'])
+
+    def test_changes_while_building(self):
+        table = LOOKUP_TABLES['users']
+        # another process builds the table before the user is renamed,
+        # and stores it after
+        cache.add('%s:lock' % table.key, 1)
+        built = table._build()
+        self.user.username = 'renamed'
+        self.user.save()
+        table._store(built)
+        cache.delete('%s:lock' % table.key)
+
+        self.assertIsNone(cache.get(table.key))
+        users = preload_instance_data()['users']
+        self.assertIn('renamed', users)
+        self.assertNotIn('lookup', users)
+
+
+class LocalCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        caching._local.clear()
+
+    def test_local_value_kept_until_new_version(self):
+        caching.store('test:key', ['old'], 60)
+        value = caching.get_or_fetch('test:key', list, local=True)
+        self.assertIs(caching.get_or_fetch('test:key', list, local=True), value)
+
+        # another process stores a new version
+        cache.set('test:key', ['new'], 60)
+        cache.set('test:key:fresh', 'other', 60)
+        self.assertEqual(
+            caching.get_or_fetch('test:key', list, local=True), ['new']
+        )
+
+    def test_lookup_tables_kept_per_version(self):
+        User.objects.create_user('local', 'local@test.com')
+        # building the tables bumps their versions
+        preload_instance_data()
+        users = preload_instance_data()['users']
+        self.assertIs(preload_instance_data()['users'], users)
+        User.objects.create_user('other', 'other@test.com')
+        self.assertIn('other', preload_instance_data()['users'])
+
+    def test_lookup_table_rebuild_bumps_version(self):
+        preload_instance_data()
+        version = LOOKUP_TABLES['users'].version()
+        # the table expires, after a change that bypassed the signals
+        cache.delete_many(['lookup:users', 'lookup:users:fresh'])
+        User.objects.bulk_create([User(username='bulk')])
+
+        self.assertIn('bulk', LOOKUP_TABLES['users'].get())
+        self.assertNotEqual(LOOKUP_TABLES['users'].version(), version)
+        self.assertIn('bulk', preload_instance_data()['users'])
+
+    def test_instance_lookup_version_after_rebuild(self):
+        from ganeti.utils import instance_lookup_version
+        version = instance_lookup_version()
+        preload_instance_data()
+        self.assertEqual(instance_lookup_version(), version)
+
+
+class InstanceTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('owner', 'owner@test.com')
+        self.info = {
+            'name': 'vm.example.com',
+            'tags': [
+                '%s:user:owner' % settings.GANETI_TAG_PREFIX,
+                '%s:service:web' % settings.GANETI_TAG_PREFIX,
+                '%s:adminlock' % settings.GANETI_TAG_PREFIX,
+            ],
+            'nic.modes': ['routed', 'bridged'],
+            'nic.ips': ['10.0.0.1', '10.0.0.2'],
+            'nic.links': ['rt1', 'br1'],
+            'nic.macs': ['aa:00:00:00:00:01', 'aa:00:00:00:00:02'],
+            'admin_state': 'up',
+            'ctime': 1400000000.0,
+        }
+        self.cached_data = {
+            'users': {'owner': self.user},
+            'groups': {},
+            'orgs': {},
+            'instanceapps': {},
+            'networks': {'rt1': '2001:db8::/64'},
+        }
+
+    def test_attributes(self):
+        instance = Instance(None, 'vm.example.com', self.info, self.cached_data)
+        self.assertEqual(instance.users, [self.user])
+        self.assertEqual(instance.services, ['web'])
+        self.assertTrue(instance.adminlock)
+        self.assertFalse(instance.isolate)
+        self.assertEqual(instance.nic_ips, ['10.0.0.1', None])
+        self.assertEqual(instance.nic_links, ['rt1', 'br1'])
+        self.assertEqual(instance.links, ['2001:db8::/64'])
+        self.assertEqual(instance.ipv6s, ['2001:db8::a800:ff:fe00:1'])
+        self.assertIs(instance.admin_state, True)
+        self.assertEqual(instance.ctime.year, 2014)
+        self.assertRaises(AttributeError, getattr, instance, 'pnode')
+        # the shared row is left untouched
+        self.assertEqual(self.info['nic.ips'], ['10.0.0.1', '10.0.0.2'])
+
+    def test_view_attributes(self):
+        instance = Instance(None, 'vm.example.com', self.info, self.cached_data)
+        instance.osname = 'debian'
+        self.assertEqual(instance.osname, 'debian')
+
+
+class OwnerIndexTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        caching._local.clear()
+        prefix = settings.GANETI_TAG_PREFIX
+        self.user = User.objects.create_user('owner', 'owner@test.com')
+        group = Group.objects.create(name='owners')
+        self.user.groups.add(group)
+        self.cluster = Cluster.objects.create(
+            hostname='owners.example.com',
+            slug='owners'
+        )
+        self.cluster._client = FakeRapiClient([
+            {'name': 'a.example.com', 'mtime': 1,
+             'tags': ['%s:user:owner' % prefix],
+             'beparams': {'vcpus': 2, 'maxmem': 1024},
+             'disk.sizes': [10240, 512]},
+            {'name': 'b.example.com', 'mtime': 1,
+             'tags': ['%s:group:owners' % prefix, '%s:user:owner' % prefix],
+             'beparams': {'vcpus': 1, 'maxmem': 512},
+             'disk.sizes': [1024]},
+            {'name': 'c.example.com', 'mtime': 1,
+             'tags': ['%s:user:other' % prefix]},
+        ])
+
+    def test_user_instances(self):
+        self.cluster.refresh_instances()
+        self.assertEqual(
+            self.cluster.get_owner_index()['users'],
+            {
+                'owner': ['a.example.com', 'b.example.com'],
+                'other': ['c.example.com'],
+            }
+        )
+        instances = self.cluster.get_user_instances(self.user)
+        self.assertEqual(
+            [i.name for i in instances], ['a.example.com', 'b.example.com']
+        )
+
+    def test_user_instances_in_cluster_order(self):
+        self.cluster._client.instances.reverse()
+        self.cluster.refresh_instances()
+        instances = self.cluster.get_user_instances(self.user)
+        self.assertEqual(
+            [i.name for i in instances], ['b.example.com', 'a.example.com']
+        )
+
+    def test_totals(self):
+        self.cluster.refresh_instances()
+        totals = self.cluster.get_owner_totals()
+        self.assertEqual(totals['users']['owner'], {
+            'instances': 2, 'cpu': 3, 'memory': 1536, 'disk': 11776
+        })
+        self.assertEqual(totals['users']['other'], {
+            'instances': 1, 'cpu': 0, 'memory': 0, 'disk': 0
+        })
+        self.assertEqual(totals['groups']['owners']['instances'], 1)
+        # instances owned both directly and through a group count once
+        self.assertEqual(
+            self.cluster.get_user_totals(self.user), totals['users']['owner']
+        )
+
+    def test_get_by_name(self):
+        self.cluster.refresh_instances()
+        self.assertEqual(
+            cache.get('directory:instance:b.example.com'), 'owners'
+        )
+        instance = Instance.objects.get(name='b.example.com')
+        self.assertEqual(instance.cluster.slug, 'owners')
+        self.assertEqual(Instance.objects.filter(name='d.example.com'), [])
+        # misses are remembered for a while, until the instance shows up
+        self.assertEqual(cache.get('directory:instance:d.example.com'), '')
+        self.assertEqual(Instance.objects.filter(name='d.example.com'), [])
+        self.cluster._client.instances.append(
+            {'name': 'd.example.com', 'mtime': 1, 'tags': []}
+        )
+        self.cluster.refresh_instances()
+        self.assertEqual(
+            [i.cluster.slug for i in
+             Instance.objects.filter(name='d.example.com')],
+            ['owners']
+        )
+
+
+class TagClassifierTestCase(TestCase):
+    def test_classify(self):
+        classes = TagClassifier('test').classify([
+            'test:user:alice',
+            'test:user:bob',
+            'test:group:admins',
+            'test:org:grnet',
+            'test:application:12',
+            'test:service:web',
+            'test:adminlock',
+            'test:whitelist_ip:2001:db8::1',
+            'test:unknown:value',
+            'other:user:mallory',
+        ])
+        self.assertEqual(classes['users'], ['alice', 'bob'])
+        self.assertEqual(classes['groups'], ['admins'])
+        self.assertEqual(classes['orgs'], ['grnet'])
+        self.assertEqual(classes['applications'], ['12'])
+        self.assertEqual(classes['services'], ['web'])
+        self.assertTrue(classes['adminlock'])
+        self.assertFalse(classes['isolate'])
+        self.assertEqual(classes['whitelistip'], '2001:db8::1')
+
+    def test_classify_row(self):
+        classifier = TagClassifier('test')
+        row = {'tags': ['test:isolate']}
+        self.assertTrue(classifier.classify_row(row, save=False)['isolate'])
+        self.assertNotIn(TagClassifier.FIELD, row)
+        classifier.classify_row(row)
+        self.assertTrue(row[TagClassifier.FIELD]['isolate'])
+        # classes cached for another prefix are recomputed
+        self.assertFalse(
+            TagClassifier('other').classify_row(row)['isolate']
+        )
+
+
+class InstanceIndexTestCase(TestCase):
+    def setUp(self):
+        from ganeti.utils import build_instance_index
+        rows = [
+            {
+                'name': name, 'cluster': cluster, 'memory': '%d MB' % size,
+                'memory_size': size, 'disk': '10 GB', 'disk_size': 10240,
+                'vcpus': 1, 'status': 'Running', 'ipaddress': [],
+                'nic_macs': '', 'network': [], 'users': [], 'groups': [],
+            } for (name, cluster, size) in [
+                ('c.example.com', 'one', 512),
+                ('a.example.com', 'two', 4096),
+                ('b.example.com', 'one', 1024),
+            ]
+        ]
+        rows[2]['needsreboot'] = True
+        self.index = build_instance_index(rows)
+
+    def page(self, **params):
+        from ganeti.utils import instance_index_page
+        params.setdefault('sEcho', '3')
+        params.setdefault('iColumns', '2')
+        params.setdefault('mDataProp_0', 'name')
+        params.setdefault('mDataProp_1', 'memory')
+        return instance_index_page(self.index, params)
+
+    def names(self, response):
+        return [row['name'] for row in response['aaData']]
+
+    def test_page(self):
+        response = self.page(iDisplayStart='1', iDisplayLength='1')
+        self.assertEqual(response['sEcho'], 3)
+        self.assertEqual(response['iTotalRecords'], 3)
+        self.assertEqual(response['iTotalDisplayRecords'], 3)
+        self.assertEqual(self.names(response), ['b.example.com'])
+        # flagged for the whole list, not only the page
+        response = self.page(iDisplayStart='0', iDisplayLength='1')
+        self.assertEqual(self.names(response), ['a.example.com'])
+        self.assertTrue(response['needsreboot'])
+        self.assertEqual(
+            self.names(self.page(iDisplayLength='-1')),
+            ['a.example.com', 'b.example.com', 'c.example.com']
+        )
+
+    def test_sort(self):
+        # sizes are sorted by their value rather than their text
+        response = self.page(iSortCol_0='1', sSortDir_0='desc')
+        self.assertEqual(
+            self.names(response),
+            ['a.example.com', 'b.example.com', 'c.example.com']
+        )
+
+    def test_search(self):
+        response = self.page(sSearch='ONE example')
+        self.assertEqual(response['iTotalDisplayRecords'], 2)
+        self.assertEqual(
+            self.names(response), ['b.example.com', 'c.example.com']
+        )
+        self.assertEqual(
+            self.names(self.page(sSearch='needs reboot')), ['b.example.com']
+        )
+        self.assertEqual(
+            self.names(self.page(sSearch_1='4 GB')), []
+        )
+        self.assertEqual(
+            self.names(self.page(sSearch_1='4096')), ['a.example.com']
+        )
+
+    def test_current_parameters(self):
+        from ganeti.utils import instance_index_page
+        response = instance_index_page(self.index, {
+            'draw': '2', 'start': '0', 'length': '2',
+            'columns[0][data]': 'name', 'order[0][column]': '0',
+            'order[0][dir]': 'desc', 'search[value]': '',
+        })
+        self.assertEqual(response['draw'], 2)
+        self.assertEqual(response['recordsFiltered'], 3)
+        self.assertEqual(
+            [row['name'] for row in response['data']],
+            ['c.example.com', 'b.example.com']
+        )
+
+
+class StreamJsonTestCase(TestCase):
+    def test_stream(self):
+        import json
+        from ganeti.utils import stream_json
+        rows = ({'name': 'instance%d' % i, 'ips': [None]} for i in range(100))
+        chunks = list(stream_json(
+            {'aaData': rows, 'clusters': ['one'], 'empty': iter([])},
+            chunk_size=256
+        ))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(json.loads(''.join(chunks)), {
+            'aaData': [
+                {'name': 'instance%d' % i, 'ips': [None]} for i in range(100)
+            ],
+            'clusters': ['one'],
+            'empty': [],
+        })
+
+
+class CachedReverseTestCase(TestCase):
+    def assertSameUrl(self, name, args=None, kwargs=None):
+        from ganeti.utils import cached_reverse
+        self.assertEqual(
+            cached_reverse(name, args=args, kwargs=kwargs),
+            reverse(name, args=args, kwargs=kwargs)
+        )
+
+    def test_cached_reverse(self):
+        self.assertSameUrl('instance-detail', kwargs={
+            'cluster_slug': 'one', 'instance': 'a.example.com'
+        })
+        # parameters are quoted like reverse does
+        self.assertSameUrl('instance-detail', kwargs={
+            'cluster_slug': 'one', 'instance': u'a b\u03b1&c'
+        })
+        self.assertSameUrl('user-info', kwargs={
+            'type': 'group', 'usergroup': 'admins@example.com'
+        })
+        self.assertSameUrl('graph', args=('one', 'a.example.com', 'cpu-ts'))
+        self.assertSameUrl('user-instances')
+
+    def test_parameters_checked(self):
+        from ganeti.utils import cached_reverse
+        # usernames may hold characters the route does not accept
+        self.assertRaises(
+            NoReverseMatch,
+            cached_reverse,
+            'user-info',
+            kwargs={'type': 'user', 'usergroup': 'a+b'}
+        )
+        self.assertRaises(
+            NoReverseMatch,
+            cached_reverse,
+            'graph',
+            args=('one/two', 'a.example.com', 'cpu-ts')
+        )
+        self.assertSameUrl('graph', args=(
+            'one', 'a.example.com', 'net-ts', '/eth0'
+        ))
+
+
+class InstanceFragmentTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        caching._local.clear()
+        prefix = settings.GANETI_TAG_PREFIX
+        self.owner = User.objects.create_user('owner', 'owner@test.com')
+        self.other = User.objects.create_user('other', 'other@test.com')
+        # building the lookup tables bumps the version rows are keyed by
+        preload_instance_data()
+        self.cluster = Cluster(hostname='one.example.com', slug='one')
+        self.info = {
+            'name': 'vm.example.com',
+            'tags': [
+                '%s:user:owner' % prefix,
+                '%s:user:other' % prefix,
+            ],
+            'pnode': 'node1.example.com',
+            'snodes': [],
+            'disk.sizes': [10240],
+            'nic.modes': ['routed'],
+            'nic.ips': ['10.0.0.1'],
+            'nic.links': ['rt1'],
+            'nic.macs': ['aa:00:00:00:00:01'],
+            'status': 'running',
+            'admin_state': True,
+            'oper_state': True,
+            'beparams': {'maxmem': 1024, 'vcpus': 1},
+            'hvparams': {},
+            'mtime': 1400000000.0,
+        }
+
+    def instance(self):
+        return Instance(self.cluster, self.info['name'], self.info)
+
+    def test_shared_rows(self):
+        from ganeti.utils import (
+            generate_json_many,
+            instance_fragment_key,
+            instance_lookup_version,
+        )
+        rows, failed = generate_json_many([self.instance()], self.owner, [])
+        self.assertEqual(failed, [])
+        self.assertEqual(rows[0]['name'], 'vm.example.com')
+        self.assertNotIn('users', rows[0])
+
+        # other owners get the row cached by the first one, with their own
+        # locks applied
+        instance = self.instance()
+        instance.joblock = 'deleting'
+        key = instance_fragment_key(
+            instance, 'owner', instance_lookup_version()
+        )
+        self.assertIsNotNone(cache.get(key))
+        rows, failed = generate_json_many(
+            [instance], self.other, ['node1.example.com']
+        )
+        self.assertEqual(rows[0]['locked_reason'], 'Deleting')
+        self.assertTrue(rows[0]['node_group_locked'])
+        self.assertNotIn('name_href', rows[0])
+        self.assertIn('name_href', cache.get(key))
+
+        # the row is rebuilt once the instance changes; both instances read
+        # the same row, so the version is taken before it changes
+        version = instance.version
+        self.info['status'] = 'ADMIN_down'
+        self.info['oper_state'] = False
+        self.assertNotEqual(self.instance().version, version)
+        rows, failed = generate_json_many([self.instance()], self.owner, [])
+        self.assertEqual(rows[0]['status'], 'Stopped, should be running')
+
+    def test_cluster_description(self):
+        from ganeti.utils import generate_json_many
+        self.cluster.description = 'One'
+        rows, failed = generate_json_many([self.instance()], self.owner, [])
+        self.assertEqual(rows[0]['cluster'], 'One')
+        self.cluster.description = 'Renamed'
+        rows, failed = generate_json_many([self.instance()], self.owner, [])
+        self.assertEqual(rows[0]['cluster'], 'Renamed')
+
+    def test_network_prefix(self):
+        from ganeti.utils import generate_json_many
+        self.cluster.save()
+        network = Network.objects.create(
+            description='rt1', cluster=self.cluster, link='rt1',
+            mode='routed', ipv6_prefix='2001:db8:1::/64'
+        )
+        rows, failed = generate_json_many([self.instance()], self.owner, [])
+        self.assertEqual(
+            rows[0]['ipv6address'], ['2001:db8:1:0:a800:ff:fe00:1']
+        )
+        network.ipv6_prefix = '2001:db8:2::/64'
+        network.save()
+        rows, failed = generate_json_many([self.instance()], self.owner, [])
+        self.assertEqual(
+            rows[0]['ipv6address'], ['2001:db8:2:0:a800:ff:fe00:1']
+        )
+
+
+class InstanceStatusTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        caching._local.clear()
+        prefix = settings.GANETI_TAG_PREFIX
+        self.user = User.objects.create_user('owner', 'owner@test.com')
+        self.cluster = Cluster.objects.create(
+            hostname='status.example.com',
+            slug='status'
+        )
+        self.client = FakeRapiClient([
+            {'name': 'a.example.com', 'mtime': 1, 'pnode': 'node1',
+             'tags': ['%s:user:owner' % prefix], 'status': 'running',
+             'admin_state': 'up', 'oper_state': True},
+            {'name': 'b.example.com', 'mtime': 1, 'pnode': 'node2',
+             'tags': ['%s:user:owner' % prefix], 'status': 'ADMIN_down',
+             'admin_state': 'up', 'oper_state': False},
+            {'name': 'c.example.com', 'mtime': 1, 'pnode': 'node1',
+             'tags': ['%s:user:other' % prefix], 'status': 'running',
+             'admin_state': 'up', 'oper_state': True},
+        ])
+        self.cluster._client = self.client
+        self.cluster.refresh_instances()
+        cache.set('cluster:status.example.com:lockednodegroups:nodes', ['node1'])
+        cache.set('locked_instances', {'b.example.com': 'rebooting'})
+
+        # answer the batch through the fake client, one query per request
+        def send_many(requests, timeout=None):
+            return [
+                self.client.Query(
+                    path.rsplit('/', 1)[-1], content['fields'],
+                    content['qfilter']
+                ) for (_, method, path, query, content) in requests
+            ]
+        from ganeti import utils
+        self.utils = utils
+        self.send_many = utils.SendMany
+        utils.SendMany = send_many
+
+    def tearDown(self):
+        self.utils.SendMany = self.send_many
+
+    def test_labels(self):
+        from ganeti.utils import instance_status
+        self.assertEqual(instance_status(True, True, 'running'),
+                         ("Running", "success"))
+        self.assertEqual(instance_status(False, True, 'running'),
+                         ("Running, should be stopped", "warning"))
+        self.assertEqual(instance_status(True, False, 'ERROR_nodedown'),
+                         ("Generic cluster error", "important"))
+
+    def test_batch(self):
+        from ganeti.utils import prepare_instance_status
+        self.client.queries = []
+        records, bad_clusters = prepare_instance_status([
+            ('status', 'b.example.com'),
+            ('status', 'a.example.com'),
+            ('status', 'c.example.com'),
+            ('missing', 'd.example.com'),
+        ], self.user)
+        self.assertEqual(bad_clusters, [])
+        # one query for both instances the user owns
+        self.assertEqual(len(self.client.queries), 1)
+        self.assertEqual(
+            self.client.queries[0][1],
+            ['|', ['=', 'name', 'b.example.com'],
+             ['=', 'name', 'a.example.com']]
+        )
+        self.assertEqual(records[0]['status'], 'Stopped, should be running')
+        self.assertEqual(records[0]['locked_reason'], 'Rebooting')
+        self.assertFalse(records[0]['node_group_locked'])
+        self.assertEqual(records[1]['status'], 'Running')
+        self.assertTrue(records[1]['node_group_locked'])
+        self.assertNotIn('locked', records[1])
+        self.assertEqual(records[2]['error'], 'not found')
+        self.assertEqual(records[3]['error'], 'not found')
+
+
+class SerialPool(object):
+    # runs the work given to a gevent pool in the calling greenlet, the only
+    # one that sees the test database
+    def __init__(self, size=None):
+        pass
+
+    def map(self, func, iterable):
+        return map(func, iterable)
+
+
+class InstanceChangesTestCase(TestCase):
+    def setUp(self):
+        from ganeti.views import instances
+        self.views = instances
+        self.views.Pool = SerialPool
+        cache.clear()
+        caching._local.clear()
+        prefix = settings.GANETI_TAG_PREFIX
+        User.objects.create_user('owner', 'owner@test.com', 'secret')
+        self.cluster = Cluster.objects.create(
+            hostname='changes.example.com',
+            slug='changes'
+        )
+        self.instances = [
+            {'name': name, 'mtime': 1, 'pnode': 'node1',
+             'tags': ['%s:user:%s' % (prefix, owner)], 'status': 'running',
+             'admin_state': 'up', 'oper_state': True, 'disk.sizes': [1024],
+             'nic.ips': ['10.0.0.1'], 'nic.modes': ['routed'],
+             'nic.links': ['rt1'], 'nic.macs': ['aa:00:00:00:00:01'],
+             'beparams': {'maxmem': 1024, 'vcpus': 1}, 'hvparams': {}}
+            for (name, owner) in [
+                ('a.example.com', 'owner'),
+                ('b.example.com', 'owner'),
+                ('c.example.com', 'other'),
+            ]
+        ]
+        self.cluster._client = FakeRapiClient(self.instances)
+        self.cluster.refresh_instances()
+        cache.set(
+            'cluster:changes.example.com:lockednodegroups:nodes', ['node9']
+        )
+        self.client = Client()
+        self.client.login(username='owner', password='secret')
+
+    def tearDown(self):
+        self.views.Pool = Pool
+
+    def changes(self, since=None):
+        params = {} if since is None else {'since': since}
+        res = self.client.get(
+            reverse('user-instances-changes-json'), params
+        )
+        self.assertEqual(res.status_code, 200)
+        return json.loads(''.join(res.streaming_content))
+
+    def test_since(self):
+        response = self.changes()
+        self.assertEqual(response['reset'], ['changes'])
+        self.assertEqual(
+            sorted(row['name'] for row in response['changed']),
+            ['a.example.com', 'b.example.com']
+        )
+
+        # nothing changed
+        version = response['version']
+        response = self.changes(version)
+        self.assertEqual(response['version'], version)
+        self.assertEqual(
+            (response['reset'], response['changed'], response['removed']),
+            ([], [], [])
+        )
+
+        # b changes, a is given away, c is not listed to the user
+        self.instances[1].update({'mtime': 2, 'status': 'ADMIN_down'})
+        self.instances[0].update({'mtime': 2, 'tags': []})
+        self.instances[2].update({'mtime': 2})
+        self.cluster.refresh_instances()
+        response = self.changes(version)
+        self.assertNotEqual(response['version'], version)
+        self.assertEqual(response['reset'], [])
+        self.assertEqual(
+            [row['name'] for row in response['changed']], ['b.example.com']
+        )
+        # changed instances the user does not see are removed, whether
+        # they were listed before or not
+        self.assertEqual(response['removed'], [
+            {'cluster': 'changes', 'name': 'a.example.com'},
+            {'cluster': 'changes', 'name': 'c.example.com'},
+        ])
+
+    def test_reset(self):
+        version = self.changes()['version']
+        # the changelog is gone, e.g. evicted
+        cache.delete('cluster:changes.example.com:instances:changes')
+        response = self.changes(version)
+        self.assertEqual(response['reset'], ['changes'])
+        self.assertEqual(len(response['changed']), 2)
+        # malformed versions are caught up with from scratch as well
+        self.assertEqual(self.changes('bogus')['reset'], ['changes'])
+
+    def test_unreachable(self):
+        version = self.changes()['version']
+        # nothing listens on port 1, so RAPI requests fail right away
+        Cluster.objects.create(hostname='127.0.0.1', slug='down', port=1)
+        response = self.changes(version)
+        self.assertEqual(response['unreachable'], ['down'])
+        self.assertEqual(response['reset'], [])
+        # left out of the version, so that it is reset on the next call
+        self.assertEqual(response['version'], version)
+
+    def test_failing_cluster(self):
+        version = self.changes()['version']
+        Cluster.objects.create(hostname='broken.example.com', slug='broken')
+        get_instance_changes = Cluster.get_instance_changes
+
+        def failing(cluster, since):
+            if cluster.slug == 'broken':
+                raise RuntimeError("cache unavailable")
+            return get_instance_changes(cluster, since)
+        Cluster.get_instance_changes = failing
+        try:
+            response = self.changes(version)
+        finally:
+            Cluster.get_instance_changes = get_instance_changes
+        self.assertEqual(response['unreachable'], ['broken'])
+        self.assertEqual(response['version'], version)
@@ -29,5 +29,6 @@ urlpatterns = [
     url(r'^instance/destreinst/(?P<application_hash>\w+)/(?P<action_id>\d+)/$', views.reinstalldestreview, name='reinstall-destroy-review'),
     url(r'^detail/$', views.clusterdetails, name="clusterdetails"),
     url(r'^detail/json/$', views.clusterdetails_json, name="clusterdetails_json"),
+    url(r'^rapi/stats/json/$', views.rapi_stats_json, name="rapi-stats-json"),
 
 ]
@@ -23,7 +23,9 @@ urlpatterns = [
     url(r'^list/$', views.list_user_instances, name='instances-list'),
     url(r'^tags/(?P<instance>[^/]+)?$', views.tagInstance, name="instance-tags"),
     url(r'^json/$', views.user_index_json, name="user-instances-json"),
+    url(r'^json/changes/$', views.user_index_changes_json, name="user-instances-changes-json"),
     url(r'^stats/json/$', views.user_sum_stats, name="user-stats-json"),
+    url(r'^poll/$', views.poll_many, name="instances-poll"),
     url(r'^lock/(?P<instance>[^/]+)?$', views.lock, name="lock"),
     url(r'^isolate/(?P<instance>[^/]+)?$', views.isolate, name="isolate"),
     url(r'^(?P<cluster_slug>[^/]+)/(?P<instance>[^/]+)/poll/?$', views.poll, name="instance-poll"),
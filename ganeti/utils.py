@@ -1,4 +1,5 @@
 import re
+import hashlib
 import requests
 from requests.exceptions import RequestException
 from bs4 import BeautifulSoup
@@ -6,22 +7,53 @@ import json
 from gevent.pool import Pool
 
 from django.conf import settings
-from django.core.urlresolvers import reverse
-from django.core.cache import cache
+from django.core.urlresolvers import (
+    NoReverseMatch,
+    get_resolver,
+    get_script_prefix,
+    get_urlconf,
+    reverse,
+)
 from django.core.mail import send_mail
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import User, Group
 from django.db import close_old_connections
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.template.defaultfilters import filesizeformat
 from django.template.loader import render_to_string
+from django.utils.encoding import force_text
+from django.utils.http import RFC3986_SUBDELIMS, urlquote
 from django.utils.translation import ugettext as _
-from ganeti.models import Cluster, Instance, InstanceAction
+from ganeti.caching import (
+    bump_generation,
+    cache,
+    generation,
+    get_lookup_tables,
+)
+from ganeti.models import (
+    Cluster,
+    Instance,
+    InstanceAction,
+    LOOKUP_TABLES,
+    parseQuery,
+)
 
-from util.client import GanetiApiError
+from util.client import GanetiApiError, SendMany
 
 IMAGES_URL = getattr(settings, "IMAGES_URL", tuple())
 IMG_META_SFX = getattr(settings, "IMG_META_SFX", ".meta")
+# Bytes of encoded JSON buffered before a chunk is sent to the client
+JSON_CHUNK_SIZE = 64 * 1024
+# Stands for the parameters of a route while it is resolved into a template.
+# It has to match the patterns of the parameters, so it is kept to \w.
+URL_TEMPLATE_SENTINEL = 'urltemplate%dsentinel'
+URL_SAFE_CHARS = RFC3986_SUBDELIMS + '/~:@'
+
+_url_templates = {}
+# Seconds the row of an instance is cached for. The key of the row changes
+# along with the instance, so this only bounds the memory they take.
+INSTANCE_FRAGMENT_TTL = 3600
 
 
 def memsize(value):
@@ -32,6 +64,157 @@ def disksizes(value):
     return [filesizeformat(v * 1024 ** 2) for v in value]
 
 
+def _json_tokens(obj):
+    if isinstance(obj, dict):
+        yield '{'
+        for (n, (key, value)) in enumerate(obj.iteritems()):
+            yield '%s%s: ' % (', ' if n else '', json.dumps(key))
+            for token in _json_tokens(value):
+                yield token
+        yield '}'
+    elif (
+        hasattr(obj, '__iter__') and
+        not isinstance(obj, (list, tuple, basestring))
+    ):
+        yield '['
+        for (n, item) in enumerate(obj):
+            if n:
+                yield ', '
+            for token in _json_tokens(item):
+                yield token
+        yield ']'
+    else:
+        yield json.dumps(obj)
+
+
+def stream_json(obj, chunk_size=JSON_CHUNK_SIZE):
+    '''
+    Encodes obj as JSON in chunks. Generators, querysets and other iterables
+    that are not lists are encoded as arrays item by item, so that they are
+    serialized as they are produced instead of all at once.
+    '''
+    chunk = []
+    size = 0
+    for token in _json_tokens(obj):
+        chunk.append(token)
+        size += len(token)
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+class StreamingJsonResponse(StreamingHttpResponse):
+    '''
+    A JSON response whose content is encoded by stream_json while it is
+    sent. Messages must be added before the response is returned, since the
+    content is only produced after the middleware has run.
+    '''
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super(StreamingJsonResponse, self).__init__(
+            stream_json(data), **kwargs
+        )
+
+
+def _url_route(viewname, args, kwargs):
+    '''
+    Returns the route reverse picks for the given parameters, as the format
+    string of its unquoted path, the names of its parameters and the
+    pattern the path has to match, or None if it cannot be told apart.
+    '''
+    if ':' in viewname:
+        # namespaced routes are looked up through their resolvers
+        return None
+    prefix = get_script_prefix()
+    resolver = get_resolver(get_urlconf())
+    for (possibility, pattern, defaults) in (
+        resolver.reverse_dict.getlist(viewname)
+    ):
+        if defaults:
+            return None
+        for (result, params) in possibility:
+            if args:
+                if len(args) != len(params):
+                    continue
+                subs = dict(zip(params, args))
+            elif set(kwargs) == set(params):
+                subs = kwargs
+            else:
+                continue
+            path = prefix.replace('%', '%%') + result
+            regex = re.compile(
+                '^%s%s' % (re.escape(prefix), pattern), re.UNICODE
+            )
+            if regex.search(path % subs):
+                return (path, params, regex)
+    return None
+
+
+def _url_template(viewname, nargs, kwnames):
+    key = (get_urlconf(), get_script_prefix(), viewname, nargs, kwnames)
+    try:
+        return _url_templates[key]
+    except KeyError:
+        pass
+    sentinels = [
+        URL_TEMPLATE_SENTINEL % n for n in range(nargs + len(kwnames))
+    ]
+    args = sentinels[:nargs]
+    kwargs = dict(zip(kwnames, sentinels[nargs:]))
+    try:
+        url = reverse(viewname, args=args or None, kwargs=kwargs or None)
+    except NoReverseMatch:
+        url = None
+    entry = None
+    if url is not None and all(url.count(s) == 1 for s in sentinels):
+        route = _url_route(viewname, args, kwargs)
+        if route is not None:
+            template = url.replace('{', '{{').replace('}', '}}')
+            for (n, sentinel) in enumerate(sentinels):
+                template = template.replace(sentinel, '{%d}' % n)
+            entry = (template,) + route
+    _url_templates[key] = entry
+    return entry
+
+
+def cached_reverse(viewname, args=None, kwargs=None):
+    '''
+    Same as reverse, except that each route is resolved once into a format
+    string, which is then filled in with the quoted parameters. The
+    parameters are checked against the pattern of the route like reverse
+    does, and reverse is left to handle the ones that do not match, as
+    well as the routes that cannot be resolved with placeholder parameters.
+    '''
+    args = tuple(args or ())
+    kwnames = tuple(sorted(kwargs)) if kwargs else ()
+    entry = None
+    if isinstance(viewname, basestring):
+        entry = _url_template(viewname, len(args), kwnames)
+    if entry is None:
+        return reverse(viewname, args=args or None, kwargs=kwargs)
+    (template, path, params, regex) = entry
+    values = [
+        force_text(value)
+        for value in args + tuple(kwargs[name] for name in kwnames)
+    ]
+    if args:
+        subs = dict(zip(params, values))
+    else:
+        subs = dict(zip(kwnames, values))
+    if not regex.search(path % subs):
+        return reverse(viewname, args=args or None, kwargs=kwargs)
+    url = template.format(*[
+        urlquote(value, safe=URL_SAFE_CHARS) for value in values
+    ])
+    if url.startswith('//'):
+        # reverse escapes scheme relative URLs
+        return reverse(viewname, args=args or None, kwargs=kwargs)
+    return url
+
+
 def build_instance_list(instances, tag=None):
     if tag:
         result = []
@@ -70,14 +253,14 @@ def get_user_instances(user, admin=True, tag=None):
 
 
 def get_instance_data(instance, cluster, node=None):
-    instance.cpu_url = reverse(
+    instance.cpu_url = cached_reverse(
         'graph',
         args=(cluster.slug, instance.name, 'cpu-ts')
     )
     instance.net_url = []
     for (nic_i, link) in enumerate(instance.nic_links):
         instance.net_url.append(
-            reverse(
+            cached_reverse(
                 'graph',
                 args=(
                     cluster.slug,
@@ -113,46 +296,204 @@ def get_nodes_with_graphs(cluster_slug, nodes=None):
 
 
 def prepare_clusternodes(cluster=None):
+    '''
+    Returns the nodes of all enabled clusters, or of the given one, along
+    with the clusters that could not be reached and the offline nodes.
+    Nodes are served from the cache; the clusters that have none cached
+    are queried through a single batch of concurrent RAPI requests.
+    '''
     if not cluster:
         # get only enabled clusters
         clusters = Cluster.objects.filter(disabled=False)
     else:
         clusters = Cluster.objects.filter(slug=cluster.slug)
-    p = Pool(15)
+    clusters = list(clusters)
+    close_old_connections()
     nodes = []
     bad_clusters = []
     bad_nodes = []
 
-    def _get_nodes(cluster):
+    cached = cache.get_many([
+        "cluster:{0}:nodes".format(c.hostname) for c in clusters
+    ])
+    missing = [
+        c for c in clusters
+        if "cluster:{0}:nodes".format(c.hostname) not in cached
+    ]
+    fetched = {}
+    responses = SendMany(
+        [c.node_list_request() for c in missing],
+        timeout=settings.RAPI_RESPONSE_TIMEOUT
+    )
+    for c, response in zip(missing, responses):
+        if isinstance(response, Exception):
+            bad_clusters.append(c)
+            continue
         try:
-            for node in cluster.get_cluster_nodes():
-                nodes.append(node)
-                if node['offline'] is True:
-                    bad_nodes.append(node['name'])
-        except (GanetiApiError, Exception):
-            cluster._client = None
-            bad_clusters.append(cluster)
-        finally:
-            close_old_connections()
-    p.map(_get_nodes, clusters)
+            fetched[c.slug] = c.store_nodes(response)
+        except Exception:
+            bad_clusters.append(c)
+
+    for c in clusters:
+        if c in bad_clusters:
+            continue
+        try:
+            if c.slug in fetched:
+                cluster_nodes = fetched[c.slug]
+            else:
+                # may refresh a stale list in the background
+                cluster_nodes = c.get_cluster_nodes()
+        except Exception:
+            bad_clusters.append(c)
+            continue
+        for node in cluster_nodes:
+            nodes.append(node)
+            if node['offline'] is True:
+                bad_nodes.append(node['name'])
     return nodes, bad_clusters, bad_nodes
 
 
-def generate_json(instance, user, locked_nodes):
-    jresp_list = []
+def prepare_job_list(clusters):
+    '''
+    Fetches the jobs of all given clusters through a single batch of
+    concurrent RAPI requests. Unreachable clusters are reported back
+    along with the reason instead of failing the whole batch.
+    '''
+    clusters = list(clusters)
+    jobs = []
+    bad_clusters = []
+    responses = SendMany(
+        [cluster.job_list_request() for cluster in clusters],
+        timeout=settings.RAPI_RESPONSE_TIMEOUT
+    )
+    for cluster, response in zip(clusters, responses):
+        if isinstance(response, GanetiApiError):
+            bad_clusters.append((cluster, format_ganeti_api_error(response)))
+        elif isinstance(response, Exception):
+            bad_clusters.append((cluster, response))
+        else:
+            try:
+                jobs.extend(cluster.format_job_list(response))
+            except Exception as e:
+                bad_clusters.append((cluster, e))
+    return jobs, bad_clusters
+
+
+def instance_status(admin_state, oper_state, status):
+    '''
+    Returns the status of an instance, as shown to users, along with the
+    style of its label.
+    '''
+    if status == 'ERROR_nodedown':
+        return "Generic cluster error", "important"
+    if admin_state == oper_state:
+        if admin_state:
+            return "Running", "success"
+        return "Stopped", "important"
+    label = "Running" if oper_state else "Stopped"
+    if admin_state:
+        return "%s, should be running" % label, "warning"
+    return "%s, should be stopped" % label, "warning"
+
+
+def prepare_instance_status(pairs, user):
+    '''
+    Fetches the status of the given (cluster slug, instance name) pairs
+    through a single batch of concurrent RAPI queries, one per cluster.
+    Returns the status records, in the order given, and the clusters that
+    could not be reached along with the reason. Instances that do not
+    exist or that the user may not see are reported as not found.
+    '''
+    admin = user.is_superuser or user.has_perm('ganeti.view_instances')
+    by_cluster = {}
+    for slug, name in pairs:
+        by_cluster.setdefault(slug, []).append(name)
+    clusters = list(Cluster.objects.filter(
+        disabled=False, slug__in=by_cluster.keys()
+    ))
+
+    queries = []
+    for cluster in clusters:
+        names = by_cluster[cluster.slug]
+        if not admin:
+            owned = cluster.get_user_instance_names(user)
+            names = [name for name in names if name in owned]
+        if names:
+            queries.append((cluster, names))
+
+    bad_clusters = []
+    found = {}
+    responses = SendMany(
+        [cluster.instance_status_request(names) for cluster, names in queries],
+        timeout=settings.RAPI_RESPONSE_TIMEOUT
+    )
+    locked_instances = cache.get('locked_instances') or {}
+    for (cluster, names), response in zip(queries, responses):
+        if isinstance(response, GanetiApiError):
+            bad_clusters.append((cluster, format_ganeti_api_error(response)))
+            continue
+        elif isinstance(response, Exception):
+            bad_clusters.append((cluster, response))
+            continue
+        try:
+            rows = parseQuery(response)
+            locked_nodes = cluster.locked_nodes_from_nodegroup()
+        except Exception as e:
+            bad_clusters.append((cluster, e))
+            continue
+        for row in rows:
+            instance = Instance(cluster, row['name'], row, {})
+            record = {
+                'cluster': cluster.slug,
+                'name': instance.name,
+                'admin_state': instance.admin_state,
+                'oper_state': instance.oper_state,
+                'node_group_locked': instance.pnode in locked_nodes,
+            }
+            record['status'], record['status_style'] = instance_status(
+                instance.admin_state, instance.oper_state, instance.status
+            )
+            if instance.name in locked_instances:
+                record['locked'] = True
+                record['locked_reason'] = "%s" % (
+                    locked_instances[instance.name].capitalize()
+                )
+            found[(cluster.slug, instance.name)] = record
+
+    unreachable = set(cluster.slug for cluster, _ in bad_clusters)
+    records = []
+    for slug, name in pairs:
+        record = found.get((slug, name))
+        if record is None:
+            record = {
+                'cluster': slug,
+                'name': name,
+                'error': (
+                    'unreachable' if slug in unreachable else 'not found'
+                ),
+            }
+        records.append(record)
+    return records, bad_clusters
+
+
+def _instance_json(instance, admin):
+    '''
+    Returns the row of an instance as listed to admins or to its owners,
+    leaving out what changes without the instance itself changing (see
+    _overlay_instance_json).
+    '''
     i = instance
     inst_dict = {}
-    if not i.admin_view_only:
-        inst_dict['name_href'] = "%s" % (
-            reverse(
-                'instance-detail',
-                kwargs={
-                    'cluster_slug': i.cluster.slug, 'instance': i.name
-                }
-            )
+    inst_dict['name_href'] = "%s" % (
+        cached_reverse(
+            'instance-detail',
+            kwargs={
+                'cluster_slug': i.cluster.slug, 'instance': i.name
+            }
         )
+    )
     inst_dict['name'] = i.name
-    if user.is_superuser or user.has_perm('ganeti.view_instances'):
+    if admin:
         inst_dict['cluster'] = i.cluster.slug
         inst_dict['pnode'] = i.pnode
         if i.snodes:
@@ -160,34 +501,19 @@ def generate_json(instance, user, locked_nodes):
     else:
         inst_dict['cluster'] = i.cluster.description
         inst_dict['clusterslug'] = i.cluster.slug
-    inst_dict['node_group_locked'] = i.pnode in locked_nodes
     inst_dict['memory'] = memsize(i.beparams['maxmem'])
     inst_dict['disk'] = ", ".join(disksizes(i.disk_sizes))
+    # raw sizes, in MB, for sorting
+    inst_dict['memory_size'] = i.beparams['maxmem']
+    inst_dict['disk_size'] = sum(i.disk_sizes)
     inst_dict['vcpus'] = i.beparams['vcpus']
     inst_dict['ipaddress'] = [ip for ip in i.nic_ips if ip]
-    if not user.is_superuser and not user.has_perm('ganeti.view_instances'):
+    if not admin:
         inst_dict['ipv6address'] = [ip for ip in i.ipv6s if ip]
     # inst_dict['status'] = i.nic_ips[0] if i.nic_ips[0] else "-"
-    if i.admin_state == i.oper_state:
-        if i.admin_state:
-            inst_dict['status'] = "Running"
-            inst_dict['status_style'] = "success"
-        else:
-            inst_dict['status'] = "Stopped"
-            inst_dict['status_style'] = "important"
-    else:
-        if i.oper_state:
-            inst_dict['status'] = "Running"
-        else:
-            inst_dict['status'] = "Stopped"
-        if i.admin_state:
-            inst_dict['status'] = "%s, should be running" % inst_dict['status']
-        else:
-            inst_dict['status'] = "%s, should be stopped" % inst_dict['status']
-        inst_dict['status_style'] = "warning"
-    if i.status == 'ERROR_nodedown':
-        inst_dict['status'] = "Generic cluster error"
-        inst_dict['status_style'] = "important"
+    inst_dict['status'], inst_dict['status_style'] = instance_status(
+        i.admin_state, i.oper_state, i.status
+    )
 
     if i.adminlock:
         inst_dict['adminlock'] = True
@@ -206,19 +532,11 @@ def generate_json(instance, user, locked_nodes):
             except KeyError:
                 pass
 
-    if i.joblock:
-        inst_dict['locked'] = True
-        inst_dict['locked_reason'] = "%s" % ((i.joblock).capitalize())
-        if inst_dict['locked_reason'] in ['Deleting', 'Renaming']:
-            try:
-                del inst_dict['name_href']
-            except KeyError:
-                pass
     if 'cdrom_image_path' in i.hvparams.keys():
         if i.hvparams['cdrom_image_path'] and i.hvparams['boot_order'] == 'cdrom':
             inst_dict['cdrom'] = True
     inst_dict['nic_macs'] = ', '.join(i.nic_macs)
-    if user.is_superuser or user.has_perm('ganeti.view_instances'):
+    if admin:
         inst_dict['nic_links'] = ', '.join(i.nic_links)
         inst_dict['network'] = []
         for (nic_i, link) in enumerate(i.nic_links):
@@ -233,7 +551,7 @@ def generate_json(instance, user, locked_nodes):
                 'user': user_item.username,
                 'email': user_item.email,
                 'user_href': "%s" % (
-                    reverse(
+                    cached_reverse(
                         "user-info",
                         kwargs={
                             'type': 'user',
@@ -249,7 +567,7 @@ def generate_json(instance, user, locked_nodes):
                     "%s,%s" % (u.username, u.email) for u in group.userset
                 ],
                 'group_href':"%s" % (
-                    reverse(
+                    cached_reverse(
                         "user-info",
                         kwargs={
                             'type': 'group',
@@ -259,41 +577,341 @@ def generate_json(instance, user, locked_nodes):
                 )
             } for group in i.groups
         ]
-    jresp_list.append(inst_dict)
-    return jresp_list
+    return inst_dict
 
 
-def generate_json_light(instance, user):
-    jresp_list = []
+def _overlay_instance_json(inst_dict, instance, locked_nodes):
+    '''
+    Returns a copy of a shared instance row with the locks of the instance
+    and of its node group applied.
+    '''
     i = instance
-    inst_dict = {}
-    if not i.admin_view_only:
-        inst_dict['name_href'] = "%s" % (
-            reverse(
-                "instance-detail",
-                kwargs={
-                    'cluster_slug': i.cluster.slug,
-                    'instance': i.name
-                }
-            )
+    inst_dict = dict(inst_dict)
+    if i.admin_view_only:
+        inst_dict.pop('name_href', None)
+    inst_dict['node_group_locked'] = i.pnode in locked_nodes
+    if i.joblock:
+        inst_dict['locked'] = True
+        inst_dict['locked_reason'] = "%s" % ((i.joblock).capitalize())
+        if inst_dict['locked_reason'] in ['Deleting', 'Renaming']:
+            inst_dict.pop('name_href', None)
+    return inst_dict
+
+
+def generate_json(instance, user, locked_nodes):
+    admin = user.is_superuser or user.has_perm('ganeti.view_instances')
+    return [
+        _overlay_instance_json(
+            _instance_json(instance, admin), instance, locked_nodes
         )
-    inst_dict['name'] = i.name
-    inst_dict['clusterslug'] = i.cluster.slug
-    inst_dict['memory'] = i.beparams['maxmem']
-    inst_dict['vcpus'] = i.beparams['vcpus']
-    inst_dict['disk'] = sum(i.disk_sizes)
-    if user.is_superuser or user.has_perm('ganeti.view_instances'):
-        inst_dict['users'] = [
-            {
-                'user': user_item.username
-            } for user_item in i.users
+    ]
+
+
+def instance_lookup_version():
+    '''
+    Returns the version of the users and groups listed in instance rows,
+    and of the networks their IPv6 addresses are derived from.
+    '''
+    tables = [
+        LOOKUP_TABLES['users'],
+        LOOKUP_TABLES['groups'],
+        LOOKUP_TABLES['networks'],
+    ]
+    # building an expired table bumps its version, so that happens first
+    get_lookup_tables(tables)
+    return generation(*[table.key for table in tables])
+
+
+def instance_list_version(lookup_version, serials):
+    '''
+    Returns the version token of an instance list, made of the version of
+    the lookup tables its rows were built with and of the serials of the
+    instance lists of its clusters, by slug.
+    '''
+    return "%s|%s" % (
+        lookup_version,
+        ",".join(
+            "%s:%s" % (slug, serial)
+            for (slug, serial) in sorted(serials.items())
+        )
+    )
+
+
+def parse_instance_list_version(token):
+    '''
+    The reverse of instance_list_version. Malformed tokens parse as an
+    empty version.
+    '''
+    try:
+        lookup_version, clusters = token.split('|', 1)
+        serials = {}
+        for cluster in filter(None, clusters.split(',')):
+            slug, serial = cluster.rsplit(':', 1)
+            serials[slug] = int(serial)
+        return lookup_version, serials
+    except ValueError:
+        return None, {}
+
+
+def instance_fragment_key(instance, view, lookup_version):
+    '''
+    Returns the cache key of the row of an instance as listed in the given
+    view, "admin" or "owner". The key changes along with the instance, with
+    the description of its cluster and with the users and groups it refers
+    to.
+    '''
+    return "fragment:instance:%s:%s:%s:%s:%s:%s" % (
+        instance.cluster.slug,
+        instance.name,
+        instance.version,
+        hashlib.md5(
+            force_text(instance.cluster.description or '').encode('utf-8')
+        ).hexdigest()[:8],
+        lookup_version,
+        view
+    )
+
+
+def generate_json_many(instances, user, locked_nodes):
+    '''
+    Returns the rows of the given instances as listed to a user, along with
+    the (instance, error) pairs of the instances that failed.
+
+    The rows are cached per instance and shared by all admins, or by all
+    owners of the instance, so that they are only rebuilt when the instance
+    changes.
+    '''
+    admin = user.is_superuser or user.has_perm('ganeti.view_instances')
+    view = 'admin' if admin else 'owner'
+    lookup_version = instance_lookup_version()
+    keys = [instance_fragment_key(i, view, lookup_version) for i in instances]
+    fragments = cache.get_many(keys)
+    missing = {}
+    rows = []
+    failed = []
+    for (key, instance) in zip(keys, instances):
+        try:
+            fragment = fragments.get(key)
+            if fragment is None:
+                fragment = missing[key] = _instance_json(instance, admin)
+            rows.append(
+                _overlay_instance_json(fragment, instance, locked_nodes)
+            )
+        except Exception as e:
+            failed.append((instance, e))
+    if missing:
+        cache.set_many(missing, INSTANCE_FRAGMENT_TTL)
+    return rows, failed
+
+
+# Labels of the instance flags, as shown in the status column, so that
+# e.g. searching for 'Needs Reboot' matches the flagged instances
+INSTANCE_FLAG_LABELS = (
+    ('adminlock', 'admin lock'),
+    ('isolate', 'isolated'),
+    ('needsreboot', 'needs reboot'),
+    ('cdrom', 'cdrom'),
+    ('node_group_locked', 'locked'),
+)
+INSTANCE_SEARCH_FIELDS = (
+    'name', 'cluster', 'pnode', 'memory', 'disk', 'vcpus', 'status',
+    'ipaddress', 'nic_macs', 'network', 'users',
+)
+INSTANCE_SORT_FIELDS = (
+    'name', 'cluster', 'pnode', 'memory', 'disk', 'vcpus', 'status',
+    'ipaddress', 'network', 'users',
+)
+INSTANCE_SORT_KEYS = {
+    'memory': lambda row: row.get('memory_size', 0),
+    'disk': lambda row: row.get('disk_size', 0),
+    'vcpus': lambda row: row.get('vcpus', 0),
+}
+
+
+def instance_row_text(row, field):
+    '''
+    Returns the lowercase text of a field of a generate_json row, as it is
+    matched by searches.
+    '''
+    if field == 'users':
+        value = [
+            '%s %s' % (u['user'], u['email']) for u in row.get('users', [])
+        ]
+        for group in row.get('groups', []):
+            value.append(group['group'])
+            value.extend(group['groupusers'])
+    elif field == 'ipaddress':
+        value = row.get('ipaddress', []) + row.get('ipv6address', [])
+    elif field == 'status':
+        value = [row.get('status', ''), row.get('locked_reason', '')] + [
+            label for (flag, label) in INSTANCE_FLAG_LABELS if row.get(flag)
         ]
-    jresp_list.append(inst_dict)
-    return jresp_list
+    else:
+        value = row.get(field, '')
+    if isinstance(value, list):
+        value = ' '.join(value)
+    return (u'%s' % value).lower()
+
+
+def _instance_order(rows, field):
+    key = INSTANCE_SORT_KEYS.get(field)
+    if key is None:
+        key = lambda row: instance_row_text(row, field)
+    return sorted(
+        range(len(rows)),
+        key=lambda pos: (key(rows[pos]), rows[pos]['name'])
+    )
+
+
+def build_instance_index(rows):
+    '''
+    Builds the cached index of the instance list of a user, that is the
+    generate_json rows along with their search text and their order by each
+    sortable column, so that a page of the list is served without sorting
+    or rendering the rows again. needsreboot tells whether any of the
+    instances needs a reboot, whether it is on the page shown or not.
+    '''
+    return {
+        'aaData': rows,
+        'needsreboot': any(row.get('needsreboot') for row in rows),
+        'search': [
+            '\n'.join(
+                instance_row_text(row, field)
+                for field in INSTANCE_SEARCH_FIELDS
+            ) for row in rows
+        ],
+        'order': dict(
+            (field, _instance_order(rows, field))
+            for field in INSTANCE_SORT_FIELDS
+        ),
+    }
+
+
+def _int_param(params, name, default=0):
+    try:
+        return int(params.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _datatables_params(params):
+    '''
+    Normalizes the server-side processing parameters of DataTables, both the
+    legacy (1.9) and the current (1.10+) ones.
+    '''
+    if 'draw' in params:
+        columns = []
+        while 'columns[%d][data]' % len(columns) in params:
+            columns.append(len(columns))
+        sort_column = _int_param(params, 'order[0][column]', -1)
+        return {
+            'start': _int_param(params, 'start'),
+            'length': _int_param(params, 'length', -1),
+            'search': params.get('search[value]', ''),
+            'sort': params.get('columns[%d][data]' % sort_column),
+            'descending': params.get('order[0][dir]') == 'desc',
+            'columns': [
+                (
+                    params.get('columns[%d][data]' % c),
+                    params.get('columns[%d][search][value]' % c, '')
+                ) for c in columns
+            ],
+        }
+    sort_column = _int_param(params, 'iSortCol_0', -1)
+    return {
+        'start': _int_param(params, 'iDisplayStart'),
+        'length': _int_param(params, 'iDisplayLength', -1),
+        'search': params.get('sSearch', ''),
+        'sort': params.get('mDataProp_%d' % sort_column),
+        'descending': params.get('sSortDir_0') == 'desc',
+        'columns': [
+            (params.get('mDataProp_%d' % c), params.get('sSearch_%d' % c, ''))
+            for c in range(_int_param(params, 'iColumns'))
+        ],
+    }
+
+
+def instance_index_page(index, params):
+    '''
+    Returns the DataTables server-side processing response for the page of
+    an instance index (see build_instance_index) that the request parameters
+    ask for.
+    '''
+    query = _datatables_params(params)
+    rows = index['aaData']
+    field = query['sort'] if query['sort'] in INSTANCE_SORT_FIELDS else 'name'
+    order = index['order'].get(field)
+    if order is None:
+        order = _instance_order(rows, field)
+    if query['descending']:
+        order = order[::-1]
+
+    words = query['search'].lower().split()
+    columns = [
+        (column, value.lower()) for (column, value) in query['columns']
+        if column and value
+    ]
+    if words or columns:
+        search = index['search']
+        order = [
+            pos for pos in order
+            if all(word in search[pos] for word in words) and all(
+                value in instance_row_text(rows[pos], column)
+                for (column, value) in columns
+            )
+        ]
+
+    start = max(query['start'], 0)
+    if query['length'] < 0:
+        page = order[start:]
+    else:
+        page = order[start:start + query['length']]
+    data = [rows[pos] for pos in page]
+    if 'draw' in params:
+        return {
+            'draw': _int_param(params, 'draw'),
+            'recordsTotal': len(rows),
+            'recordsFiltered': len(order),
+            'data': data,
+            'needsreboot': index['needsreboot'],
+        }
+    return {
+        'sEcho': _int_param(params, 'sEcho'),
+        'iTotalRecords': len(rows),
+        'iTotalDisplayRecords': len(order),
+        'aaData': data,
+        'needsreboot': index['needsreboot'],
+    }
+
+
+def user_instances_cache_key(username, cluster_slug=None):
+    '''
+    Returns the cache key of the index (see build_instance_index) of the
+    instances listed to a user, for all clusters or for the given one. The
+    key changes whenever the listed clusters are invalidated by
+    invalidate_cluster_users_cache.
+    '''
+    if cluster_slug:
+        return "user:%s:%s:instance-index:%s" % (
+            username,
+            cluster_slug,
+            generation('global', 'cluster:%s' % cluster_slug)
+        )
+    return "user:%s:index:instance-index:%s" % (
+        username,
+        generation('global', 'clusters')
+    )
+
+
+def invalidate_cluster_users_cache(cluster_slug):
+    '''
+    Invalidates the cached instance lists of all users for a cluster.
+    '''
+    bump_generation('cluster:%s' % cluster_slug, 'clusters')
 
 
 def clear_cluster_user_cache(username, cluster_slug):
-    cache.delete("user:%s:index:instances" % username)
+    cache.delete(user_instances_cache_key(username))
     cache.delete("cluster:%s:instances" % cluster_slug)
 
 
@@ -437,8 +1055,7 @@ def get_os_details(img_id):
 
 def refresh_cluster_cache(cluster, instance):
     cluster.force_cluster_cache_refresh(instance)
-    for u in User.objects.all():
-        cache.delete("user:%s:index:instances" % u.username)
+    invalidate_cluster_users_cache(cluster.slug)
     nodes, bc, bn = prepare_clusternodes()
     cache.set('allclusternodes', nodes, 180)
     cache.set('badclusters', bc, 180)
@@ -24,8 +24,9 @@ from clusters import *
 from discovery import *
 from nodegroup import *
 
+from ganeti.models import LOOKUP_TABLES
 from ganeti.utils import prepare_tags
-from django.core.cache import cache
+from ganeti.caching import cache
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User, Group
 from django.contrib import messages
@@ -90,27 +91,15 @@ def clear_cache(request):
         'ganeti.view_instances'
     ):
         username = request.user.username
-        keys_pattern = [
-            "user:%s:index:*" % username,
-            "cluster:*",
-            "pendingapplications",
-            "%s:ajax*" % username,
-            "user:%s:index:instances" % username,
-            "user:%s:index:instance:light" % username,
-            "user:%s:index:users:instance:stats" % username,
-            '%s:ajaxapplist' % username,
-            '%s:ajaxinstances' % username,
-            "allclusternodes",
-            "bad*",
-            "len*",
-            "locked_instances",
-            "*list",
-            "operating_systems",
-        ]
-        for key in keys_pattern:
-            if key in cache:
-                cache.delete(key)
-        result = {'result': "Success"}
+        dropped = (
+            cache.invalidate('user', shard=username) +
+            cache.invalidate('ajax', shard=username) +
+            cache.invalidate('cluster') +
+            cache.invalidate('lists')
+        )
+        for table in LOOKUP_TABLES.values():
+            table.invalidate()
+        result = {'result': "Success", 'dropped': dropped}
     else:
         result = {'error': "Violation"}
     return HttpResponse(json.dumps(result), content_type='application/json')
@@ -26,10 +26,11 @@ from django.core.urlresolvers import reverse
 from django.contrib.messages import constants as msgs
 from django.contrib import messages
 from django.contrib.auth.models import User
-from django.core.cache import cache
+from ganeti.caching import cache
 from django.core.exceptions import PermissionDenied
 from django.shortcuts import get_object_or_404
 from django.http import (
+    JsonResponse,
     HttpResponse,
     HttpResponseRedirect,
     HttpResponseServerError,
@@ -50,8 +51,14 @@ from django.template.loader import render_to_string
 from ganeti.utils import (
     prepare_clusternodes,
     clusterdetails_generator,
+    StreamingJsonResponse,
+)
+from ganeti.models import (
+    Cluster,
+    InstanceAction,
+    Instance,
+    rapi_connection_stats,
 )
-from ganeti.models import Cluster, InstanceAction, Instance
 
 
 def mail_unauthorized_action(action, instance, user):
@@ -68,8 +75,6 @@ def clusternodes_json(request, cluster=None):
         request.user.is_superuser or
         request.user.has_perm('ganeti.view_instances')
     ):
-        nodedetails = []
-        jresp = {}
         nodes = []
         bad_clusters = []
         bad_nodes = []
@@ -94,31 +99,31 @@ def clusternodes_json(request, cluster=None):
                 "Some nodes appear to be offline: " +
                 ", ".join(bad_nodes)
             )
-        for node in nodes:
-            if (not cluster or
-                    (cluster and node['cluster'] == cluster.hostname)):
-                node_dict = {}
-                node_dict['name'] = node['name']
-                # node_dict['node_group'] = node['node_group']
-                node_dict['mem_used'] = node['mem_used']
-                node_dict['mfree'] = node['mfree']
-                node_dict['mtotal'] = node['mtotal']
-                node_dict['shared_storage'] = node['shared_storage']
-                node_dict['disk_used'] = node['disk_used']
-                node_dict['dfree'] = node['dfree']
-                node_dict['dtotal'] = node['dtotal']
-                node_dict['ctotal'] = node['ctotal']
-                node_dict['pinst_cnt'] = node['pinst_cnt']
-                node_dict['pinst_list'] = node['pinst_list']
-                node_dict['role'] = node['role']
-                if cluster:
-                    node_dict['cluster'] = cluster.hostname
-                else:
-                    node_dict['cluster'] = node['cluster']
-                nodedetails.append(node_dict)
-        jresp['aaData'] = nodedetails
-        res = jresp
-        return HttpResponse(json.dumps(res), content_type='application/json')
+
+        def _node_details():
+            for node in nodes:
+                if (not cluster or
+                        (cluster and node['cluster'] == cluster.hostname)):
+                    node_dict = {}
+                    node_dict['name'] = node['name']
+                    # node_dict['node_group'] = node['node_group']
+                    node_dict['mem_used'] = node['mem_used']
+                    node_dict['mfree'] = node['mfree']
+                    node_dict['mtotal'] = node['mtotal']
+                    node_dict['shared_storage'] = node['shared_storage']
+                    node_dict['disk_used'] = node['disk_used']
+                    node_dict['dfree'] = node['dfree']
+                    node_dict['dtotal'] = node['dtotal']
+                    node_dict['ctotal'] = node['ctotal']
+                    node_dict['pinst_cnt'] = node['pinst_cnt']
+                    node_dict['pinst_list'] = node['pinst_list']
+                    node_dict['role'] = node['role']
+                    if cluster:
+                        node_dict['cluster'] = cluster.hostname
+                    else:
+                        node_dict['cluster'] = node['cluster']
+                    yield node_dict
+        return StreamingJsonResponse({'aaData': _node_details()})
     else:
         raise PermissionDenied
 
@@ -407,3 +412,15 @@ def clusterdetails_json(request):
                 content_type='application/json'
             )
     raise PermissionDenied
+
+
+@login_required
+def rapi_stats_json(request):
+    '''
+    Returns the counters of the RAPI connections of the process serving the
+    request, by cluster: requests, created and reused cURL handles and
+    created and reused connections.
+    '''
+    if not request.user.is_superuser:
+        raise PermissionDenied
+    return JsonResponse(rapi_connection_stats())
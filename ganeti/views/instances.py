@@ -22,7 +22,7 @@ from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.messages import constants as msgs
 from django.contrib import messages as djmessages
 from django.core.urlresolvers import reverse
-from django.core.cache import cache
+from ganeti.caching import cache
 from django.conf import settings
 from django.db import close_old_connections
 from django.http import HttpResponseRedirect, HttpResponse, Http404, HttpResponseForbidden
@@ -42,13 +42,21 @@ from auditlog.utils import auditlog_entry
 from util.client import GanetiApiError
 
 from ganeti.utils import (
-    generate_json,
-    generate_json_light,
+    build_instance_index,
+    cached_reverse,
+    generate_json_many,
     clear_cluster_user_cache,
+    user_instances_cache_key,
     notifyuseradvancedactions,
     get_os_details,
     get_user_instances,
     format_ganeti_api_error,
+    instance_index_page,
+    instance_list_version,
+    instance_lookup_version,
+    parse_instance_list_version,
+    prepare_instance_status,
+    StreamingJsonResponse,
 )
 
 from ganeti.forms import (
@@ -65,6 +73,9 @@ from ganeti.decorators import (
     check_instance_readonly,
 )
 
+# Instances polled at most in one request
+INSTANCE_POLL_MAX = 500
+
 
 def user_index(request):
     if request.user.is_anonymous():
@@ -117,6 +128,19 @@ else:
         raise NotImplementedError('Please install oauth2_toolkit. For more details take a look at admin section of the docs.')
 
 
+def _set_job_locks(instances):
+    '''Marks the given instances that have jobs pending'''
+    locked_instances = cache.get('locked_instances')
+    for instance in instances:
+        if (
+            locked_instances is not None and
+            instance.name in locked_instances
+        ):
+            instance.joblock = locked_instances['%s' % instance.name]
+        else:
+            instance.joblock = False
+
+
 @login_required
 def user_index_json(request):
     cluster_slug = request.GET.get('cluster', None)
@@ -148,34 +172,19 @@ def user_index_json(request):
                 bad_clusters.append((cluster, e))
             finally:
                 close_old_connections()
-    jresp = {}
-    cache_key = "user:%s:index:instances" % request.user.username
-    if cluster_slug:
-        cache_key = "user:%s:%s:instances" % (
-            request.user.username,
-            cluster_slug
-        )
+    cache_key = user_instances_cache_key(request.user.username, cluster_slug)
     res = cache.get(cache_key)
-    instancedetails = []
-    j = Pool(80)
-    locked_instances = cache.get('locked_instances')
 
-    def _get_instance_details(instance):
-        try:
-            if (
-                locked_instances is not None and
-                instance.name in locked_instances
-            ):
-                instance.joblock = locked_instances['%s' % instance.name]
-            else:
-                instance.joblock = False
-            instancedetails.extend(generate_json(instance, request.user, locked_nodes))
-        except GanetiApiError as e:
-            bad_clusters.append((instance.cluster, format_ganeti_api_error(e)))
-        except Exception as e:
-                bad_clusters.append((instance.cluster, e))
-        finally:
-            close_old_connections()
+    def _get_instance_details():
+        _set_job_locks(instances)
+        rows, failed = generate_json_many(
+            instances, request.user, locked_nodes
+        )
+        for (instance, e) in failed:
+            if isinstance(e, GanetiApiError):
+                e = format_ganeti_api_error(e)
+            bad_clusters.append((instance.cluster, e))
+        return rows
     if res is None:
         if not request.user.is_anonymous():
             if cluster_slug:
@@ -218,7 +227,7 @@ def user_index_json(request):
                 pass
 
             cache_timeout = 30
-        j.map(_get_instance_details, instances)
+        instancedetails = _get_instance_details()
         if locked_clusters:
             djmessages.add_message(
                 request,
@@ -236,15 +245,102 @@ def user_index_json(request):
             )
             cache_timeout = 30
 
-        jresp['aaData'] = instancedetails
-        cache.set(cache_key, jresp, cache_timeout)
-        res = jresp
+        res = build_instance_index(instancedetails)
+        cache.set(cache_key, res, cache_timeout)
+
+    # DataTables in server-side processing mode only asks for the page
+    # it shows
+    if 'sEcho' in request.GET or 'draw' in request.GET:
+        return JsonResponse(instance_index_page(res, request.GET))
+    # the rows come whole from the cached index, only their encoding is
+    # streamed
+    return StreamingJsonResponse({
+        'aaData': iter(res['aaData']),
+        'needsreboot': res['needsreboot'],
+    })
 
-    return HttpResponse(json.dumps(res), content_type='application/json')
+
+@login_required
+def user_index_changes_json(request):
+    '''
+    Brings a copy of the instance list of the user up to date. Given the
+    version of the copy in "since", returns the rows of the instances that
+    were added or changed since then, the cluster slugs and names of the
+    ones that were removed, and the current version of the list.
+
+    Clusters listed in "reset" could not be caught up with, so all of their
+    rows are returned and any other rows of theirs are to be dropped.
+    Clusters listed in "unreachable" are left out of the returned version,
+    so they are reset on the next call.
+    '''
+    cluster_slug = request.GET.get('cluster', None)
+    lookup_version = instance_lookup_version()
+    since_lookups, since = parse_instance_list_version(
+        request.GET.get('since', '')
+    )
+    if since_lookups != lookup_version:
+        # the owners of all rows may have changed
+        since = {}
+    clusters = Cluster.objects.filter(disabled=False)
+    if cluster_slug:
+        clusters = clusters.filter(slug=cluster_slug)
+    serials = {}
+    reset = []
+    removed = []
+    instances = []
+    locked_nodes = []
+    unreachable = []
+
+    def _get_changes(cluster):
+        try:
+            serial, changed, gone = cluster.get_instance_changes(
+                since.get(cluster.slug)
+            )
+            locked_nodes.extend(cluster.locked_nodes_from_nodegroup())
+            if changed is None:
+                reset.append(cluster.slug)
+                instances.extend(cluster.get_user_instances(request.user))
+            else:
+                listed = cluster.get_user_instances(
+                    request.user, names=changed
+                )
+                instances.extend(listed)
+                # instances the user no longer sees are removed as well
+                gone.update(changed.difference(i.name for i in listed))
+                removed.extend(
+                    {'cluster': cluster.slug, 'name': name}
+                    for name in sorted(gone)
+                )
+            if serial is not None:
+                serials[cluster.slug] = serial
+        except Exception:
+            unreachable.append(cluster.slug)
+        finally:
+            close_old_connections()
+    Pool(20).map(_get_changes, clusters)
+
+    _set_job_locks(instances)
+    rows, failed = generate_json_many(instances, request.user, locked_nodes)
+    for (instance, e) in failed:
+        # rebuild the rows of the cluster on the next call
+        serials.pop(instance.cluster.slug, None)
+    return StreamingJsonResponse({
+        'version': instance_list_version(lookup_version, serials),
+        'reset': reset,
+        'changed': iter(rows),
+        'removed': removed,
+        'unreachable': unreachable,
+    })
 
 
 @login_required
 def user_sum_stats(request):
+    '''
+    Returns the instance count, vCPUs, memory and disk of the instances of
+    each user (and group, for admins), merged from the totals recorded per
+    cluster whenever its instances are refreshed. Users only see their
+    own totals.
+    '''
     if request.user.is_anonymous():
         action = {
             'error': _(
@@ -253,23 +349,46 @@ def user_sum_stats(request):
             )
         }
         return HttpResponse(json.dumps(action), content_type='application/json')
+    admin = (
+        request.user.is_superuser or
+        request.user.has_perm('ganeti.view_instances')
+    )
+    cache_key_stats = "user:%s:index:users:instance:stats" % \
+        request.user.username
+    instances_stats = cache.get(cache_key_stats)
+    if instances_stats is not None:
+        return HttpResponse(
+            json.dumps(instances_stats),
+            content_type='application/json'
+        )
+
     p = Pool(20)
-    instances = []
+    user_totals = {}
+    group_totals = {}
     bad_clusters = []
 
-    def _get_instances(cluster):
+    def _get_totals(cluster):
         try:
-            instances.extend(cluster.get_user_instances(request.user))
+            if admin:
+                totals = cluster.get_owner_totals()
+                for (user, resources) in totals['users'].iteritems():
+                    add_owner_totals(user_totals, user, resources)
+                for (group, resources) in totals['groups'].iteritems():
+                    add_owner_totals(group_totals, group, resources)
+            else:
+                resources = cluster.get_user_totals(request.user)
+                if resources:
+                    add_owner_totals(
+                        user_totals, request.user.username, resources
+                    )
         except GanetiApiError as e:
             bad_clusters.append((cluster, format_ganeti_api_error(e)))
         except Exception as e:
             bad_clusters.append((cluster, e))
-
         finally:
             close_old_connections()
-    if not request.user.is_anonymous():
-        # get only enabled clusters
-        p.map(_get_instances, Cluster.objects.filter(disabled=False))
+    # get only enabled clusters
+    p.map(_get_totals, Cluster.objects.filter(disabled=False))
 
     if bad_clusters:
         for c in bad_clusters:
@@ -303,77 +422,32 @@ def user_sum_stats(request):
                     )
                 )
 
-    jresp = {}
-    cache_key = "user:%s:index:instance:light" % request.user.username
-    res = cache.get(cache_key)
-    instancedetails = []
-    j = Pool(80)
-    user = request.user
-
-    def _get_instance_details(instance):
-        try:
-            instancedetails.extend(generate_json_light(instance, user))
-        except (GanetiApiError, Exception):
-            pass
-        finally:
-            close_old_connections()
-    if res is None:
-        j.map(_get_instance_details, instances)
-        jresp['aaData'] = instancedetails
-        cache.set(cache_key, jresp, 125)
-        res = jresp
-
-    instances_stats = []
-    user_dict = {}
-    cache_key_stats = "user:%s:index:users:instance:stats" % \
-        request.user.username
-    instances_stats = cache.get(cache_key_stats)
-    if instances_stats is None:
-        for i in res['aaData']:
-            if not 'users' in i:
-                i['users'] = [{'user': request.user.username}]
-            for useritem in i['users']:
-                if not useritem['user'] in user_dict:
-                    user_dict[useritem['user']] = {
-                        'instances': 0,
-                        'disk': 0,
-                        'cpu': 0,
-                        'memory': 0
-                    }
-                user_dict[useritem['user']]['instances'] = user_dict[
-                    useritem['user']
-                ]['instances'] + 1
-                user_dict[useritem['user']]['disk'] = user_dict[
-                    useritem['user']
-                ]['disk'] + int(i['disk'])
-                user_dict[useritem['user']]['cpu'] = user_dict[
-                    useritem['user']
-                ]['cpu'] + int(i['vcpus'])
-                user_dict[useritem['user']]['memory'] = user_dict[
-                    useritem['user']
-                ]['memory'] + int(i['memory'])
-        #TODO: Must implement that in a more efficient way
-        instances_stats_list = []
-        for u in user_dict.keys():
-            user_stats_dict = {}
-            user_stats_dict['user_href'] = '%s' % (
-                reverse(
-                    'user-info',
-                    kwargs={
-                        'type': 'user',
-                        'usergroup': u
-                    }
-                )
+    def _stats(totals, kind, known):
+        stats = []
+        for owner in sorted(totals):
+            # tags may refer to users and groups that do not exist
+            if owner not in known:
+                continue
+            owner_stats = dict(totals[owner])
+            owner_stats['%s_href' % kind] = cached_reverse(
+                'user-info',
+                kwargs={'type': kind, 'usergroup': owner}
             )
-            user_stats_dict['user'] = u
-            user_stats_dict['instances'] = user_dict[u]['instances']
-            user_stats_dict['disk'] = user_dict[u]['disk']
-            user_stats_dict['cpu'] = user_dict[u]['cpu']
-            user_stats_dict['memory'] = user_dict[u]['memory']
-            instances_stats_list.append(user_stats_dict)
-        return_dict = {'aaData': instances_stats_list}
-        cache.set(cache_key_stats, return_dict, 300)
-        instances_stats = return_dict
+            owner_stats[kind] = owner
+            stats.append(owner_stats)
+        return stats
+
+    if admin:
+        tables = preload_instance_data()
+        instances_stats = {
+            'aaData': _stats(user_totals, 'user', tables['users']),
+            'groups': _stats(group_totals, 'group', tables['groups']),
+        }
+    else:
+        instances_stats = {
+            'aaData': _stats(user_totals, 'user', user_totals),
+        }
+    cache.set(cache_key_stats, instances_stats, 300)
     return HttpResponse(
         json.dumps(instances_stats),
         content_type='application/json'
@@ -414,6 +488,26 @@ def poll(request, cluster_slug, instance):
             )
 
 
+@login_required
+def poll_many(request):
+    '''
+    Returns the status of many instances at once, given as "instance"
+    parameters of the form <cluster slug>/<instance name>. Each cluster is
+    queried once for all of its instances.
+    '''
+    params = request.POST if request.method == 'POST' else request.GET
+    pairs = []
+    for param in params.getlist('instance')[:INSTANCE_POLL_MAX]:
+        slug, _, name = param.partition('/')
+        if slug and name:
+            pairs.append((slug, name))
+    records, bad_clusters = prepare_instance_status(pairs, request.user)
+    return JsonResponse({
+        'instances': records,
+        'unreachable': sorted(set(c.slug for c, e in bad_clusters)),
+    })
+
+
 
 
 @login_required
@@ -15,24 +15,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import json
 import pprint
 
-from gevent.pool import Pool
-
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
 from django.contrib import messages as djmessages
-from django.db import close_old_connections
 from django.http import HttpResponseRedirect, HttpResponse, Http404
 from django.shortcuts import render, get_object_or_404
 from django.template.context import RequestContext
 from django.utils.translation import ugettext_lazy as _
 from django.core.exceptions import PermissionDenied
 
-from util.client import GanetiApiError
 from ganeti.models import Cluster
-from ganeti.utils import format_ganeti_api_error
+from ganeti.utils import prepare_job_list, StreamingJsonResponse
 
 
 @login_required
@@ -68,25 +63,14 @@ def jobs_index_json(request):
     ):
         cluster_slug = request.GET.get('cluster', None)
         messages = ""
-        p = Pool(20)
         jobs = []
         bad_clusters = []
-
-        def _get_jobs(cluster):
-            try:
-                jobs.extend(cluster.get_job_list())
-            except GanetiApiError as e:
-                bad_clusters.append((cluster, format_ganeti_api_error(e)))
-            except Exception as e:
-                bad_clusters.append((cluster, e))
-            finally:
-                close_old_connections()
         if not request.user.is_anonymous():
             # get only enabled clusters
             clusters = Cluster.objects.filter(disabled=False)
             if cluster_slug:
                 clusters = clusters.filter(slug=cluster_slug)
-            p.map(_get_jobs, clusters)
+            jobs, bad_clusters = prepare_job_list(clusters)
         if bad_clusters:
             messages = "Some instances may be missing because the" \
                 " following clusters are unreachable: %s" \
@@ -102,7 +86,9 @@ def jobs_index_json(request):
                 )
         jresp = {}
         clusters = list(set([j['cluster'] for j in jobs]))
-        jresp['aaData'] = jobs
+        # the jobs are decoded from the RAPI responses as a whole, only
+        # their encoding is streamed
+        jresp['aaData'] = iter(jobs)
         if messages:
             djmessages.add_message(
                 request,
@@ -110,8 +96,7 @@ def jobs_index_json(request):
                 messages
             )
         jresp['clusters'] = clusters
-        res = jresp
-        return HttpResponse(json.dumps(res), content_type='application/json')
+        return StreamingJsonResponse(jresp)
     else:
         raise PermissionDenied()
 
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*- vim:fileencoding=utf-8:
+# Copyright (C) 2010-2014 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+from random import uniform
+
+from gevent import sleep, spawn
+from gevent.threadpool import ThreadPool
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from ganeti.models import Cluster
+
+# Seconds between two refreshes of the same cluster. Keep it below the
+# lifetime of the cached resources so that they never turn stale.
+WARM_INTERVAL = getattr(settings, 'CACHE_WARM_INTERVAL', 120)
+# Seconds the refreshed resources are considered fresh
+WARM_TTL = getattr(settings, 'CACHE_WARM_TTL', 180)
+# Upper limit of the delay between refreshes of an unreachable cluster
+WARM_MAX_BACKOFF = getattr(settings, 'CACHE_WARM_MAX_BACKOFF', 1800)
+# Fraction of the interval refreshes are randomly spread by
+WARM_JITTER = 0.1
+# Seconds between checks for added or removed clusters
+CLUSTER_RESCAN_INTERVAL = 300
+
+logger = logging.getLogger('refresh_logger')
+
+
+def next_interval(interval, failures=0):
+    '''
+    Returns the seconds to wait before the next refresh of a cluster, after
+    the given number of consecutive failures.
+    '''
+    if failures:
+        interval = min(interval * 2 ** failures, WARM_MAX_BACKOFF)
+    return interval * uniform(1 - WARM_JITTER, 1 + WARM_JITTER)
+
+
+class CacheWarmer(object):
+    '''
+    Keeps the cached resources of every cluster fresh.
+
+    Each cluster is refreshed on its own schedule by a separate greenlet.
+    The RAPI requests themselves block, so they run in a pool of OS threads
+    in order for clusters to be refreshed in parallel.
+    '''
+
+    def __init__(self, clusters=None, interval=WARM_INTERVAL,
+                 seconds=WARM_TTL, workers=10):
+        self.clusters = clusters
+        self.interval = interval
+        self.seconds = seconds
+        self.pool = ThreadPool(workers)
+
+    def fetch_hostnames(self):
+        clusters = Cluster.objects.all()
+        if self.clusters:
+            clusters = clusters.filter(hostname__in=self.clusters)
+        hostnames = list(clusters.values_list('hostname', flat=True))
+        close_old_connections()
+        return hostnames
+
+    def refresh(self, hostname):
+        '''
+        Refreshes the cached resources of a cluster. Returns False if the
+        cluster no longer exists.
+        '''
+        try:
+            cluster = Cluster.objects.get(hostname=hostname)
+        except Cluster.DoesNotExist:
+            return False
+        finally:
+            close_old_connections()
+        self.pool.apply(self._refresh_cache, (cluster,))
+        return True
+
+    def _refresh_cache(self, cluster):
+        # runs in a thread of the pool, which keeps its own DB connection
+        try:
+            cluster.refresh_cache(seconds=self.seconds)
+        finally:
+            close_old_connections()
+
+    def warm(self, hostname):
+        failures = 0
+        while True:
+            try:
+                if not self.refresh(hostname):
+                    logger.info("Cluster %s removed, no longer refreshing" %
+                                hostname)
+                    return
+                if failures:
+                    logger.info("Cluster %s reachable again" % hostname)
+                failures = 0
+            except Exception as err:
+                failures += 1
+                logger.warning(
+                    "Error while refreshing cache for cluster %s"
+                    " (%d consecutive failures): %s" %
+                    (hostname, failures, err)
+                )
+            sleep(next_interval(self.interval, failures))
+
+    def run_once(self):
+        '''
+        Refreshes all clusters in parallel once. Returns the hostnames of
+        the clusters that failed.
+        '''
+        def _refresh(hostname):
+            try:
+                self.refresh(hostname)
+            except Exception as err:
+                logger.warning("Error while refreshing cache for cluster %s:"
+                               " %s" % (hostname, err))
+                return hostname
+
+        greenlets = [spawn(_refresh, h) for h in self.fetch_hostnames()]
+        failed = [g.get() for g in greenlets]
+        return [hostname for hostname in failed if hostname is not None]
+
+    def run(self):
+        '''Refreshes all clusters forever'''
+        greenlets = {}
+        while True:
+            for hostname, greenlet in greenlets.items():
+                if greenlet.dead:
+                    del greenlets[hostname]
+            try:
+                hostnames = self.fetch_hostnames()
+            except Exception as err:
+                logger.error("Unable to list clusters: %s" % err)
+                hostnames = []
+            for hostname in hostnames:
+                if hostname not in greenlets:
+                    logger.info("Refreshing cache for cluster %s every %ds" %
+                                (hostname, self.interval))
+                    greenlets[hostname] = spawn(self.warm, hostname)
+            sleep(CLUSTER_RESCAN_INTERVAL)
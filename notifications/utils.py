@@ -15,7 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 from itertools import chain
-from django.core.cache import cache
+from ganeti.caching import cache
 from ganeti.models import Cluster, Instance
 from django.template import Context, Template
 from django.conf import settings
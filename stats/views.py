@@ -22,7 +22,7 @@ from operator import itemgetter
 
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User, Group
-from django.core.cache import cache
+from ganeti.caching import cache
 from django.db import close_old_connections
 from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import render, get_object_or_404
@@ -37,6 +37,7 @@ import logging
 import json
 import socket
 import urllib
+import select
 import threading
 import pycurl
 import time
@@ -166,11 +167,29 @@ except AttributeError:
   _CURLE_SSL_CACERT = 60
   _CURLE_SSL_CACERT_BADFILE = 77
 
+try:
+  _CURLE_OPERATION_TIMEDOUT = pycurl.E_OPERATION_TIMEDOUT
+except AttributeError:
+  _CURLE_OPERATION_TIMEDOUT = 28
+
 _CURL_SSL_CERT_ERRORS = frozenset([
   _CURLE_SSL_CACERT,
   _CURLE_SSL_CACERT_BADFILE,
   ])
 
+#: Maximum number of idle cURL handles kept around per client
+DEFAULT_CURL_POOL_SIZE = 10
+
+#: Counters maintained by L{CurlPool}
+CURL_POOL_COUNTERS = frozenset([
+  "requests",
+  "handles_created",
+  "handles_reused",
+  "handles_discarded",
+  "connections_created",
+  "connections_reused",
+  ])
+
 
 class Error(Exception):
   """Base error class for this module.
@@ -249,6 +268,134 @@ def UsesRapiClient(fn):
   return wrapper
 
 
+class CurlPool(object):
+  """Pool of reusable cURL handles.
+
+  A handle is checked out by exactly one caller (thread or greenlet) for the
+  duration of a request and returned afterwards. Since libcurl keeps the
+  connection and the TLS session cache on the handle, subsequent requests
+  through a pooled handle skip the TCP and TLS handshakes.
+
+  """
+  def __init__(self, factory, max_idle=DEFAULT_CURL_POOL_SIZE):
+    """Initializes this class.
+
+    @type factory: callable
+    @param factory: Function returning a new, configured C{pycurl.Curl} object
+    @type max_idle: int
+    @param max_idle: Maximum number of idle handles to keep
+
+    """
+    self._factory = factory
+    self._max_idle = max_idle
+    self._idle = []
+    self._lock = threading.Lock()
+    self._stats = dict.fromkeys(CURL_POOL_COUNTERS, 0)
+
+  def _Count(self, counter, value=1):
+    """Increments one of the pool counters.
+
+    """
+    self._lock.acquire()
+    try:
+      self._stats[counter] += value
+    finally:
+      self._lock.release()
+
+  def Acquire(self):
+    """Checks out a cURL handle, creating a new one if none is idle.
+
+    @rtype: pycurl.Curl
+
+    """
+    self._lock.acquire()
+    try:
+      if self._idle:
+        curl = self._idle.pop()
+      else:
+        curl = None
+      self._stats["requests"] += 1
+    finally:
+      self._lock.release()
+
+    if curl is None:
+      curl = self._factory()
+      self._Count("handles_created")
+    else:
+      self._Count("handles_reused")
+
+    return curl
+
+  def Release(self, curl, reusable=True):
+    """Returns a cURL handle to the pool.
+
+    @type curl: pycurl.Curl
+    @param curl: Handle previously returned by L{Acquire}
+    @type reusable: bool
+    @param reusable: Whether the handle is in a state that allows reuse; pass
+                     C{False} after transfer errors so that a possibly broken
+                     connection is not handed out again
+
+    """
+    if reusable:
+      self._lock.acquire()
+      try:
+        if len(self._idle) < self._max_idle:
+          self._idle.append(curl)
+          return
+      finally:
+        self._lock.release()
+
+    self._Count("handles_discarded")
+    curl.close()
+
+  def RecordTransfer(self, curl):
+    """Records whether a finished transfer reused an existing connection.
+
+    @type curl: pycurl.Curl
+    @param curl: Handle that just completed a transfer
+
+    """
+    try:
+      new_connections = curl.getinfo(pycurl.NUM_CONNECTS)
+    except (AttributeError, pycurl.error):
+      return
+
+    if new_connections:
+      self._Count("connections_created", new_connections)
+    else:
+      self._Count("connections_reused")
+
+  def Close(self):
+    """Closes all idle handles.
+
+    """
+    self._lock.acquire()
+    try:
+      idle = self._idle
+      self._idle = []
+    finally:
+      self._lock.release()
+
+    for curl in idle:
+      curl.close()
+
+  def GetStats(self):
+    """Returns a snapshot of the pool counters.
+
+    @rtype: dict
+
+    """
+    self._lock.acquire()
+    try:
+      stats = self._stats.copy()
+      stats["idle"] = len(self._idle)
+    finally:
+      self._lock.release()
+
+    return stats
+
+
 def GenericCurlConfig(verbose=False, use_signal=False,
                       use_curl_cabundle=False, cafile=None, capath=None,
                       proxy=None, verify_hostname=False,
@@ -360,7 +507,8 @@ class GanetiRapiClient(object): # pylint: disable=R0904
 
   def __init__(self, host, port=GANETI_RAPI_PORT,
                username=None, password=None, logger=logging,
-               curl_config_fn=None, curl_factory=None):
+               curl_config_fn=None, curl_factory=None,
+               curl_pool_size=DEFAULT_CURL_POOL_SIZE):
     """Initializes this class.
 
     @type host: string
@@ -373,6 +521,9 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     @param password: the password to connect with
     @type curl_config_fn: callable
     @param curl_config_fn: Function to configure C{pycurl.Curl} object
+    @type curl_pool_size: int
+    @param curl_pool_size: Maximum number of idle cURL handles (and thus
+                           persistent connections) kept by this client
     @param logger: Logging object
 
     """
@@ -381,6 +532,7 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     self._logger = logger
     self._curl_config_fn = curl_config_fn
     self._curl_factory = curl_factory
+    self._curl_pool = CurlPool(self._CreateCurl, max_idle=curl_pool_size)
 
     try:
       socket.inet_pton(socket.AF_INET6, host)
@@ -414,6 +566,10 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     curl.setopt(pycurl.USERAGENT, self.USER_AGENT)
     curl.setopt(pycurl.SSL_VERIFYHOST, 0)
     curl.setopt(pycurl.SSL_VERIFYPEER, False)
+    # Keep connections open between requests made through the same handle
+    curl.setopt(pycurl.FORBID_REUSE, False)
+    if hasattr(pycurl, "TCP_KEEPALIVE"):
+      curl.setopt(pycurl.TCP_KEEPALIVE, 1)
     curl.setopt(pycurl.HTTPHEADER, [
       "Accept: %s" % HTTP_APP_JSON,
       "Content-type: %s" % HTTP_APP_JSON,
@@ -434,6 +590,22 @@ class GanetiRapiClient(object): # pylint: disable=R0904
 
     return curl
 
+  def GetCurlPoolStats(self):
+    """Returns the counters of this client's cURL handle pool.
+
+    @rtype: dict
+    @return: number of requests, created/reused/discarded handles, and
+             created/reused connections
+
+    """
+    return self._curl_pool.GetStats()
+
+  def Close(self):
+    """Closes the idle cURL handles of this client, and their connections.
+
+    """
+    self._curl_pool.Close()
+
   @staticmethod
   def _EncodeQuery(query):
     """Encode query values for RAPI URL.
@@ -462,12 +634,11 @@ class GanetiRapiClient(object): # pylint: disable=R0904
 
     return result
 
-  def _SendRequest(self, method, path, query, content):
-    """Sends an HTTP request.
-
-    This constructs a full URL, encodes and decodes HTTP bodies, and
-    handles invalid responses in a pythonic way.
+  def _PrepareRequest(self, curl, method, path, query, content):
+    """Configures a cURL handle for a request.
 
+    @type curl: pycurl.Curl
+    @param curl: Handle checked out from this client's pool
     @type method: string
     @param method: HTTP method to use
     @type path: string
@@ -477,17 +648,12 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     @type content: str or None
     @param content: HTTP body content
 
-    @rtype: str
-    @return: JSON-Decoded response
-
-    @raises CertificateError: If an invalid SSL certificate is found
-    @raises GanetiApiError: If an invalid response is returned
+    @rtype: StringIO
+    @return: Buffer the response body will be written to
 
     """
     assert path.startswith("/")
 
-    curl = self._CreateCurl()
-
     if content is not None:
       encoded_content = self._json_encoder.encode(content)
     else:
@@ -513,25 +679,43 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     curl.setopt(pycurl.POSTFIELDS, str(encoded_content))
     curl.setopt(pycurl.WRITEFUNCTION, encoded_resp_body.write)
 
-    try:
-      # Send request and wait for response
-      try:
-        curl.perform()
-      except pycurl.error, err:
-        if err.args[0] in _CURL_SSL_CERT_ERRORS:
-          raise CertificateError("SSL certificate error %s" % err,
-                                 code=err.args[0])
+    return encoded_resp_body
 
-        raise GanetiApiError(str(err), code=err.args[0])
-    finally:
-      # Reset settings to not keep references to large objects in memory
-      # between requests
-      curl.setopt(pycurl.POSTFIELDS, "")
-      curl.setopt(pycurl.WRITEFUNCTION, lambda _: None)
+  def _FinishRequest(self, curl, reusable):
+    """Returns a cURL handle used by a finished request to the pool.
+
+    """
+    # Reset settings to not keep references to large objects in memory
+    # between requests
+    curl.setopt(pycurl.POSTFIELDS, "")
+    curl.setopt(pycurl.WRITEFUNCTION, lambda _: None)
+    self._curl_pool.Release(curl, reusable=reusable)
+
+  @staticmethod
+  def _CurlError(errno, msg):
+    """Converts a cURL error to an exception instance.
+
+    @rtype: L{GanetiApiError}
+
+    """
+    if errno in _CURL_SSL_CERT_ERRORS:
+      return CertificateError("SSL certificate error %s" % msg, code=errno)
+
+    return GanetiApiError(msg, code=errno)
+
+  @staticmethod
+  def _ParseResponse(http_code, encoded_resp_body):
+    """Decodes a response and checks its HTTP status.
 
-    # Get HTTP response code
-    http_code = curl.getinfo(pycurl.RESPONSE_CODE)
+    @type http_code: int
+    @param http_code: HTTP response code
+    @type encoded_resp_body: StringIO
+    @param encoded_resp_body: Buffer holding the response body
 
+    @return: JSON-Decoded response
+    @raises GanetiApiError: If an invalid response is returned
+
+    """
     # Was anything written to the response buffer?
     if encoded_resp_body.tell():
       response_content = json.loads(encoded_resp_body.getvalue())
@@ -551,6 +735,50 @@ class GanetiRapiClient(object): # pylint: disable=R0904
 
     return response_content
 
+  def _SendRequest(self, method, path, query, content):
+    """Sends an HTTP request.
+
+    This constructs a full URL, encodes and decodes HTTP bodies, and
+    handles invalid responses in a pythonic way.
+
+    @type method: string
+    @param method: HTTP method to use
+    @type path: string
+    @param path: HTTP URL path
+    @type query: list of two-tuples
+    @param query: query arguments to pass to urllib.urlencode
+    @type content: str or None
+    @param content: HTTP body content
+
+    @rtype: str
+    @return: JSON-Decoded response
+
+    @raises CertificateError: If an invalid SSL certificate is found
+    @raises GanetiApiError: If an invalid response is returned
+
+    """
+    curl = self._curl_pool.Acquire()
+
+    reusable = False
+    try:
+      encoded_resp_body = self._PrepareRequest(curl, method, path, query,
+                                               content)
+
+      # Send request and wait for response
+      try:
+        curl.perform()
+      except pycurl.error, err:
+        raise self._CurlError(err.args[0], str(err))
+
+      # Get HTTP response code
+      http_code = curl.getinfo(pycurl.RESPONSE_CODE)
+      self._curl_pool.RecordTransfer(curl)
+      reusable = True
+    finally:
+      self._FinishRequest(curl, reusable)
+
+    return self._ParseResponse(http_code, encoded_resp_body)
+
   def GetVersion(self):
     """Gets the Remote API version running on the cluster.
 
@@ -2188,3 +2416,131 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     return self._SendRequest(HTTP_GET,
                              ("/%s/query/%s/fields" %
                               (GANETI_RAPI_VERSION, what)), query, None)
+
+
+def SendMany(requests, timeout=None):
+  """Sends several RAPI requests concurrently.
+
+  All requests are driven by a single C{pycurl.CurlMulti} loop, using handles
+  from the pools of the respective clients. Waiting is done through
+  C{select.select}, so when the caller runs under gevent the loop yields to
+  other greenlets instead of blocking the process.
+
+  Failures do not abort the batch: a request that fails or misses its
+  deadline gets the corresponding exception instance as its result, while
+  the remaining requests carry on.
+
+  @type requests: list of tuples
+  @param requests: C{(client, method, path, query, content)} tuples, as
+                   passed to C{GanetiRapiClient._SendRequest}; an optional
+                   sixth item overrides C{timeout} for that request
+  @type timeout: number
+  @param timeout: Deadline in seconds for every request, measured from the
+                  start of the batch (C{None} for no deadline besides the
+                  ones configured on the clients' cURL handles)
+  @rtype: list
+  @return: One item per request, in order: either the JSON-decoded response
+           or an L{Error} instance describing why the request failed
+
+  """
+  results = [None] * len(requests)
+  # Maps cURL handles to (index, client, response buffer, deadline)
+  pending = {}
+  start = time.time()
+  multi = pycurl.CurlMulti()
+
+  def _Finish(curl, error=None):
+    (idx, client, encoded_resp_body, _) = pending.pop(curl)
+    multi.remove_handle(curl)
+
+    reusable = False
+    try:
+      if error is not None:
+        results[idx] = error
+      else:
+        http_code = curl.getinfo(pycurl.RESPONSE_CODE)
+        client._curl_pool.RecordTransfer(curl) # pylint: disable=W0212
+        reusable = True
+        try:
+          results[idx] = client._ParseResponse(http_code, encoded_resp_body)
+        except (Error, ValueError), err:
+          results[idx] = err
+    finally:
+      client._FinishRequest(curl, reusable) # pylint: disable=W0212
+
+  try:
+    for idx, request in enumerate(requests):
+      (client, method, path, query, content) = request[:5]
+      if len(request) > 5:
+        req_timeout = request[5]
+      else:
+        req_timeout = timeout
+
+      curl = client._curl_pool.Acquire() # pylint: disable=W0212
+      try:
+        encoded_resp_body = client._PrepareRequest(curl, method, path, query,
+                                                   content)
+      except (Error, ValueError), err:
+        results[idx] = err
+        client._FinishRequest(curl, True) # pylint: disable=W0212
+        continue
+
+      if req_timeout is not None:
+        deadline = start + req_timeout
+      else:
+        deadline = None
+
+      pending[curl] = (idx, client, encoded_resp_body, deadline)
+      multi.add_handle(curl)
+
+    while pending:
+      while True:
+        (ret, _) = multi.perform()
+        if ret != pycurl.E_CALL_MULTI_PERFORM:
+          break
+
+      while True:
+        (queued, ok_list, err_list) = multi.info_read()
+        for curl in ok_list:
+          _Finish(curl)
+        for (curl, errno, msg) in err_list:
+          _Finish(curl, GanetiRapiClient._CurlError(errno, msg))
+        if not queued:
+          break
+
+      # Expire requests that missed their deadline
+      now = time.time()
+      deadlines = []
+      for (curl, (_, _, _, deadline)) in pending.items():
+        if deadline is None:
+          continue
+        if deadline <= now:
+          _Finish(curl, GanetiApiError("Request timed out after %s seconds" %
+                                       (now - start),
+                                       code=_CURLE_OPERATION_TIMEDOUT))
+        else:
+          deadlines.append(deadline - now)
+
+      if not pending:
+        break
+
+      # Wait for activity, but not longer than cURL or the nearest deadline
+      # allow
+      wait = 1.0
+      curl_timeout = multi.timeout()
+      if curl_timeout >= 0:
+        wait = min(wait, curl_timeout / 1000.0)
+      if deadlines:
+        wait = min(wait, min(deadlines))
+
+      (read_fds, write_fds, exc_fds) = multi.fdset()
+      if read_fds or write_fds or exc_fds:
+        select.select(read_fds, write_fds, exc_fds, wait)
+      elif wait > 0:
+        time.sleep(wait)
+  finally:
+    for curl in pending.keys():
+      _Finish(curl, GanetiApiError("Request aborted"))
+    multi.close()
+
+  return results
@@ -30,7 +30,7 @@ import setproctitle
 from lockfile import LockError
 from signal import SIGINT, SIGTERM
 
-from gevent import sleep, signal
+from gevent import sleep, signal, spawn, Timeout
 from gevent import reinit as gevent_reinit
 from gevent.pool import Pool
 
@@ -42,10 +42,13 @@ import django
 django.setup()
 
 from ganeti.models import Cluster
+from ganeti.utils import invalidate_cluster_users_cache
+from ganeti.warmer import CacheWarmer
+from ganeti.jobpoller import JobPoller, JobWaiter, POLL_INTERVALS
+from ganeti.jobqueue import flush_outbox
 from apply.models import InstanceApplication, STATUS_FAILED, STATUS_SUCCESS
-from django.core.cache import cache
+from ganeti.caching import cache
 from django.contrib.sites.models import Site
-from django.contrib.auth.models import User
 from django.utils.encoding import smart_str
 from django.core.mail import mail_admins, mail_managers, send_mail
 from django.core import urlresolvers
@@ -54,20 +57,18 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.db import close_old_connections
 
 logger = None
+# Tracks the jobs handlers wait for, replaced by a JobWaiter with
+# --wait-jobs
+job_poller = JobPoller()
 
-POLL_INTERVALS = [0.5, 1, 1, 2, 2, 2, 5]
+# Seconds between checks of a lock or an application while its job runs
+LOCK_TOUCH_INTERVAL = POLL_INTERVALS[-1]
 DEFAULT_WORKERS = 10
 DEFAULT_PID_FILE = "/var/run/ganetimgr-watcher.pid"
 DEFAULT_LOG_FILE = "/var/log/ganetimgr/watcher.log"
 RESERVE_ERROR_THRESHOLD = 30
-
-
-def next_poll_interval():
-    for t in POLL_INTERVALS:
-        yield t
-
-    while True:
-        yield POLL_INTERVALS[-1]
+# Seconds between moves of the messages the web processes could not queue
+OUTBOX_FLUSH_INTERVAL = 10
 
 
 def try_log(fn, *args, **kwargs):
@@ -117,11 +118,24 @@ def monitor_jobs():
         if "type" in data and data["type"] in DISPATCH_TABLE:
             DISPATCH_TABLE[data["type"]](job)
 
+
+def monitor_outbox():
+    while True:
+        try:
+            moved = flush_outbox()
+            if moved:
+                logger.info("Moved %d messages from the outbox to beanstalkd" %
+                            moved)
+        except Exception, err:
+            logger.error("Error flushing the outbox: %s" % str(err))
+        finally:
+            close_old_connections()
+        sleep(OUTBOX_FLUSH_INTERVAL)
+
+
 def clear_cluster_users_cache(cluster_slug):
-    for user in User.objects.all():
-        cache.delete("user:%s:index:instances" %user.username)
+    invalidate_cluster_users_cache(cluster_slug)
     cache.delete("cluster:%s:instances" % cluster_slug)
-    close_old_connections()
 
 def handle_job_lock(job):
     global logger
@@ -142,28 +156,24 @@ def handle_job_lock(job):
     finally:
         close_old_connections()
 
-    pi = next_poll_interval()
-    while True:
-        logger.debug("Checking lock key %s (job: %d)" % (lock_key, job_id))
-        reason = cache.get(lock_key)
-        if reason is None:
-            logger.info("Lock key %s vanished, forgetting it" % lock_key)
-            job.delete()
-            return
+    result = job_poller.watch(cluster, job_id)
+    try:
+        while True:
+            logger.debug("Checking lock key %s (job: %d)" % (lock_key, job_id))
+            reason = cache.get(lock_key)
+            if reason is None:
+                logger.info("Lock key %s vanished, forgetting it" % lock_key)
+                job.delete()
+                return
 
-        logger.debug("Polling job %d" % job_id)
-        try:
-            status = cluster.get_job_status(job_id)
-        except Exception, err:
-            logger.warn("Error polling job: %s" % str(err))
-            close_old_connections()
-            sleep(pi.next())
-            continue
-        finally:
-            close_old_connections()
-        logger.debug("Done")
+            try:
+                status = result.get(timeout=LOCK_TOUCH_INTERVAL)
+            except Timeout:
+                # Touch the key
+                cache.set(lock_key, reason, 30)
+                job.touch()
+                continue
 
-        if status["end_ts"]:
             logger.info("Job %d finished, removing lock %s" %
                          (job_id, lock_key))
             if "flush_keys" in data:
@@ -188,10 +198,8 @@ def handle_job_lock(job):
             clear_cluster_users_cache(cluster.slug)
             job.delete()
             return
-        # Touch the key
-        cache.set(lock_key, reason, 30)
-        job.touch()
-        sleep(pi.next())
+    finally:
+        job_poller.forget(cluster, job_id)
 
 
 def handle_creation(job):
@@ -214,12 +222,14 @@ def handle_creation(job):
 
     logger.info("Handling %s (job: %d)",
                  application.hostname, application.job_id)
-    while True:
-        sleep(15)
-        logger.info("Checking %s (job: %d)",
-                     application.hostname, application.job_id)
-        status = application.cluster.get_job_status(application.job_id)
-        if status["end_ts"]:
+    result = job_poller.watch(application.cluster, application.job_id)
+    try:
+        while True:
+            try:
+                status = result.get(timeout=LOCK_TOUCH_INTERVAL)
+            except Timeout:
+                job.touch()
+                continue
             logger.info("%s (job: %d) done. Status: %s", application.hostname,
                          application.job_id, status["status"])
             if status["status"] == "error":
@@ -265,7 +275,8 @@ def handle_creation(job):
             job.delete()
             close_old_connections()
             break
-        job.touch()
+    finally:
+        job_poller.forget(application.cluster, application.job_id)
 
 
 DISPATCH_TABLE = {
@@ -296,6 +307,14 @@ def parse_arguments(args):
                       help="User to run as")
     parser.add_option("-g", "--group", dest="group", metavar="GROUP",
                       help="Group to run as")
+    parser.add_option("-c", "--warm-cache", action="store_true",
+                      dest="warm_cache",
+                      help="Keep the cluster caches fresh, replacing the"
+                           " refresh_cluster_instances cron job")
+    parser.add_option("-W", "--wait-jobs", action="store_true",
+                      dest="wait_jobs",
+                      help="Track jobs through RAPI job change notifications"
+                           " instead of polling them")
     return parser.parse_args(args)
 
 
@@ -319,7 +338,7 @@ def main():
 
     lvl = logging.DEBUG if opts.debug else logging.INFO
 
-    global logger
+    global logger, job_poller
     logger = logging.getLogger("watcher")
     logger.setLevel(lvl)
     formatter = logging.Formatter("%(asctime)s %(message)s",
@@ -386,6 +405,14 @@ def main():
     setproctitle.setproctitle(sys.argv[0])
 
     logger.info("Initialization complete")
+    if opts.wait_jobs:
+        job_poller = JobWaiter()
+    spawn(job_poller.run)
+    spawn(monitor_outbox)
+    if opts.warm_cache:
+        logger.info("Starting cache warmer")
+        spawn(CacheWarmer().run)
+
     p = Pool(opts.workers)
     while True:
         logger.debug("Spawning new worker")